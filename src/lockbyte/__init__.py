@@ -1,4 +1,4 @@
-__all__ = ['app', 'lock_unlock']
+__all__ = ['app', 'archive', 'atomic', 'batch', 'cli', 'compress', 'container', 'journal', 'lock_unlock', 'manifest', 'reader', 'scheduler']
 
 version_info = (1, 0, 0)
 
@@ -10,16 +10,18 @@ import darkdetect
 import customtkinter as ctk
 from argon2 import exceptions as argon2exceptions
 
-from tkinter import filedialog, ttk, Menu
-from concurrent.futures import ThreadPoolExecutor
+from tkinter import filedialog, messagebox, ttk, Menu
 from threading import Event
+from queue import SimpleQueue, Empty
 from sys import exc_info, argv
-from os import walk, unlink, path as ospath, remove as osremove
+from os import unlink, path as ospath
 from platform import system
-from fnmatch import fnmatch
+from multiprocessing import freeze_support
 import webbrowser
 
-from lockbyte.lock_unlock import LockByteUser
+from lockbyte.batch import BatchRunner, walk_files, format_eta
+from lockbyte.journal import journal_path
+from lockbyte.manifest import manifest_path
 # from lock_unlock import LockByteUser
 
 
@@ -35,6 +37,12 @@ class App(ctk.CTkFrame):
     '''
     Class to build customtkinter UI for the LockByte App
     '''
+    batch_backend = "thread"  # 'thread' or 'process', see lockbyte.batch.BatchRunner
+    incremental_folders = False  # folders encrypted with files kept only encrypt new or changed files
+    prune_outputs = False  # delete .lockbyte files of deleted sources on incremental folder runs
+    compression = None  # codec compressing files before encryption, e.g. 'auto', see lockbyte.compress
+    user_tips_interval = 100  # milliseconds between two updates of the user tips box
+    user_tips_max_lines = 2000  # older lines are dropped from the user tips box
 
     def __init__(self, root) -> None:
 
@@ -92,8 +100,8 @@ class App(ctk.CTkFrame):
         self.load_main_widgets()  # load all widgets
         self.index = 0  # index number for frames
         self.cancel_event = Event()
-        self.user_tips_write_ready_event = Event()
-        self.user_tips_write_ready_event.set()
+        self.user_tips_queue = SimpleQueue()  # messages from any thread, written by the Tk main loop
+        self.after(self.user_tips_interval, self.flush_user_tips)
 
         # configure widget(s) behaviour on keypress
         self.passw_text.bind("<Any-KeyPress>", lambda event,
@@ -107,9 +115,9 @@ class App(ctk.CTkFrame):
             "<Button-1>", lambda e: webbrowser.open_new("https://github.com/bose-kb/LockByte"))
 
         # declare multi-threading variables
-        global pool, jobs
-        pool = None
-        jobs = []
+        global runner
+        runner = None
+        self.batch_mode = None
 
     # function to call all other widgets creation functions
     def load_main_widgets(self):
@@ -216,10 +224,9 @@ class App(ctk.CTkFrame):
         self.passw_text.configure(border_color=self.colour2)
         self.progress_bar.configure(
             progress_color=self.colour1)  # update progressbar
-        global pool, jobs
-
-        # create a pool of threads for parallel execution
-        pool = ThreadPoolExecutor(max_workers=2)
+        global runner
+        self.batch_mode = self.action_button.cget("text").lower()
+        self.batch_source = mode
 
         try:
             # check file/folder option choice
@@ -229,21 +236,8 @@ class App(ctk.CTkFrame):
                 self.source_file_text.configure(border_color=self.colour2)
                 self.browse_file_button.configure(state="disabled")
                 self.browse_file_button.configure(fg_color=self.colour2)
-                file_path = self.source_file_location.get().strip()
-                if self.action_button.cget("text") == "Encrypt":
-                    self.progress_bar.start()
-                    # add job to pool
-                    jobs = [pool.submit(
-                        self.begin_encryption, file_path, self.cancel_event)]
-                    # update progressbar
-                    self.after(200, self.check_thread_pool)
-                else:
-                    self.progress_bar.start()
-                    # add job to pool
-                    jobs = [pool.submit(
-                        self.begin_decryption, file_path, self.cancel_event)]
-                    # update progressbar
-                    self.after(200, self.check_thread_pool)
+                file_paths = [self.source_file_location.get().strip()]
+                source_path = file_paths[0]
 
             elif mode == "folder":
                 # disable folder picker
@@ -252,134 +246,108 @@ class App(ctk.CTkFrame):
                 self.browse_folder_button.configure(state="disabled")
                 self.browse_folder_button.configure(fg_color=self.colour2)
                 folder_path = self.source_folder_location.get().strip()
-                extension = "*.lockbyte"
-                jobs = []
-
-                if self.action_button.cget("text") == "Encrypt":
-                    self.progress_bar.start()
-                    # search given folder and sub folders
-                    for path, subdirs, files in walk(folder_path):
-                        for name in files:
-                            jobs.append(pool.submit(
-                                # add job to pool
-                                self.begin_encryption, ospath.join(path, name), self.cancel_event))
-                    self.update_idletasks()
-                    # update progressbar
-                    self.after(200, self.check_thread_pool)
-                    if len(jobs) == 0:
-                        raise EmptyFolderError(
-                            "Folder is empty or invalid folder path provided")
+                source_path = folder_path
+                # search given folder and sub folders on the runner, files are processed while the scan goes on
+                if self.batch_mode == "encrypt":
+                    file_paths = walk_files(folder_path)
                 else:
-                    self.progress_bar.start()
-                    # search given folder and sub folders
-                    for path, subdirs, files in walk(folder_path):
-                        for name in files:
-                            if fnmatch(name, extension):
-                                jobs.append(pool.submit(
-                                    # add job to pool
-                                    self.begin_decryption, ospath.join(path, name), self.cancel_event))
-                    self.update_idletasks()
-                    # update progressbar
-                    self.after(200, self.check_thread_pool)
-                    if len(jobs) == 0:
-                        raise EmptyFolderError(
-                            "Folder is empty or no lockbyte files were found")
+                    file_paths = walk_files(folder_path, include="*.lockbyte")
+
+            self.progress_bar.set(0)  # determinate progressbar, updated by check_thread_pool
+            # run jobs on a pool of workers sharing one password derivation, scrypt
+            # runs are separately limited by the available memory (see lockbyte.scheduler)
+            keep_files = self.batch_mode == "decrypt" or self.keep_files_switch_val.get() == "on"
+            manifest = None
+            if mode == "folder" and self.batch_mode == "encrypt" and keep_files and self.incremental_folders:
+                # later runs on the folder skip unchanged files, outputs of changed files are replaced
+                manifest = manifest_path(source_path)
+                file_paths = walk_files(source_path, exclude="*.lockbyte")
+            # an interrupted batch on the same source resumes from its journal unless the user starts over
+            journal = journal_path(self.batch_mode, [source_path])
+            if ospath.isfile(journal) and not messagebox.askyesno(
+                    "Resume", "An earlier run on this source did not finish. Resume it and skip the files it "
+                    "already processed?\n\nChoose No to start over.", parent=self.master):
+                unlink(journal)
+            runner = BatchRunner(self.batch_mode, self.user_passw.get().strip(), backend=self.batch_backend,
+                                 keep_files=keep_files, cancel_event=self.cancel_event, on_event=self.on_batch_event,
+                                 keep_results=False, journal=journal,
+                                 manifest=manifest, prune=self.prune_outputs,
+                                 compression=self.compression if self.batch_mode == "encrypt" else None)
+            runner.start(file_paths)
+            # update progressbar
+            self.after(200, self.check_thread_pool)
 
-        except EmptyFolderError as e:  # handle empty folder condition
-            self.update_user_tips(
-                "-- Empty folder error: {0}\n".format(e), self.user_tips_write_ready_event)
         except:  # handle other exceptions
             self.update_user_tips(
-                "-- Unexpected error: {0}\n".format(exc_info()[1]), self.user_tips_write_ready_event)
+                "-- Unexpected error: {0}\n".format(exc_info()[1]))
             raise
 
-    # function to handle encryption
-    def begin_encryption(self, file_path: str, cancel_event: Event):
+    # function to report events of the batch runner
+    def on_batch_event(self, kind: str, file_path: str, value):
         '''
-        Function to handle encryption process
+        Function to report the progress of encryption/decryption jobs to the user
 
-        :param file_path: path to file to be encrypted
-        :param cancel_event: threading.Event object to signal cancellation of operation
+        :param kind: event type, one of 'start', 'done' or 'error'
+        :param file_path: path to file the event refers to
+        :param value: new file path for 'done' events (None if cancelled), exception for 'error' events
         '''
-        user = LockByteUser(self.user_passw.get().strip())
-        # encryption process
-        try:
+        if kind == "start":
             self.update_user_tips(
-                "-- Reading File: {0}\n".format(file_path), self.user_tips_write_ready_event)
-            with open(file_path, "rb") as file:
+                "-- Reading File: {0}\n".format(file_path))
+            if self.batch_mode == "encrypt":
                 self.update_user_tips(
-                    "-- Encrypting..\n", self.user_tips_write_ready_event)
-                if user.validate_and_generate(1):
-                    if cancel_event.is_set():
-                        return
-                    user.encrypt(file=file, file_path=file_path)
-            if self.keep_files_switch_val.get() == "off" and ospath.isfile(file_path):
-                osremove(file_path)
-            self.update_user_tips(
-                "-- Encrypted: {0}\n".format(file_path), self.user_tips_write_ready_event)
-
-        except FileNotFoundError:
-            self.update_user_tips(
-                "-- File error: {0} not found\n".format(file_path), self.user_tips_write_ready_event)
-        except IOError as e:
-            self.update_user_tips(
-                "-- I/O error({0}): {1}\n".format(e.errno, e.strerror), self.user_tips_write_ready_event)
-        except ValueError as ve:  # handle low memory case
-            if "Error 2 while running scrypt" in getattr(ve, 'message', str(ve)):
+                    "-- Encrypting..\n")
+            else:
+                self.update_user_tips(
+                    "-- Decrypting..\n")
+        elif kind == "done" and value is not None:
+            if self.batch_mode == "encrypt":
                 self.update_user_tips(
-                    "-- Memory error: Not enough memory available\n", self.user_tips_write_ready_event)
+                    "-- Encrypted: {0}\n".format(file_path))
             else:
                 self.update_user_tips(
-                    "-- Unexpected error: {0}\n".format(exc_info()[1]), self.user_tips_write_ready_event)
-        except:  # handle other exceptions
+                    "-- Decrypted: {0}\n".format(file_path))
+        elif kind == "pruned":
             self.update_user_tips(
-                "-- Unexpected error: {0}\n".format(exc_info()[1]), self.user_tips_write_ready_event)
+                "-- Deleted (source removed): {0}\n".format(file_path))
+        elif kind == "error":
+            self.report_error(file_path, value)
 
-    # function to handle decryption
-    def begin_decryption(self, file_path: str, cancel_event: Event):
+    # function to report errors of encryption/decryption jobs
+    def report_error(self, file_path: str, error: Exception):
         '''
-        Function to handle decryption process
+        Function to translate an error raised while processing a file into a user tip
 
-        :param file_path: path to file to be decrypted
-        :param cancel_event: threading.Event object to signal cancellation of operation
+        :param file_path: path to file that failed
+        :param error: exception raised by the job
         '''
-        user = LockByteUser(self.user_passw.get().strip())
-        # decryption process
         try:
-            self.update_user_tips(
-                "-- Reading File: {0}\n".format(file_path), self.user_tips_write_ready_event)
-            with open(file_path, "rb") as file:
-                self.update_user_tips(
-                    "-- Decrypting..\n", self.user_tips_write_ready_event)
-                file_path_new = user.decrypt(file=file, file_path=file_path)
-                if cancel_event.is_set():
-                    if ospath.isfile(file_path_new):
-                        osremove(file_path_new)
-                    return
-            self.update_user_tips(
-                "-- Decrypted: {0}\n".format(file_path), self.user_tips_write_ready_event)
+            raise error
         except FileNotFoundError:
             self.update_user_tips(
-                "-- File error: {0} not found\n".format(file_path), self.user_tips_write_ready_event)
+                "-- File error: {0} not found\n".format(file_path))
         except IOError as e:
             self.update_user_tips(
-                "-- I/O error({0}): {1}\n".format(e.errno, e.strerror), self.user_tips_write_ready_event)
+                "-- I/O error({0}): {1}\n".format(e.errno, e.strerror))
         except argon2exceptions.InvalidHashError:  # handle corrupt/ non-lockbyte files
             self.update_user_tips(
-                "-- File error: File chosen is corrupt or of incorrect type\n", self.user_tips_write_ready_event)
+                "-- File error: File chosen is corrupt or of incorrect type\n")
         except argon2exceptions.VerifyMismatchError:  # handle incorrect password
             self.update_user_tips(
-                "-- Authentication error: Password entered is incorrect\n", self.user_tips_write_ready_event)
+                "-- Authentication error: Password entered is incorrect\n")
         except ValueError as ve:  # handle low memory case
             if "Error 2 while running scrypt" in getattr(ve, 'message', str(ve)):
                 self.update_user_tips(
-                    "-- Memory error: Not enough memory available\n", self.user_tips_write_ready_event)
+                    "-- Memory error: Not enough memory available\n")
+            elif self.batch_mode == "encrypt":
+                self.update_user_tips(
+                    "-- Unexpected error: {0}\n".format(exc_info()[1]))
             elif not self.cancel_event.is_set():
                 self.update_user_tips(
-                    "-- Unexpected error occured\n", self.user_tips_write_ready_event)
+                    "-- Unexpected error occured\n")
         except:  # handle other exceptions
             self.update_user_tips(
-                "-- Unexpected error: {0}\n".format(exc_info()[1]), self.user_tips_write_ready_event)
+                "-- Unexpected error: {0}\n".format(exc_info()[1]))
 
     # check status of thread and update progressbar
     def check_thread_pool(self):
@@ -388,19 +356,19 @@ class App(ctk.CTkFrame):
 
         :param cancel_operation: flag variable to indicate if cancel request was made
         '''
-        for job in jobs:
-            if job.done():
-                jobs.remove(job)  # remove completed job from jobs list
-            else:
-                break
-        if len(jobs) > 0:
+        if not runner.done():
+            # update progressbar with the bytes processed so far
+            progress = runner.progress()
+            self.progress_bar.set(progress.fraction)
+            self.progress_label.configure(text="{0:.0f}%  {1:.1f} MB/s  ETA {2}".format(
+                100 * progress.fraction, progress.rate / 2**20, format_eta(progress.eta)))
             self.after(200, self.check_thread_pool)
             self.update_idletasks()
         else:
             # update progressbar
-            self.progress_bar.stop()
             self.progress_bar.configure(progress_color=self.colour3)
             self.progress_bar.set(0)
+            self.progress_label.configure(text="")
 
             self.back_button.configure(
                 state="normal")  # enable back button
@@ -420,12 +388,26 @@ class App(ctk.CTkFrame):
                 fg_color=self.colour1)  # reconfigure exit button
             self.cancel_button.configure(
                 hover_color=('#36719F', '#144870'))  # reconfigure exit button
-            # close thread pool
-            if not self.cancel_event.is_set():
-                pool.shutdown()
+            progress = runner.progress()
+            if progress.files_skipped:
+                self.update_user_tips(
+                    "-- Skipped {0} file(s) unchanged or already done by an earlier run\n".format(progress.files_skipped))
+            try:
+                # the folder is scanned while files are processed, so emptiness is only known at the end
+                if self.batch_source == "folder" and progress.files_total + progress.files_skipped == 0 \
+                        and not self.cancel_event.is_set():
+                    if self.batch_mode == "encrypt":
+                        raise EmptyFolderError(
+                            "Folder is empty or invalid folder path provided")
+                    else:
+                        raise EmptyFolderError(
+                            "Folder is empty or no lockbyte files were found")
+            except EmptyFolderError as e:  # handle empty folder condition
+                self.update_user_tips(
+                    "-- Empty folder error: {0}\n".format(e))
             self.cancel_event.clear()  # clear cancel event
             self.update_user_tips(
-                "-- Done.\n", self.user_tips_write_ready_event)
+                "-- Done.\n")
 
     # cancel thread(s) operation if cancel button pressed or exit operation if exit button pressed
     def cancel_all_threads(self):
@@ -438,12 +420,12 @@ class App(ctk.CTkFrame):
             self.cancel_button.configure(state="disabled")
             self.cancel_event.set()
             self.update_user_tips(
-                "-- Aborting..\n", self.user_tips_write_ready_event)
-            pool.shutdown(wait=False, cancel_futures=True)
+                "-- Aborting..\n")
+            runner.cancel()
             self.progress_bar.configure(progress_color=("#F62A43", "#EF1214"))
             if self.action_button.cget('text') == "Decrypt":
                 self.update_user_tips(
-                    "-- Rolling back changes..\n", self.user_tips_write_ready_event)
+                    "-- Rolling back changes..\n")
             self.check_thread_pool
 
     # add 1ms delay for Entry widgets to update
@@ -479,20 +461,35 @@ class App(ctk.CTkFrame):
             self.passw_text.configure(border_color=self.colour2)
 
     # fuction to update user-tips
-    def update_user_tips(self, message: str, user_tips_write_ready_event: Event):
+    def update_user_tips(self, message: str):
         '''
-        Function to write messages to user-tips box
+        Function to queue messages for the user-tips box, safe to call from any thread and never blocks
 
         :param message: message to be writtn to user-tips box
-        :param user_tips_write_ready_event: threading.Event object used to indicate text widget ready state
         '''
-        user_tips_write_ready_event.wait(timeout=0.5)
-        user_tips_write_ready_event.clear()
-        self.user_tips.configure(state="normal")
-        self.user_tips.insert(
-            ctk.END, message)
-        self.user_tips.configure(state="disabled")
-        user_tips_write_ready_event.set()
+        self.user_tips_queue.put(message)
+
+    # function to write queued messages to user-tips
+    def flush_user_tips(self):
+        '''
+        Function to write all queued messages to the user-tips box in a single insert, runs on the Tk main loop
+        '''
+        messages = []
+        while True:
+            try:
+                messages.append(self.user_tips_queue.get_nowait())
+            except Empty:
+                break
+        if messages:
+            self.user_tips.configure(state="normal")
+            self.user_tips.insert(
+                ctk.END, "".join(messages))
+            # cap the history kept by the widget, messages end with a newline so "end-1c" is on an empty line
+            excess = int(self.user_tips.index("end-1c").split(".")[0]) - 1 - self.user_tips_max_lines
+            if excess > 0:
+                self.user_tips.delete("1.0", "{0}.0".format(excess + 1))
+            self.user_tips.configure(state="disabled")
+        self.after(self.user_tips_interval, self.flush_user_tips)
 
     # function to clear widgets when going to previous page
     def on_click_back(self, window_change_req: int = 0):
@@ -501,6 +498,11 @@ class App(ctk.CTkFrame):
 
         :param window_change_req: 0 = window change required, 1 = not required 
         '''
+        while True:  # drop messages not written yet
+            try:
+                self.user_tips_queue.get_nowait()
+            except Empty:
+                break
         self.user_tips.configure(state="normal")
         self.user_tips.delete('1.0', ctk.END)
         self.user_tips.configure(state="disabled")
@@ -722,13 +724,24 @@ class App(ctk.CTkFrame):
         self.progress_bar = ctk.CTkProgressBar(
             self.second_frame,
             orientation="horizontal",
-            mode="indeterminate",
+            mode="determinate",
             fg_color=self.colour3,
             progress_color=self.colour3,
             height=18,
         )
         self.progress_bar.grid(row=2, rowspan=2, column=0, columnspan=2,
                                sticky=ctk.EW, padx=10, pady=(0, 0))
+        self.progress_bar.set(0)
+
+        # configure label for bytes processed, throughput and time left
+        self.progress_label = ctk.CTkLabel(
+            self.second_frame,
+            height=25,
+            text="",
+            font=(self.font_text_normal, 11)
+        )
+        self.progress_label.grid(row=4, column=0, columnspan=2,
+                                 sticky=ctk.S, padx=10, pady=15)
 
         # configure user tips box
         self.user_tips = ctk.CTkTextbox(
@@ -1238,7 +1251,7 @@ def handle_sys_args(*args, app_instance: App):
     :param app_instance: current app_instance
     '''
     global drag_drop_win
-    if len(jobs) < 1:
+    if runner is None or runner.done():
         if ospath.isdir(args[0]):
             app_root.iconify()
             drag_drop_win = create_drag_drop_window(args[0], app_instance)
@@ -1272,6 +1285,7 @@ def main():
     '''
     Main caller function
     '''
+    freeze_support()  # allow the process backend to spawn workers from frozen executables
     global curr_path, app_root, fh, drag_drop_win
     curr_path = ospath.dirname(ospath.realpath(__file__))
     print(curr_path)
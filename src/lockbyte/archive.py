@@ -0,0 +1,365 @@
+# ====================================================================
+# This file is part of LockByte.
+# LockByte is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3 of the License.
+# LockByte is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with LockByte. If not, see <https://www.gnu.org/licenses/>.
+# ====================================================================
+
+from os import pipe, replace, scandir, chmod, utime, sep, altsep, path as ospath
+from shutil import rmtree
+from copy import copy
+from struct import Struct
+from tempfile import mkdtemp
+from threading import Event
+from typing import NamedTuple
+from errno import EEXIST
+import tarfile
+import json
+import zlib
+
+from lockbyte.lock_unlock import LockByteUser, LockByteSession
+from lockbyte.container import FORMAT_MAGIC, FLAG_ARCHIVE, FLAG_CODEC_MASK, OperationCancelled
+from lockbyte.container import read_exact, run_in_thread, pipeline_error
+from lockbyte.atomic import TEMP_SUFFIX, atomic_write, fsync_dir, is_temp_file
+from lockbyte.reader import open_encrypted
+
+
+# archive payload: a tar stream (PAX format) of the folder contents, optionally followed by
+#   member index (zlib compressed JSON lines) | index offset in the payload (8) | INDEX_MAGIC (8)
+# tar readers stop at the end-of-archive marker, so the index never gets in the way of extraction
+INDEX_TRAILER = Struct(">Q8s")
+INDEX_MAGIC = b"LBINDEX1"
+
+# extraction filter of tarfile (Python 3.12, backported to security releases), _check_member is applied regardless
+DATA_FILTER = getattr(tarfile, "data_filter", None)
+
+
+class ArchiveMember(NamedTuple):
+    '''
+    Class to describe an entry of an archive
+    '''
+    name: str # path relative to the packed folder, '/' separated
+    type: str # 'file', 'dir', 'symlink' or 'other'
+    size: int
+    mtime: float
+    mode: int
+
+
+# function to describe a tar entry
+def _member(tarinfo: tarfile.TarInfo) -> ArchiveMember:
+    if tarinfo.isfile():
+        kind = "file"
+    elif tarinfo.isdir():
+        kind = "dir"
+    elif tarinfo.issym():
+        kind = "symlink"
+    else:
+        kind = "other"
+    return ArchiveMember(tarinfo.name, kind, tarinfo.size, tarinfo.mtime, tarinfo.mode)
+
+
+class _CountingWriter:
+    '''
+    Class to count the bytes written to a stream, i.e. the position of the next byte in a non-seekable stream
+    '''
+
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.count = 0
+
+    def write(self, data) -> int:
+        self.stream.write(data)
+        self.count += len(data)
+        return len(data)
+
+
+# function to check an archive entry before extracting it
+def _check_member(tarinfo: tarfile.TarInfo, folder: str) -> None:
+    '''
+    Function to reject entries that would be written outside of the extraction folder,
+    in addition to the 'data' extraction filter where tarfile provides one
+
+    :param tarinfo: entry to be extracted
+    :param folder: extraction folder
+    '''
+    root = ospath.realpath(folder)
+    target = ospath.realpath(ospath.join(root, tarinfo.name))
+    if ospath.isabs(tarinfo.name) or ospath.commonpath([root, target]) != root:
+        raise ValueError("Archive member outside of the extraction folder: {0}".format(tarinfo.name))
+    if tarinfo.issym() or tarinfo.islnk():
+        base = ospath.dirname(target) if tarinfo.issym() else root
+        link = ospath.realpath(ospath.join(base, tarinfo.linkname))
+        if ospath.isabs(tarinfo.linkname) or ospath.commonpath([root, link]) != root:
+            raise ValueError("Archive link pointing outside of the extraction folder: {0}".format(tarinfo.name))
+    if not (tarinfo.isfile() or tarinfo.isdir() or tarinfo.issym() or tarinfo.islnk()):
+        raise ValueError("Unsupported archive member: {0}".format(tarinfo.name))
+
+
+# function to stream a folder into a pipe as a tar archive
+def _write_tar(folder: str, write_fd: int, index: bool, skip: set, cancel_event: Event) -> None:
+    '''
+    Function to write the contents of a folder to a pipe as a tar stream, followed by the member index
+
+    :param folder: path to the folder
+    :param write_fd: write end of the pipe, closed once done
+    :param index: append the member index
+    :param skip: absolute paths left out, e.g. the archive being written
+    :param cancel_event: (optional) event to signal cancellation of operation
+    '''
+    with open(write_fd, "wb") as stream:
+        counter = _CountingWriter(stream)
+        compressor = zlib.compressobj()
+        entries = [] # compressed index, a few bytes per member
+
+        def add_member(tarinfo):
+            if cancel_event is not None and cancel_event.is_set():
+                raise OperationCancelled()
+            entries.append(compressor.compress(json.dumps(_member(tarinfo)._asdict()).encode("utf-8") + b"\n"))
+            return tarinfo
+
+        with tarfile.open(fileobj=counter, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            with scandir(folder) as found:
+                names = sorted(entry.name for entry in found)
+            for name in names:
+                _add_tree(tar, ospath.join(folder, name), name, skip, add_member)
+        if index:
+            offset = counter.count
+            entries.append(compressor.flush())
+            for data in entries:
+                stream.write(data)
+            stream.write(INDEX_TRAILER.pack(offset, INDEX_MAGIC))
+
+
+# function to add a folder tree to a tar stream
+def _add_tree(tar: tarfile.TarFile, file_path: str, arcname: str, skip: set, member_filter) -> None:
+    '''
+    Function to add a file or folder tree to a tar stream in name order, leaving out
+    temporary files of unfinished writes and the paths in skip
+
+    :param tar: tar stream opened for writing
+    :param file_path: path to the file or folder
+    :param arcname: name of the entry in the archive
+    :param skip: absolute paths left out
+    :param member_filter: callback(tarinfo) returning the entry to add, called before its data is written
+    '''
+    if is_temp_file(ospath.basename(file_path)) or ospath.abspath(file_path) in skip:
+        return
+    tar.add(file_path, arcname, recursive=False, filter=member_filter)
+    if ospath.isdir(file_path) and not ospath.islink(file_path):
+        with scandir(file_path) as found:
+            names = sorted(entry.name for entry in found)
+        for name in names:
+            _add_tree(tar, ospath.join(file_path, name), arcname + "/" + name, skip, member_filter)
+
+
+# function to encrypt a folder into a single archive
+def pack(folder: str, passphrase: str, output: str = None, index: bool = True, session: LockByteSession = None,
+         progress=None, cancel_event: Event = None, compression: str = None) -> str:
+    '''
+    Function to encrypt a folder tree into a single .lockbyte archive. The folder is streamed as a tar archive
+    straight into the cipher, so the key is derived once, the output is written sequentially and
+    nothing but the archive is written to disk
+
+    :param folder: path to the folder
+    :param passphrase: user password
+    :param output: (optional) path to the archive, defaults to the folder name with a .lockbyte extension
+    :param index: append a member index, so that list_archive does not have to decrypt the whole archive
+    :param session: (optional) LockByteSession shared with other files
+    :param progress: (optional) callback(size) receiving the number of bytes processed
+    :param cancel_event: (optional) threading.Event checked between chunks, OperationCancelled is raised once set
+    :param compression: (optional) codec compressing the tar stream, see lockbyte.compress, listing then
+                        decrypts the whole archive
+
+    Returns archive path
+    '''
+    if not ospath.isdir(folder):
+        raise NotADirectoryError("Not a folder: {0}".format(folder))
+    user = LockByteUser(passphrase, session=session, flags=FLAG_ARCHIVE, progress=progress,
+                        cancel_event=cancel_event, compression=compression)
+    user.validate_and_generate(1)
+    if output is None:
+        output = user.get_unique_name(folder.rstrip(sep + (altsep or "")) + ".lockbyte")
+    read_fd, write_fd = pipe()
+    with open(read_fd, "rb") as src:
+        thread, errors = run_in_thread(_write_tar, folder, write_fd, index, {ospath.abspath(output)}, cancel_event)
+        try:
+            with atomic_write(output) as dst:
+                user.encrypt_stream(src, dst)
+                thread.join()
+                if errors: # the stream ended early, do not keep a partial archive
+                    raise errors[0]
+        finally:
+            src.close() # unblocks the writer if encryption failed
+            thread.join()
+    return output
+
+
+# function to decrypt an archive into a pipe
+def _decrypt_payload(user: LockByteUser, file, write_fd: int) -> None:
+    with open(write_fd, "wb") as dst:
+        user._decrypt_chunks(file, dst)
+
+
+# function to read the tar stream of an archive while it is decrypted
+def _read_tar(user: LockByteUser, file, consume):
+    '''
+    Function to decrypt an archive on a thread and hand its tar stream to consume as it is decrypted
+
+    :param user: LockByteUser set up from the archive header
+    :param file: archive positioned after the header
+    :param consume: callback(tar) reading the tar stream
+
+    Returns the result of consume, once the whole archive has been authenticated
+    '''
+    read_fd, write_fd = pipe()
+    thread, errors = run_in_thread(_decrypt_payload, user, file, write_fd)
+    with open(read_fd, "rb") as src:
+        try:
+            with tarfile.open(fileobj=src, mode="r|") as tar:
+                result = consume(tar)
+            while src.read(2**16): # member index
+                pass
+        except Exception as e:
+            src.close() # unblocks the decryption thread
+            thread.join()
+            # e.g. a tampered chunk is more telling than the truncated tar stream it caused,
+            # but a rejected member or a failed write is the cause of the broken pipe the thread saw
+            raise pipeline_error(errors, e)
+    thread.join()
+    if errors:
+        raise errors[0]
+    return result
+
+
+# function to read the flags of an archive header
+def _header_flags(file_path: str) -> int:
+    '''
+    Function to read the header flags of a version 3 or 4 file without deriving any key
+
+    :param file_path: path to the encrypted file
+
+    Returns flags or None for other files
+    '''
+    try:
+        with open(file_path, "rb") as file:
+            header = read_exact(file, len(FORMAT_MAGIC) + 2) # magic, version and flags
+    except OSError:
+        return None
+    if len(header) != len(FORMAT_MAGIC) + 2 or not header.startswith(FORMAT_MAGIC):
+        return None
+    version, flags = header[len(FORMAT_MAGIC):]
+    return flags if version in (3, 4) else None
+
+
+# function to extract a tar stream
+def _extract(tar: tarfile.TarFile, folder: str) -> None:
+    '''
+    Function to extract the members of a tar stream one by one as they are decrypted. Folders are created
+    writable and get their own permissions and times once everything inside them is extracted
+
+    :param tar: tar stream opened for reading
+    :param folder: extraction folder
+    '''
+    folders = []
+    for tarinfo in tar:
+        _check_member(tarinfo, folder)
+        if DATA_FILTER is not None:
+            tarinfo = DATA_FILTER(tarinfo, folder)
+        if tarinfo.isdir():
+            folders.append(tarinfo)
+            tarinfo = copy(tarinfo)
+            tarinfo.mode = 0o700
+        if DATA_FILTER is not None:
+            tar.extract(tarinfo, folder, filter="fully_trusted") # already filtered above
+        else:
+            tar.extract(tarinfo, folder)
+    for tarinfo in reversed(folders):
+        folder_path = ospath.join(folder, tarinfo.name)
+        if tarinfo.mode is not None:
+            chmod(folder_path, tarinfo.mode)
+        if tarinfo.mtime is not None:
+            utime(folder_path, (tarinfo.mtime, tarinfo.mtime))
+
+
+# function to check whether a file is an archive
+def is_archive(file_path: str) -> bool:
+    '''
+    Function to check whether an encrypted file is an archive written by pack, from its header only
+
+    :param file_path: path to the encrypted file
+    '''
+    flags = _header_flags(file_path)
+    return flags is not None and bool(flags & FLAG_ARCHIVE)
+
+
+# function to extract an archive
+def unpack(file_path: str, passphrase: str, output: str = None, session: LockByteSession = None,
+           progress=None, cancel_event: Event = None, workers: int = None) -> str:
+    '''
+    Function to decrypt and extract an archive written by pack. Members are extracted while the archive
+    is being decrypted, into a temporary folder renamed into place once the whole archive is authenticated
+
+    :param file_path: path to the archive
+    :param passphrase: user password
+    :param output: (optional) path to the folder to create, defaults to the archive name with a _decrypted suffix
+    :param session: (optional) LockByteSession shared with other files
+    :param progress: (optional) callback(size) receiving the number of bytes processed
+    :param cancel_event: (optional) threading.Event checked between chunks, OperationCancelled is raised once set
+    :param workers: (optional) number of chunks decrypted in parallel, defaults to one per core
+
+    Returns path to the extracted folder
+    '''
+    user = LockByteUser(passphrase, session=session, progress=progress, cancel_event=cancel_event, workers=workers)
+    with open(file_path, "rb") as file:
+        header = user._read_header(file)
+        if not user.flags & FLAG_ARCHIVE:
+            raise ValueError("Not a LockByte archive: {0}".format(file_path))
+        user.validate_and_generate(0, **header)
+        if output is None:
+            root = file_path[:-len(".lockbyte")] if file_path.endswith(".lockbyte") else file_path
+            output = user.get_unique_name(root + "_decrypted")
+        elif ospath.exists(output):
+            raise FileExistsError(EEXIST, "Output folder already exists", output)
+        parent, name = ospath.split(ospath.abspath(output))
+        temp_folder = mkdtemp(prefix="." + name + ".", suffix=TEMP_SUFFIX, dir=parent)
+        try:
+            _read_tar(user, file, lambda tar: _extract(tar, temp_folder))
+            replace(temp_folder, output)
+        except BaseException:
+            rmtree(temp_folder, ignore_errors=True)
+            raise
+    fsync_dir(parent)
+    return output
+
+
+# function to list the contents of an archive
+def list_archive(file_path: str, passphrase: str, session: LockByteSession = None) -> list:
+    '''
+    Function to list the members of an archive. With a member index only the chunks holding
+    the index are decrypted, otherwise (or if the archive is compressed) the whole archive
+    is decrypted without writing anything
+
+    :param file_path: path to the archive
+    :param passphrase: user password
+    :param session: (optional) LockByteSession shared with other files
+
+    Returns list of ArchiveMember tuples in archive order
+    '''
+    flags = _header_flags(file_path)
+    if flags is None or not flags & FLAG_ARCHIVE:
+        raise ValueError("Not a LockByte archive: {0}".format(file_path))
+    if not flags & FLAG_CODEC_MASK: # compressed archives cannot be read at random positions
+        with open_encrypted(file_path, passphrase, session) as reader: # closes the file if the password is wrong
+            if reader.size >= INDEX_TRAILER.size:
+                offset, magic = INDEX_TRAILER.unpack(reader.read_at(reader.size - INDEX_TRAILER.size,
+                                                                    INDEX_TRAILER.size))
+                if magic == INDEX_MAGIC and offset <= reader.size - INDEX_TRAILER.size:
+                    data = zlib.decompress(reader.read_at(offset, reader.size - INDEX_TRAILER.size - offset))
+                    return [ArchiveMember(**json.loads(line)) for line in data.splitlines()]
+            reader.seek(0)
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                return [_member(tarinfo) for tarinfo in tar]
+    user = LockByteUser(passphrase, session=session)
+    with open(file_path, "rb") as file:
+        user.validate_and_generate(0, **user._read_header(file))
+        return _read_tar(user, file, lambda tar: [_member(tarinfo) for tarinfo in tar])
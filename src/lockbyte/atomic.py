@@ -0,0 +1,304 @@
+# ====================================================================
+# This file is part of LockByte.
+# LockByte is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3 of the License.
+# LockByte is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with LockByte. If not, see <https://www.gnu.org/licenses/>.
+# ====================================================================
+
+from os import fsync, replace, link, scandir, listdir, open as osopen, close as osclose, remove as osremove
+from os import chmod, stat, umask, path as ospath, O_RDONLY
+from errno import EEXIST
+from tempfile import mkstemp
+from threading import Lock
+
+
+TEMP_SUFFIX = ".lockbyte-part" # suffix of the temporary files written by atomic_write
+
+# the umask can only be read by setting it, so it is read once before any worker threads exist
+_UMASK = umask(0o022)
+umask(_UMASK)
+
+
+# function to recognise temporary files
+def is_temp_file(name: str) -> bool:
+    '''
+    Function to check whether a file name is a temporary file of atomic_write, e.g. left behind by a crash
+
+    :param name: file name
+    '''
+    return name.startswith(".") and name.endswith(TEMP_SUFFIX)
+
+
+# function to clean up after a crash
+def remove_temp_files(folder: str) -> int:
+    '''
+    Function to delete the temporary files of atomic_write left in a folder, only safe once no batch writes to it
+
+    :param folder: path to the folder
+
+    Returns number of files deleted
+    '''
+    count = 0
+    try:
+        with scandir(folder) as entries:
+            stale = [entry.path for entry in entries if is_temp_file(entry.name) and entry.is_file(follow_symlinks=False)]
+    except OSError:
+        return 0
+    for file_path in stale:
+        try:
+            osremove(file_path)
+            count += 1
+        except OSError:
+            pass
+    return count
+
+
+# function to flush a directory entry to disk
+def fsync_dir(folder: str) -> None:
+    '''
+    Function to make renames and deletions inside a folder durable, a no-op where folders cannot be opened (Windows)
+
+    :param folder: path to the folder
+    '''
+    try:
+        fd = osopen(folder or ".", O_RDONLY)
+    except OSError:
+        return
+    try:
+        fsync(fd)
+    except OSError: # some file systems do not support syncing folders
+        pass
+    finally:
+        osclose(fd)
+
+
+class DirectorySync:
+    '''
+    Class to group the folder syncs of a batch, each folder is synced once per flush however many files were renamed
+    into it, and source files are only deleted once the renames replacing them are durable
+    '''
+
+    def __init__(self, durable: bool = True) -> None:
+        '''
+        Constructor for DirectorySync class
+
+        :param durable: sync folders to disk, False only orders deletions after renames
+        '''
+        self.durable = durable
+        self._lock = Lock()
+        self._folders = set()
+        self._removals = []
+
+    def add(self, file_path: str) -> None:
+        '''
+        Function to register a file renamed into place, its folder is synced on the next flush
+
+        :param file_path: path the file was renamed to
+        '''
+        with self._lock:
+            self._folders.add(ospath.dirname(ospath.abspath(file_path)))
+
+    def remove_after_sync(self, file_path: str) -> None:
+        '''
+        Function to delete a file once the pending renames are durable
+
+        :param file_path: path to file to be deleted, e.g. the source of an encrypted file
+        '''
+        with self._lock:
+            self._removals.append(file_path)
+
+    def flush(self) -> None:
+        '''
+        Function to sync every pending folder, then delete the files waiting for it
+        '''
+        with self._lock:
+            folders, self._folders = self._folders, set()
+            removals, self._removals = self._removals, []
+        if self.durable:
+            for folder in folders:
+                fsync_dir(folder)
+        for file_path in removals:
+            if ospath.isfile(file_path):
+                osremove(file_path)
+
+
+class NameAllocator:
+    '''
+    Class to pick unique output names for a batch. Every folder is listed once and names are then reserved
+    in memory, so many workers writing to the same folder never pick the same name. Nothing is created until
+    the output is complete, atomic_write(names=...) then moves on to the next free name instead of replacing
+    a file another process created under the reserved one meanwhile
+    '''
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._taken = {} # folder -> names existing or allocated in it
+        self._next = {} # (folder, root, extension) -> next numbered suffix to try
+        self._preferred = {} # numbered path handed out -> preferred path it was claimed for
+
+    def claim(self, file_path: str) -> str:
+        '''
+        Function to allocate the first free name among file_path, root(1).ext, root(2).ext, ...
+
+        :param file_path: preferred path of the output file
+
+        Returns reserved path, release it if the output is never written
+        '''
+        parent, name = ospath.split(file_path)
+        folder = ospath.abspath(parent)
+        root, ext = ospath.splitext(name)
+        with self._lock:
+            taken = self._taken.get(folder)
+            if taken is None:
+                try:
+                    taken = self._taken[folder] = set(listdir(folder))
+                except OSError: # e.g. missing folder, reported when the output is written
+                    taken = set()
+            index = self._next.get((folder, root, ext), 0)
+            candidate = name if index == 0 else "%s(%i)%s" % (root, index, ext)
+            while candidate in taken:
+                index += 1
+                candidate = "%s(%i)%s" % (root, index, ext)
+            self._next[(folder, root, ext)] = index + 1
+            taken.add(candidate)
+            if index:
+                self._preferred[ospath.join(parent, candidate)] = file_path
+        return ospath.join(parent, candidate)
+
+    def claim_next(self, file_path: str) -> str:
+        '''
+        Function to reserve another name for an output whose reserved name was created by another process
+        meanwhile, e.g. a worker process of the same batch with its own NameAllocator
+
+        :param file_path: path returned by claim, it stays taken
+
+        Returns reserved path, release it if the output is never written
+        '''
+        with self._lock:
+            preferred = self._preferred.pop(file_path, file_path)
+        return self.claim(preferred)
+
+    def release(self, file_path: str) -> None:
+        '''
+        Function to give up a reserved name whose output was never written, e.g. after an error
+
+        :param file_path: path returned by claim
+        '''
+        parent, name = ospath.split(file_path)
+        with self._lock:
+            self._taken.get(ospath.abspath(parent), set()).discard(name)
+            self._preferred.pop(file_path, None)
+
+
+# function to move a complete file to a new name
+def _link_into_place(temp_path: str, file_path: str) -> None:
+    '''
+    Function to rename a file without ever replacing an existing one, raises FileExistsError instead
+
+    :param temp_path: path to the complete temporary file
+    :param file_path: final path of the file
+    '''
+    try:
+        link(temp_path, file_path) # fails if file_path exists, unlike a rename
+    except FileExistsError:
+        raise
+    except OSError: # no hard links on this file system, only the NameAllocator reservation guards the name
+        if ospath.lexists(file_path):
+            raise FileExistsError(EEXIST, "File exists", file_path)
+        replace(temp_path, file_path)
+        return
+    osremove(temp_path)
+
+
+class AtomicWriter:
+    '''
+    Class implementing atomic_write, file_path holds the path the file was finally written to
+    '''
+
+    def __init__(self, file_path: str, syncer: DirectorySync = None, durable: bool = True,
+                 exclusive: bool = False, names: NameAllocator = None) -> None:
+        self.file_path = file_path
+        self.syncer = syncer
+        self.durable = durable
+        self.exclusive = exclusive or names is not None
+        self.names = names
+        self._file = self._temp_path = None
+
+    def __enter__(self):
+        folder, name = ospath.split(ospath.abspath(self.file_path))
+        fd, self._temp_path = mkstemp(prefix="." + name + ".", suffix=TEMP_SUFFIX, dir=folder)
+        try:
+            mode = 0o666 & ~_UMASK # mkstemp creates the temporary file readable by its owner only
+            if not self.exclusive:
+                try:
+                    mode = stat(self.file_path).st_mode & 0o7777
+                except OSError: # nothing to replace
+                    pass
+            chmod(self._temp_path, mode)
+            self._file = open(fd, "wb")
+        except BaseException:
+            osclose(fd)
+            osremove(self._temp_path)
+            raise
+        return self._file
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        try:
+            with self._file as f:
+                if exc_type is None:
+                    f.flush()
+                    if self.durable:
+                        fsync(f.fileno())
+            if exc_type is None:
+                self._place()
+        except BaseException:
+            self._discard()
+            raise
+        if exc_type is not None:
+            self._discard()
+            return False
+        if self.syncer is not None:
+            self.syncer.add(self.file_path)
+        elif self.durable:
+            fsync_dir(ospath.dirname(ospath.abspath(self.file_path)))
+        return False
+
+    def _place(self) -> None:
+        if not self.exclusive:
+            replace(self._temp_path, self.file_path)
+            return
+        while True:
+            try:
+                _link_into_place(self._temp_path, self.file_path)
+                return
+            except FileExistsError:
+                if self.names is None:
+                    raise
+                # created by another process after the name was reserved, the complete file takes the next one
+                self.file_path = self.names.claim_next(self.file_path)
+
+    def _discard(self) -> None:
+        if ospath.exists(self._temp_path):
+            osremove(self._temp_path)
+
+
+# function to write a file atomically
+def atomic_write(file_path: str, syncer: DirectorySync = None, durable: bool = True, exclusive: bool = False,
+                 names: NameAllocator = None) -> AtomicWriter:
+    '''
+    Context manager writing to a temporary file in the target folder, renamed over file_path only once complete.
+    A crash or an error never leaves a truncated file_path behind, the temporary file is removed on errors.
+    The file gets the permissions of a file created by open() (or keeps those of the file it replaces),
+    not the owner-only ones of the temporary file
+
+    :param file_path: final path of the file
+    :param syncer: (optional) DirectorySync grouping folder syncs, otherwise the folder is synced right away
+    :param durable: fsync the file before renaming it, this one is not grouped by the syncer since the
+                    rename must not reach the disk before the data does
+    :param exclusive: raise FileExistsError instead of replacing an existing file_path
+    :param names: (optional) NameAllocator file_path was reserved with, implies exclusive: if another process
+                  created file_path meanwhile the next free name is used, see the file_path attribute
+
+    Returns AtomicWriter, entering it yields a writable binary file object
+    '''
+    return AtomicWriter(file_path, syncer, durable, exclusive, names)
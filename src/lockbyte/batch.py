@@ -0,0 +1,754 @@
+# ====================================================================
+# This file is part of LockByte.
+# LockByte is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3 of the License.
+# LockByte is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with LockByte. If not, see <https://www.gnu.org/licenses/>.
+# ====================================================================
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Event, Thread, Lock
+from queue import SimpleQueue, Queue, Empty, Full
+from os import scandir, path as ospath, remove as osremove, devnull, urandom
+from fnmatch import fnmatch
+from itertools import islice
+from collections import deque
+from time import monotonic
+from typing import NamedTuple
+import multiprocessing
+from argon2 import exceptions as argon2exceptions
+
+from lockbyte.lock_unlock import LockByteUser, LockByteSession, OperationCancelled
+from lockbyte.atomic import DirectorySync, NameAllocator, is_temp_file, remove_temp_files
+from lockbyte.journal import BatchJournal
+from lockbyte.manifest import Manifest, file_digest
+from lockbyte.archive import is_archive, unpack
+from lockbyte.scheduler import aes_workers, kdf_scheduler
+
+
+BACKENDS = ("thread", "process")
+
+
+# function to list the files of a folder tree lazily
+def walk_files(top: str, include: str = None, exclude: str = None):
+    '''
+    Generator listing the files of a folder and its sub folders one directory at a time,
+    so that processing can start on the first file while the rest of the tree is still being scanned
+
+    :param top: path to the folder
+    :param include: (optional) fnmatch pattern file names have to match
+    :param exclude: (optional) fnmatch pattern of file names to skip
+
+    Yields file paths, unreadable folders and temporary files of unfinished writes are skipped
+    '''
+    folders = [top]
+    while folders:
+        try:
+            with scandir(folders.pop()) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subfolders = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            if is_temp_file(entry.name):
+                continue
+            if include is not None and not fnmatch(entry.name, include):
+                continue
+            if exclude is not None and fnmatch(entry.name, exclude):
+                continue
+            yield entry.path
+        folders.extend(reversed(subfolders)) # visit sub folders in name order
+
+
+# function to encrypt a single file
+def encrypt_file(file_path: str, passphrase: str, session: LockByteSession = None,
+                 keep_files: bool = True, cancel_event: Event = None, progress=None,
+                 syncer: DirectorySync = None, replace: str = None, compression: str = None,
+                 names: NameAllocator = None, workers: int = None) -> str:
+    '''
+    Function to encrypt a single file
+
+    :param file_path: path to file to be encrypted
+    :param passphrase: user password
+    :param session: (optional) LockByteSession shared by all files of a batch
+    :param keep_files: keep the source file once it has been encrypted
+    :param cancel_event: (optional) event to signal cancellation of operation
+    :param progress: (optional) callback(size) receiving the number of bytes processed
+    :param syncer: (optional) DirectorySync grouping the folder syncs of a batch
+    :param replace: (optional) path of the .lockbyte file an earlier run wrote for this file, replaced in place
+    :param compression: (optional) codec compressing the file before encryption, see lockbyte.compress
+    :param names: (optional) NameAllocator picking the output names of a batch
+    :param workers: (optional) number of chunks encrypted in parallel, defaults to one per core
+
+    Returns encrypted file path or None if the operation was cancelled
+    '''
+    user = LockByteUser(passphrase, session=session, progress=progress, cancel_event=cancel_event, syncer=syncer,
+                        replace=replace, compression=compression, names=names, workers=workers)
+    with open(file_path, "rb") as file:
+        if not user.validate_and_generate(1):
+            return None
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        try:
+            file_path_new = user.encrypt(file=file, file_path=file_path)
+        except OperationCancelled: # stopped between two chunks, the partial output is already removed
+            return None
+    if not keep_files:
+        if syncer is not None: # only delete the source once the encrypted file is durable
+            syncer.remove_after_sync(file_path)
+        elif ospath.isfile(file_path):
+            osremove(file_path)
+    return file_path_new
+
+
+# function to decrypt a single file
+def decrypt_file(file_path: str, passphrase: str, session: LockByteSession = None,
+                 keep_files: bool = True, cancel_event: Event = None, progress=None,
+                 syncer: DirectorySync = None, names: NameAllocator = None, workers: int = None) -> str:
+    '''
+    Function to decrypt a single file, decryption stops at the next chunk and the decrypted file is rolled back
+    if the operation is cancelled meanwhile. Archives written by lockbyte.archive.pack are extracted into a folder
+
+    :param file_path: path to file to be decrypted
+    :param passphrase: user password
+    :param session: (optional) LockByteSession shared by all files of a batch
+    :param keep_files: unused, encrypted files are always kept
+    :param cancel_event: (optional) event to signal cancellation of operation
+    :param progress: (optional) callback(size) receiving the number of bytes processed
+    :param syncer: (optional) DirectorySync grouping the folder syncs of a batch
+    :param names: (optional) NameAllocator picking the output names of a batch
+    :param workers: (optional) number of chunks decrypted in parallel, defaults to one per core
+
+    Returns decrypted file path or None if the operation was cancelled
+    '''
+    if is_archive(file_path):
+        try:
+            return unpack(file_path, passphrase, session=session, progress=progress, cancel_event=cancel_event,
+                          workers=workers)
+        except OperationCancelled: # the partially extracted folder is already removed
+            return None
+    user = LockByteUser(passphrase, session=session, progress=progress, cancel_event=cancel_event, syncer=syncer,
+                        names=names, workers=workers)
+    with open(file_path, "rb") as file:
+        try:
+            file_path_new = user.decrypt(file=file, file_path=file_path)
+        except OperationCancelled: # stopped between two chunks, the partial output is already removed
+            return None
+    if cancel_event is not None and cancel_event.is_set():
+        if ospath.isfile(file_path_new):
+            osremove(file_path_new)
+        return None
+    return file_path_new
+
+
+# function to check the integrity of a single file
+def verify_file(file_path: str, passphrase: str, session: LockByteSession = None,
+                keep_files: bool = True, cancel_event: Event = None, progress=None,
+                syncer: DirectorySync = None, workers: int = None) -> str:
+    '''
+    Function to check the password and the integrity of an encrypted file by decrypting it without writing any output
+
+    :param file_path: path to file to be verified
+    :param passphrase: user password
+    :param session: (optional) LockByteSession shared by all files of a batch
+    :param keep_files: unused, files are never modified
+    :param cancel_event: (optional) event to signal cancellation of operation
+    :param progress: (optional) callback(size) receiving the number of bytes processed
+    :param syncer: (optional) DirectorySync grouping the folder syncs of a batch
+    :param workers: (optional) number of chunks decrypted in parallel, defaults to one per core
+
+    Returns verified file path or None if the operation was cancelled
+    '''
+    user = LockByteUser(passphrase, session=session, progress=progress, cancel_event=cancel_event, syncer=syncer,
+                        workers=workers)
+    with open(file_path, "rb") as file, open(devnull, "wb") as sink:
+        try:
+            user.decrypt(file=file, file_path=file_path, output=sink)
+        except OperationCancelled:
+            return None
+    return file_path
+
+
+# function to check the password of a single file
+def check_file(file_path: str, passphrase: str, session: LockByteSession = None,
+               keep_files: bool = True, cancel_event: Event = None, progress=None,
+               syncer: DirectorySync = None) -> str:
+    '''
+    Function to check the password of an encrypted file by reading its header only, the contents are not verified
+
+    :param file_path: path to file to be checked
+    :param passphrase: user password
+    :param session: (optional) LockByteSession shared by all files of a batch
+    :param keep_files: unused, files are never modified
+    :param cancel_event: (optional) event to signal cancellation of operation
+    :param progress: (optional) callback(size) receiving the number of bytes processed
+    :param syncer: (optional) DirectorySync grouping the folder syncs of a batch
+
+    Returns checked file path
+    '''
+    user = LockByteUser(passphrase, session=session, progress=progress)
+    with open(file_path, "rb") as file:
+        user.verify_password(file)
+    return file_path
+
+
+ACTIONS = {"encrypt": encrypt_file,
+           "decrypt": decrypt_file,
+           "verify": verify_file,
+           "check": check_file}
+
+
+class BatchProgress(NamedTuple):
+    '''
+    Class to hold a snapshot of the progress of a batch
+    '''
+    files_done: int
+    files_failed: int
+    files_total: int # files found so far, grows while folders are being scanned
+    bytes_done: int
+    bytes_total: int
+    rate: float # bytes per second over the last few seconds
+    eta: float # seconds left at the current rate, None while unknown
+    scanning: bool # True until every file to be processed has been found
+    files_skipped: int = 0 # files done by an earlier run (journal) or unchanged (manifest), not in files_total
+
+    @property
+    def fraction(self) -> float:
+        return self.bytes_done / self.bytes_total if self.bytes_total else (1.0 if not self.scanning else 0.0)
+
+
+# function to format the time left of a batch
+def format_eta(seconds: float) -> str:
+    '''
+    Function to format a number of seconds as h:mm:ss
+
+    :param seconds: time left, None if unknown
+    '''
+    if seconds is None:
+        return "--:--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    return "{0}:{1:02d}:{2:02d}".format(minutes // 60, minutes % 60, seconds)
+
+
+class _ByteCounter:
+    '''
+    Class to turn the byte counts of a file into 'progress' events, batched to limit queue traffic
+    '''
+    threshold = 2**20
+
+    def __init__(self, events, file_path: str) -> None:
+        self.events = events
+        self.file_path = file_path
+        self.pending = 0
+
+    def __call__(self, size: int) -> None:
+        self.pending += size
+        if self.pending >= self.threshold:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            self.events.put(("progress", self.file_path, self.pending))
+            self.pending = 0
+
+
+class _WorkerState:
+    '''
+    Class to hold everything a worker needs to process its share of a batch
+    '''
+
+    def __init__(self, mode: str, passphrase: str, keep_files: bool, cancel_event, events,
+                 session: LockByteSession, manifest: Manifest = None, compression: str = None,
+                 workers: int = None) -> None:
+        self.action = ACTIONS[mode]
+        # sources are hashed for the manifest and replace the output it recorded for them, if still intact
+        self.manifest = manifest
+        self.incremental = manifest is not None
+        self.options = {}
+        if compression is not None:
+            self.options["compression"] = compression
+        if mode in ("encrypt", "decrypt"): # one listing per folder, shared by every worker
+            self.options["names"] = NameAllocator()
+        if workers is not None:
+            self.options["workers"] = workers
+        self.passphrase = passphrase
+        self.keep_files = keep_files
+        self.cancel_event = cancel_event
+        self.events = events
+        self.session = session
+        self.syncer = DirectorySync() # folder syncs and source deletions are grouped per task
+
+
+# worker process state, set up once per process by _init_worker
+_worker_state = None
+
+
+def _init_worker(mode, passphrase, keep_files, cancel_event, events, shared_key, kdf_semaphore, manifest,
+                 compression, workers) -> None:
+    global _worker_state
+    session = LockByteSession(passphrase) # per-process key cache, reused by every task of this worker
+    if shared_key is not None:
+        session.load_master_key(*shared_key)
+    if manifest is not None: # read only, the outputs recorded by earlier runs are all a worker needs
+        manifest = Manifest(manifest)
+    _worker_state = _WorkerState(mode, passphrase, keep_files, cancel_event, events, session, manifest, compression,
+                                 workers)
+    kdf_scheduler.attach(kdf_semaphore) # scrypt memory is budgeted across all processes
+
+
+def _run_worker_batch(file_paths: list) -> list:
+    return _run_batch(_worker_state, file_paths)
+
+
+def _run_batch(state: _WorkerState, file_paths: list) -> list:
+    '''
+    Function to process a batch of files on a worker
+
+    :param state: worker state
+    :param file_paths: paths of the files in this batch
+
+    Returns list of (file path, new file path, exception, content hash) tuples, the hash is None unless incremental
+    '''
+    results = []
+    try:
+        for file_path in file_paths:
+            if state.cancel_event.is_set():
+                break
+            state.events.put(("start", file_path, None))
+            progress = _ByteCounter(state.events, file_path)
+            try:
+                # hashed right before encryption, the contents are read from the cache a second time
+                digest = file_digest(file_path) if state.incremental else None
+                options = state.options
+                if state.incremental:
+                    options = dict(options, replace=state.manifest.previous_output(file_path))
+                results.append((file_path, state.action(file_path, state.passphrase, state.session, state.keep_files,
+                                                        state.cancel_event, progress, state.syncer, **options),
+                                None, digest))
+            except Exception as e:
+                results.append((file_path, None, e, None))
+            progress.flush()
+    finally:
+        state.syncer.flush() # results are only reported once their renames are durable
+    return results
+
+
+class BatchRunner:
+    '''
+    Class to encrypt / decrypt many files on a pool of threads or processes sharing one password derivation
+    '''
+
+    window_size = 1024 # maximum number of files ordered by size at a time
+
+    pack_size = 2**23 # small files are packed into tasks of up to this many bytes
+
+    progress_interval = 0.25 # minimum number of seconds between 'progress' events
+
+    rate_window = 5.0 # number of seconds the transfer rate is averaged over
+
+    def __init__(self, mode: str, passphrase: str, backend: str = "thread", jobs: int = None,
+                 chunksize: int = None, keep_files: bool = True, cancel_event: Event = None, on_event=None,
+                 keep_results: bool = True, journal: str = None, manifest: str = None, prune: bool = False,
+                 compression: str = None) -> None:
+        '''
+        Constructor for BatchRunner class
+
+        :param mode: 'encrypt', 'decrypt', 'verify' (decrypt without output) or 'check' (password only)
+        :param passphrase: user password
+        :param backend: 'thread' or 'process'
+        :param jobs: (optional) number of workers, defaults to one per available core
+        :param chunksize: (optional) maximum number of files handed to a worker per task, defaults to 64
+        :param keep_files: keep source files once they have been encrypted
+        :param cancel_event: (optional) threading.Event object to signal cancellation of operation
+        :param on_event: (optional) callback(kind, file_path, value) receiving 'start', 'done', 'error',
+                         'pruned' (file_path is an output deleted by prune) and 'progress' events
+                         (value is a BatchProgress, file_path is None), called from the runner thread
+        :param keep_results: collect a (file path, new file path, exception) tuple per file in results,
+                             without them memory use does not depend on the number of files and
+                             only the counters of progress() are kept
+        :param journal: (optional) path to a lockbyte.journal.BatchJournal, files finished by an earlier run
+                        of the same journal are skipped and the journal is deleted once every file succeeded
+        :param manifest: (optional) path to a lockbyte.manifest.Manifest, encrypt mode only: sources unchanged since
+                         the last run on the same manifest are skipped and changed ones replace their previous output
+        :param prune: with a manifest, delete the outputs of sources that no longer exist once the batch is done
+        :param compression: (optional) encrypt mode only, codec compressing files before encryption
+                            ('zlib', 'lzma', 'zstd' or 'auto'), see lockbyte.compress
+        '''
+        if mode not in ACTIONS:
+            raise ValueError("Unknown mode: {0}".format(mode))
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend: {0}".format(backend))
+        if manifest is not None and (mode != "encrypt" or not keep_files):
+            raise ValueError("A manifest requires encrypt mode with source files kept")
+        if compression is not None and mode != "encrypt":
+            raise ValueError("Compression only applies to encrypt mode, decryption detects it from the header")
+        self.mode = mode
+        self.backend = backend
+        self.jobs = max(1, jobs or aes_workers())
+        self.chunksize = chunksize
+        self.keep_files = keep_files
+        self.cancel_event = cancel_event if cancel_event is not None else Event()
+        self.on_event = on_event
+        self.keep_results = keep_results
+        self.journal = journal
+        self.manifest = manifest
+        self.prune = prune
+        self.compression = compression
+        self.results = []
+        self._passphrase = passphrase
+        self._worker_cancel_event = self.cancel_event
+        self._pool = None
+        self._pending = {} # submitted futures -> their chunk of files
+        self._pending_lock = Lock()
+        self._journal = None
+        self._manifest = None
+        self._session = None
+        self._keys = {} # password hashes of earlier runs -> whether they match the batch password
+        self._thread = None
+        self._finished = Event()
+        self._progress_lock = Lock()
+        self._file_bytes = {} # size and bytes reported of every file found but not finished yet
+        self._files_total = self._files_done = self._files_failed = self._files_skipped = 0
+        self._bytes_total = self._bytes_done = 0
+        self._scanning = True
+        self._samples = deque() # (time, bytes done) pairs measuring the transfer rate
+        self._last_progress = None
+
+    # function to start processing in the background
+    def start(self, file_paths) -> None:
+        '''
+        Function to start processing files on a background thread
+
+        :param file_paths: paths of the files to be processed, any iterable (e.g. walk_files) is consumed lazily
+        '''
+        self._thread = Thread(target=self._dispatch, args=(file_paths,), daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout: float = None) -> bool:
+        '''
+        Function to wait for all files to be processed
+
+        :param timeout: (optional) maximum number of seconds to wait
+
+        Returns True once the batch has finished
+        '''
+        return self._finished.wait(timeout)
+
+    def done(self) -> bool:
+        return self._finished.is_set()
+
+    # function to process files and wait for the result
+    def run(self, file_paths) -> list:
+        '''
+        Function to process files, blocking until all of them are done
+
+        :param file_paths: paths of the files to be processed
+
+        Returns list of (file path, new file path, exception) tuples, empty unless keep_results is set
+        '''
+        self.start(file_paths)
+        self.wait()
+        return self.results
+
+    def progress(self) -> BatchProgress:
+        '''
+        Function to take a snapshot of the progress of the batch, safe to call from any thread
+        '''
+        now = monotonic()
+        with self._progress_lock:
+            samples = self._samples
+            samples.append((now, self._bytes_done))
+            while len(samples) > 2 and now - samples[1][0] >= self.rate_window:
+                samples.popleft()
+            elapsed = now - samples[0][0]
+            rate = (self._bytes_done - samples[0][1]) / elapsed if elapsed > 0 else 0.0
+            remaining = self._bytes_total - self._bytes_done
+            eta = remaining / rate if rate > 0 else (0.0 if remaining == 0 and not self._scanning else None)
+            return BatchProgress(self._files_done, self._files_failed, self._files_total, self._bytes_done, self._bytes_total,
+                                 rate, eta, self._scanning, self._files_skipped)
+
+    def cancel(self) -> None:
+        '''
+        Function to cancel pending files, files being processed are stopped at the next checkpoint
+        '''
+        self.cancel_event.set()
+        if self._worker_cancel_event is not self.cancel_event:
+            self._worker_cancel_event.set()
+        if self._pool is not None:
+            self._cancel_pending()
+
+    def _cancel_pending(self) -> None:
+        '''
+        Function to cancel the tasks not started yet and release the pool without waiting for running ones,
+        as Executor.shutdown(cancel_futures=True) which needs Python 3.9
+        '''
+        with self._pending_lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.cancel()
+        self._pool.shutdown(wait=False)
+
+    def _emit(self, kind: str, file_path: str, value) -> None:
+        if self.on_event is not None:
+            self.on_event(kind, file_path, value)
+
+    def _record(self, file_path: str, file_path_new: str, error: Exception, digest: str = None) -> None:
+        with self._progress_lock:
+            size, reported = self._file_bytes.pop(file_path, (0, 0))
+            self._bytes_done += size - reported
+            if file_path is not None:
+                self._files_done += 1
+            if error is not None:
+                self._files_failed += 1
+        if self.keep_results:
+            self.results.append((file_path, file_path_new, error))
+        if self._journal is not None and file_path is not None:
+            if error is not None:
+                self._journal.failed(file_path)
+            elif file_path_new is not None: # cancelled files stay in flight and are processed again
+                self._journal.done(file_path, file_path_new)
+        if self._manifest is not None and error is None and file_path_new is not None:
+            self._manifest.record(file_path, file_path_new, digest, self._session.master_key()[0])
+        if error is None:
+            self._emit("done", file_path, file_path_new)
+        else:
+            self._emit("error", file_path, error)
+
+    def _drain(self, events) -> None:
+        while True:
+            try:
+                kind, file_path, value = events.get_nowait()
+            except Empty:
+                break
+            if kind != "progress":
+                if kind == "start" and self._journal is not None:
+                    self._journal.start(file_path)
+                self._emit(kind, file_path, value)
+                continue
+            with self._progress_lock:
+                entry = self._file_bytes.get(file_path)
+                if entry is not None:
+                    size = min(value, entry[0] - entry[1]) # files may grow while being processed
+                    entry[1] += size
+                    self._bytes_done += size
+        self._report_progress()
+
+    def _report_progress(self, force: bool = False) -> None:
+        now = monotonic()
+        if force or self._last_progress is None or now - self._last_progress >= self.progress_interval:
+            self._last_progress = now
+            self._emit("progress", None, self.progress())
+
+    def _create_pool(self, session: LockByteSession):
+        if self.backend == "thread":
+            events = SimpleQueue()
+            state = _WorkerState(self.mode, self._passphrase, self.keep_files, self.cancel_event, events, session,
+                                 self._manifest, self.compression)
+            pool = ThreadPoolExecutor(max_workers=self.jobs)
+            return pool, events, lambda chunk: pool.submit(_run_batch, state, chunk)
+
+        # processes are spawned so that no GUI or thread state is inherited
+        context = multiprocessing.get_context("spawn")
+        self._worker_cancel_event = context.Event()
+        events = context.Queue()
+        shared_key = None
+        if self.mode == "encrypt": # derive once here, workers only run HKDF
+            pass_hash, master_key = session.master_key()
+            shared_key = (pass_hash, bytes(master_key), session.key_params)
+        kdf_semaphore = context.BoundedSemaphore(kdf_scheduler.capacity(session.key_params))
+        # every process has its own chunk threads, together they get one per core
+        workers = None if self.mode == "check" else max(1, aes_workers() // self.jobs)
+        pool = ProcessPoolExecutor(max_workers=self.jobs, mp_context=context, initializer=_init_worker,
+                                   initargs=(self.mode, self._passphrase, self.keep_files, self._worker_cancel_event,
+                                             events, shared_key, kdf_semaphore, self.manifest,
+                                             self.compression, workers))
+        return pool, events, lambda chunk: pool.submit(_run_worker_batch, chunk)
+
+    def _produce(self, file_paths, chunks: Queue, chunksize: int) -> None:
+        '''
+        Function to group file paths into tasks, runs on its own thread so that scanning overlaps with processing.
+        Files are ordered by size in windows that double in length, so the first file starts right away
+        while large batches still get largest-first scheduling. The queue is bounded, so the producer
+        never runs far ahead of the workers
+        '''
+        try:
+            file_paths = iter(file_paths)
+            if self._journal is not None or self._manifest is not None:
+                file_paths = self._skip_finished(file_paths)
+            window = 1
+            while True:
+                file_paths_window = list(islice(file_paths, window))
+                if not file_paths_window:
+                    break
+                for chunk in self._pack(file_paths_window, chunksize):
+                    if not self._put(chunks, chunk):
+                        return
+                window = min(2 * window, self.window_size)
+            with self._progress_lock:
+                self._scanning = False
+            self._put(chunks, None) # end of input
+        except Exception as e:
+            self._put(chunks, e)
+
+    def _skip_finished(self, file_paths):
+        for file_path in file_paths:
+            if (self._journal is not None and self._journal.finished(file_path)) or \
+                    (self._manifest is not None and self._manifest.unchanged(file_path, self._key_matches)):
+                with self._progress_lock:
+                    self._files_skipped += 1
+                continue
+            yield file_path
+
+    def _key_matches(self, key: str) -> bool:
+        '''
+        Function to check whether a password hash recorded by an earlier run belongs to the batch password,
+        each hash is checked once per batch
+        '''
+        with self._progress_lock:
+            if key in self._keys:
+                return self._keys[key]
+        try:
+            matches = key is not None and self._session.verify(key)
+        except (argon2exceptions.VerificationError, ValueError): # other password or not a password hash
+            matches = False
+        with self._progress_lock:
+            self._keys[key] = matches
+        return matches
+
+    def _pack(self, file_paths: list, chunksize: int) -> list:
+        '''
+        Function to order files largest first (longest processing time first) and pack small files into shared tasks
+
+        :param file_paths: paths of the files in this window
+        :param chunksize: maximum number of files per task
+
+        Returns list of tasks, each a list of file paths
+        '''
+        sizes = {}
+        for file_path in file_paths:
+            try:
+                sizes[file_path] = ospath.getsize(file_path)
+            except OSError: # reported by the worker processing the file
+                sizes[file_path] = 0
+        with self._progress_lock:
+            for file_path, size in sizes.items():
+                self._file_bytes[file_path] = [size, 0]
+            self._files_total += len(file_paths)
+            self._bytes_total += sum(sizes.values())
+        # keep at least four tasks per worker, so that packing never leaves workers idle on small batches
+        target = max(1, min(self.pack_size, sum(sizes.values()) // (4 * self.jobs)))
+        tasks, task, task_size = [], [], 0
+        for file_path in sorted(file_paths, key=sizes.get, reverse=True):
+            task.append(file_path)
+            task_size += sizes[file_path]
+            if task_size >= target or len(task) >= chunksize:
+                tasks.append(task)
+                task, task_size = [], 0
+        if task:
+            tasks.append(task)
+        return tasks
+
+    def _put(self, chunks: Queue, item) -> bool:
+        while not self.cancel_event.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _dispatch(self, file_paths) -> None:
+        '''
+        Function to submit files in chunks and collect their results, runs on the runner thread.
+        At most two chunks per worker are in flight, so memory does not grow with the number of files
+        '''
+        session = self._session = LockByteSession(self._passphrase)
+        failed = True
+        try:
+            if self.journal is not None:
+                self._journal = BatchJournal(self.journal)
+                # files in flight when the last run stopped are processed again, their partial outputs can go
+                for folder in {ospath.dirname(file_path) for file_path in self._journal.in_flight}:
+                    remove_temp_files(folder)
+                if self._journal.resumed and not self._key_matches(self._journal.key):
+                    # written by a batch with another password, none of its files count as done
+                    self._journal.close(remove=True)
+                    self._journal = BatchJournal(self.journal)
+                if self._journal.key is None:
+                    self._journal.set_key(session.hashing_obj.hash(self._passphrase, salt=urandom(32)))
+            if self.manifest is not None:
+                self._manifest = Manifest(self.manifest)
+            chunksize = self.chunksize or 64
+            self._pool, events, submit = self._create_pool(session)
+            queue = Queue(maxsize=2 * self.jobs)
+            Thread(target=self._produce, args=(file_paths, queue, chunksize), daemon=True).start()
+            chunks = self._pending
+            completed = SimpleQueue() # futures put themselves here once done, no polling over pending futures
+            exhausted = False
+            while not exhausted or chunks:
+                if self.cancel_event.is_set():
+                    exhausted = True # nothing new is submitted once cancelled
+                    if not self._worker_cancel_event.is_set():
+                        self.cancel()
+                while not exhausted and len(chunks) < 2 * self.jobs:
+                    try:
+                        chunk = queue.get(timeout=0.1) if not chunks else queue.get_nowait()
+                    except Empty:
+                        break
+                    if chunk is None:
+                        exhausted = True
+                    elif isinstance(chunk, Exception):
+                        raise chunk
+                    else:
+                        with self._pending_lock:
+                            future = submit(chunk)
+                            chunks[future] = chunk
+                        future.add_done_callback(completed.put)
+                if not chunks:
+                    continue
+                try:
+                    future = completed.get(timeout=0.1)
+                except Empty:
+                    self._drain(events)
+                    continue
+                self._drain(events)
+                with self._pending_lock:
+                    chunk = chunks.pop(future)
+                if future.cancelled():
+                    continue
+                try:
+                    for result in future.result():
+                        self._record(*result)
+                except Exception as e: # worker died, report every file of its chunk
+                    for file_path in chunk:
+                        self._record(file_path, None, e)
+                if self._journal is not None:
+                    self._journal.sync() # once per task, outputs of the task are already durable
+            self._drain(events)
+            self._pool.shutdown()
+            failed = self.cancel_event.is_set() or self._files_failed > 0
+            if self._manifest is not None and self.prune and not self.cancel_event.is_set():
+                for file_path_old in self._manifest.prune():
+                    self._emit("pruned", file_path_old, None)
+            self._report_progress(force=True)
+        except Exception as e:
+            self._record(None, None, e)
+            if self._pool is not None:
+                self._cancel_pending()
+        finally:
+            session.close() # wipe key material once the batch is over
+            if self._manifest is not None:
+                try:
+                    self._manifest.save() # files encrypted before a failure are not encrypted again
+                except OSError as e:
+                    self._record(None, None, e)
+            if self._journal is not None:
+                self._journal.close(remove=not failed) # kept for a rerun unless every file is done
+            self._finished.set()
@@ -0,0 +1,447 @@
+# ====================================================================
+# This file is part of LockByte.
+# LockByte is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3 of the License.
+# LockByte is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with LockByte. If not, see <https://www.gnu.org/licenses/>.
+# ====================================================================
+
+# headless entry point, must not import the GUI stack (customtkinter, PIL, darkdetect)
+
+from argparse import ArgumentParser
+from getpass import getpass
+from os import environ, devnull, path as ospath, remove as osremove
+import sys
+from itertools import chain
+from contextlib import nullcontext
+
+from argon2 import exceptions as argon2exceptions
+
+from lockbyte import __version__
+from lockbyte.batch import BatchRunner, BACKENDS, walk_files, format_eta
+from lockbyte.lock_unlock import LockByteUser, LockByteSession, KeySlotError
+from lockbyte.atomic import atomic_write
+from lockbyte.journal import journal_path
+from lockbyte.manifest import manifest_path
+from lockbyte.archive import pack, unpack, list_archive
+from lockbyte.compress import available_codecs
+
+COMPRESSION_CHOICES = ["auto"] + available_codecs()
+
+
+class CLIError(Exception):
+    '''
+    Extends standard exception class to report command line usage errors
+    '''
+    pass
+
+
+# function to build the argument parser
+def build_parser() -> ArgumentParser:
+    '''
+    Function to build the argument parser of the lockbyte command
+    '''
+    parser = ArgumentParser(prog="lockbyte", description="Password based file encryption")
+    parser.add_argument("--version", action="version", version="%(prog)s " + __version__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command, help_text in (("encrypt", "encrypt files into .lockbyte files"),
+                               ("decrypt", "decrypt .lockbyte files"),
+                               ("verify", "check the password of .lockbyte files without writing output")):
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument("paths", nargs="+", metavar="PATH",
+                               help="file(s) or folder(s) to process, '-' reads from standard input")
+        subparser.add_argument("-r", "--recursive", action="store_true",
+                               help="process folders and their sub folders")
+        subparser.add_argument("-j", "--jobs", type=int, default=None,
+                               help="number of parallel workers (default: one per core)")
+        subparser.add_argument("--backend", choices=BACKENDS, default="thread",
+                               help="run workers as threads or processes (default: thread)")
+        password = subparser.add_mutually_exclusive_group()
+        password.add_argument("--password-env", metavar="VAR",
+                              help="read the password from environment variable VAR")
+        password.add_argument("--password-fd", metavar="FD", type=int,
+                              help="read the password from the first line of file descriptor FD")
+        subparser.add_argument("-q", "--quiet", action="store_true", help="only report errors")
+        subparser.add_argument("--progress", action="store_true",
+                               help="show bytes processed, throughput and time left on standard error")
+        if command != "verify":
+            subparser.add_argument("-o", "--output", metavar="FILE",
+                                   help="write the result of a single input to FILE, '-' writes to standard output")
+        if command == "verify":
+            subparser.add_argument("--full", action="store_true",
+                                   help="also decrypt and authenticate the file contents instead of reading headers only")
+        if command != "verify":
+            subparser.add_argument("--restart", action="store_true",
+                                   help="start over instead of skipping files finished by an interrupted run on the same paths")
+        if command == "encrypt":
+            subparser.add_argument("--compress", choices=COMPRESSION_CHOICES, default=None,
+                                   help="compress files before encryption, 'auto' skips data that does not compress")
+            subparser.add_argument("--delete", action="store_true",
+                                   help="delete original files once they have been encrypted")
+            subparser.add_argument("--incremental", action="store_true",
+                                   help="only encrypt files of a folder that are new or changed since the last "
+                                        "incremental run, replacing their previous .lockbyte files")
+            subparser.add_argument("--prune", action="store_true",
+                                   help="with --incremental, delete .lockbyte files whose source file was deleted")
+
+    for command, help_text in (("pack", "encrypt a folder into a single .lockbyte archive"),
+                               ("unpack", "decrypt and extract a .lockbyte archive"),
+                               ("list", "list the contents of a .lockbyte archive")):
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument("path", metavar="FOLDER" if command == "pack" else "ARCHIVE")
+        password = subparser.add_mutually_exclusive_group()
+        password.add_argument("--password-env", metavar="VAR",
+                              help="read the password from environment variable VAR")
+        password.add_argument("--password-fd", metavar="FD", type=int,
+                              help="read the password from the first line of file descriptor FD")
+        subparser.add_argument("-q", "--quiet", action="store_true", help="only report errors")
+        if command != "list":
+            subparser.add_argument("-o", "--output", metavar=("FILE" if command == "pack" else "FOLDER"),
+                                   help="path to the archive / folder to create (default: next to the input)")
+        if command == "pack":
+            subparser.add_argument("--compress", choices=COMPRESSION_CHOICES, default=None,
+                                   help="compress the archive before encryption, listing then decrypts it entirely")
+            subparser.add_argument("--no-index", action="store_true",
+                                   help="leave out the member index, listing then decrypts the whole archive")
+
+    subparser = subparsers.add_parser("rekey", help="change the password of .lockbyte files without re-encrypting them")
+    subparser.add_argument("paths", nargs="+", metavar="FILE", help=".lockbyte file(s) written in format version 4")
+    password = subparser.add_mutually_exclusive_group()
+    password.add_argument("--password-env", metavar="VAR",
+                          help="read the current password from environment variable VAR")
+    password.add_argument("--password-fd", metavar="FD", type=int,
+                          help="read the current password from the first line of file descriptor FD")
+    subparser.add_argument("--new-password-env", metavar="VAR",
+                           help="read the new password from environment variable VAR")
+    action = subparser.add_mutually_exclusive_group()
+    action.add_argument("--add", action="store_true",
+                        help="add the new password, the current password keeps working")
+    action.add_argument("--remove", action="store_true",
+                        help="remove the current password, other passwords added with --add keep working")
+    subparser.add_argument("-q", "--quiet", action="store_true", help="only report errors")
+    return parser
+
+
+# function to read the user password
+def read_password(args) -> str:
+    '''
+    Function to read the user password from an environment variable, a file descriptor or an interactive prompt
+
+    :param args: parsed command line arguments
+    '''
+    if args.password_env is not None:
+        if args.password_env not in environ:
+            raise CLIError("environment variable {0} is not set".format(args.password_env))
+        passphrase = environ[args.password_env]
+    elif args.password_fd is not None:
+        with open(args.password_fd, "r", closefd=False) as f:
+            passphrase = f.readline().rstrip("\r\n")
+    else:
+        passphrase = getpass("Password: ")
+        if args.command in ("encrypt", "pack") and getpass("Confirm password: ") != passphrase:
+            raise CLIError("passwords do not match")
+    passphrase = passphrase.strip() # same normalisation as the GUI
+    if args.command in ("encrypt", "pack") and len(passphrase) < 6:
+        raise CLIError("password must be at least six characters long")
+    return passphrase
+
+
+# function to read the password replacing the current one
+def read_new_password(args) -> str:
+    '''
+    Function to read the new password of the rekey command from an environment variable or an interactive prompt
+
+    :param args: parsed command line arguments
+    '''
+    if args.new_password_env is not None:
+        if args.new_password_env not in environ:
+            raise CLIError("environment variable {0} is not set".format(args.new_password_env))
+        passphrase = environ[args.new_password_env]
+    else:
+        passphrase = getpass("New password: ")
+        if getpass("Confirm new password: ") != passphrase:
+            raise CLIError("passwords do not match")
+    passphrase = passphrase.strip()
+    if len(passphrase) < 6:
+        raise CLIError("password must be at least six characters long")
+    return passphrase
+
+
+# function to expand the command line paths into files
+def collect_files(args):
+    '''
+    Generator expanding the paths given on the command line into the files to process,
+    folders are scanned lazily while earlier files are already being processed
+
+    :param args: parsed command line arguments
+    '''
+    for path in args.paths:
+        if ospath.isdir(path):
+            if not args.recursive:
+                raise CLIError("{0} is a folder, use -r to process folders".format(path))
+            # never encrypt existing .lockbyte files twice, only decrypt .lockbyte files
+            if args.command == "encrypt":
+                yield from walk_files(path, exclude="*.lockbyte")
+            else:
+                yield from walk_files(path, include="*.lockbyte")
+        else:
+            yield path
+
+
+# function to process a single stream
+def run_stream(args, passphrase: str, file_path: str) -> int:
+    '''
+    Function to encrypt / decrypt / verify a single input into a single output without intermediate files,
+    used for standard input / output and for explicit output files
+
+    :param args: parsed command line arguments
+    :param passphrase: user password
+    :param file_path: input path, '-' for standard input
+
+    Returns exit status
+    '''
+    output = getattr(args, "output", None)
+    if args.command == "verify":
+        output = devnull
+    elif output is None: # input read from standard input
+        output = "-"
+    if output == "-" and args.command == "encrypt" and sys.stdout.isatty():
+        raise CLIError("refusing to write encrypted data to a terminal")
+
+    try:
+        src = sys.stdin.buffer if file_path == "-" else open(file_path, "rb")
+    except OSError as e:
+        print("lockbyte: {0}: {1}".format(e.filename, describe_error(e)), file=sys.stderr, flush=True)
+        return 1
+    try:
+        if output == "-":
+            dst = nullcontext(sys.stdout.buffer)
+        elif output == devnull:
+            dst = open(devnull, "wb")
+        else: # written to a temporary file renamed into place, never a partial output file
+            dst = atomic_write(output)
+        with dst as f:
+            user = LockByteUser(passphrase, compression=getattr(args, "compress", None))
+            if args.command == "encrypt":
+                if user.validate_and_generate(1):
+                    user.encrypt_stream(src, f)
+            elif args.command == "verify" and not args.full:
+                user.verify_password(src)
+            else:
+                user.decrypt_stream(src, f)
+            f.flush()
+    except Exception as e:
+        print("lockbyte: {0}: {1}".format(file_path, describe_error(e)), file=sys.stderr, flush=True)
+        return 1
+    finally:
+        if src is not sys.stdin.buffer:
+            src.close()
+    return 0
+
+
+# function to pack, unpack or list an archive
+def run_archive(args, passphrase: str) -> int:
+    '''
+    Function to run the archive commands, the whole folder is a single encrypted stream
+
+    :param args: parsed command line arguments
+    :param passphrase: user password
+
+    Returns exit status
+    '''
+    try:
+        if args.command == "pack":
+            output = pack(args.path, passphrase, args.output, index=not args.no_index, compression=args.compress)
+            if not args.quiet:
+                print("packed: {0} -> {1}".format(args.path, output), flush=True)
+        elif args.command == "unpack":
+            output = unpack(args.path, passphrase, args.output)
+            if not args.quiet:
+                print("unpacked: {0} -> {1}".format(args.path, output), flush=True)
+        else:
+            for member in list_archive(args.path, passphrase):
+                print(member.name + ("/" if member.type == "dir" else ""))
+            sys.stdout.flush()
+    except Exception as e:
+        print("lockbyte: {0}: {1}".format(args.path, describe_error(e)), file=sys.stderr, flush=True)
+        return 1
+    return 0
+
+
+# function to change the passwords of files
+def run_rekey(args, passphrase: str, new_passphrase: str) -> int:
+    '''
+    Function to run the rekey command, only the headers of the files are rewritten
+
+    :param args: parsed command line arguments
+    :param passphrase: current password
+    :param new_passphrase: new password, None with --remove
+
+    Returns exit status
+    '''
+    failed = 0
+    # files sharing a salt are unlocked with a single derivation, the new password is derived once for all files
+    with LockByteSession(passphrase) as session, LockByteSession(new_passphrase or passphrase) as new_session:
+        for file_path in args.paths:
+            user = LockByteUser(passphrase, session=session)
+            try:
+                if args.remove:
+                    user.remove_password(file_path)
+                elif args.add:
+                    user.add_password(file_path, new_session)
+                else:
+                    user.change_password(file_path, new_session)
+            except Exception as e:
+                print("lockbyte: {0}: {1}".format(file_path, describe_error(e)), file=sys.stderr, flush=True)
+                failed += 1
+                continue
+            if not args.quiet:
+                print("rekeyed: {0}".format(file_path), flush=True)
+    return 1 if failed else 0
+
+
+# function to describe errors raised while processing a file
+def describe_error(error: Exception) -> str:
+    '''
+    Function to translate an error raised while processing a file into a short message
+
+    :param error: exception raised by the job
+    '''
+    if isinstance(error, FileNotFoundError):
+        return "file not found"
+    if isinstance(error, argon2exceptions.InvalidHashError):
+        return "file is corrupt or of incorrect type"
+    if isinstance(error, argon2exceptions.VerifyMismatchError):
+        return "password is incorrect"
+    if isinstance(error, KeySlotError):
+        return str(error)
+    if isinstance(error, OSError):
+        return "I/O error({0}): {1}".format(error.errno, error.strerror)
+    if isinstance(error, ValueError):
+        if "Error 2 while running scrypt" in str(error):
+            return "not enough memory available"
+        return "file is corrupt or of incorrect type"
+    return "unexpected error: {0}".format(error)
+
+
+# function to format a progress snapshot
+def format_progress(progress) -> str:
+    '''
+    Function to format a batch progress snapshot into a single status line
+
+    :param progress: lockbyte.batch.BatchProgress snapshot
+    '''
+    return "{0:5.1f}% {1}/{2}{3} files {4:.1f}/{5:.1f} MB {6:.1f} MB/s ETA {7}".format(
+        100 * progress.fraction, progress.files_done, progress.files_total, "+" if progress.scanning else "",
+        progress.bytes_done / 2**20, progress.bytes_total / 2**20, progress.rate / 2**20, format_eta(progress.eta))
+
+
+# main caller function
+def main(argv: list = None) -> int:
+    '''
+    Main caller function of the lockbyte command
+
+    :param argv: (optional) command line arguments, defaults to sys.argv
+
+    Returns exit status, 0 on success, 1 if any file failed and 2 on usage errors
+    '''
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "rekey":
+        try:
+            passphrase = read_password(args)
+            new_passphrase = None if args.remove else read_new_password(args)
+        except CLIError as e:
+            parser.error(str(e))
+        except (KeyboardInterrupt, EOFError):
+            return 2
+        try:
+            return run_rekey(args, passphrase, new_passphrase)
+        except KeyboardInterrupt:
+            return 130
+    if args.command in ("pack", "unpack", "list"):
+        try:
+            if args.command == "pack" and not ospath.isdir(args.path):
+                raise CLIError("{0} is not a folder".format(args.path))
+            passphrase = read_password(args)
+        except CLIError as e:
+            parser.error(str(e))
+        except (KeyboardInterrupt, EOFError):
+            return 2
+        try:
+            return run_archive(args, passphrase)
+        except KeyboardInterrupt:
+            return 130
+    try:
+        for path in args.paths: # report usage errors before anything is processed
+            if ospath.isdir(path) and not args.recursive:
+                raise CLIError("{0} is a folder, use -r to process folders".format(path))
+        if getattr(args, "prune", False) and not args.incremental:
+            raise CLIError("--prune requires --incremental")
+        if getattr(args, "incremental", False):
+            if len(args.paths) != 1 or not ospath.isdir(args.paths[0]):
+                raise CLIError("--incremental takes a single folder")
+            if args.delete:
+                raise CLIError("--incremental keeps original files, it cannot be combined with --delete")
+        file_paths = collect_files(args)
+        first = next(file_paths, None)
+        if first is None:
+            raise CLIError("no files to {0}".format(args.command))
+        stream = "-" in args.paths or getattr(args, "output", None) is not None
+        if stream and next(file_paths, None) is not None:
+            raise CLIError("standard input and --output take a single input file")
+        passphrase = read_password(args)
+        if stream:
+            return run_stream(args, passphrase, first)
+        file_paths = chain([first], file_paths)
+    except CLIError as e:
+        parser.error(str(e))
+    except (KeyboardInterrupt, EOFError):
+        return 2
+
+    past_tense = {"encrypt": "encrypted", "decrypt": "decrypted", "verify": "verified"}[args.command]
+
+    def on_event(kind, file_path, value):
+        if kind == "done" and value is not None and not args.quiet:
+            if args.command == "verify":
+                print("{0}: {1}".format(past_tense, file_path), flush=True)
+            else:
+                print("{0}: {1} -> {2}".format(past_tense, file_path, value), flush=True)
+        elif kind == "pruned" and not args.quiet:
+            print("pruned: {0}".format(file_path), flush=True)
+        elif kind == "error":
+            print("lockbyte: {0}: {1}".format(file_path, describe_error(value)), file=sys.stderr, flush=True)
+        elif kind == "progress" and args.progress:
+            # redraw a single line on terminals, print one line per update otherwise
+            end = "\r" if sys.stderr.isatty() else "\n"
+            print(format_progress(value), end=end, file=sys.stderr, flush=True)
+
+    mode = "check" if args.command == "verify" and not args.full else args.command
+    journal = None
+    if args.command != "verify": # verifying writes nothing, there is nothing to resume
+        journal = journal_path(mode, args.paths)
+        if args.restart and ospath.isfile(journal):
+            osremove(journal)
+    manifest = manifest_path(args.paths[0]) if getattr(args, "incremental", False) else None
+    runner = BatchRunner(mode, passphrase, backend=args.backend, jobs=args.jobs,
+                         keep_files=not getattr(args, "delete", False), on_event=on_event, keep_results=False,
+                         journal=journal, manifest=manifest, prune=getattr(args, "prune", False),
+                         compression=getattr(args, "compress", None))
+    try:
+        runner.run(file_paths)
+    except KeyboardInterrupt:
+        runner.cancel()
+        runner.wait()
+        return 130
+    if args.progress and sys.stderr.isatty():
+        print(file=sys.stderr)
+    progress = runner.progress()
+    if not args.quiet:
+        skipped = ", {0} skipped".format(progress.files_skipped) if progress.files_skipped else ""
+        print("{0} file(s) {1}{2}, {3} failed".format(progress.files_done - progress.files_failed, past_tense,
+                                                      skipped, progress.files_failed), file=sys.stderr)
+    return 1 if progress.files_failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
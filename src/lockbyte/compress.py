@@ -0,0 +1,167 @@
+# ====================================================================
+# This file is part of LockByte.
+# LockByte is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3 of the License.
+# LockByte is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with LockByte. If not, see <https://www.gnu.org/licenses/>.
+# ====================================================================
+
+from io import RawIOBase
+import zlib
+import lzma
+
+# zstd is optional, from the standard library (Python 3.14) or the zstandard package
+try:
+    from compression import zstd as _zstd
+except ImportError:
+    _zstd = None
+try:
+    import zstandard as _zstandard
+except ImportError:
+    _zstandard = None
+
+from lockbyte.container import FLAG_CODEC_MASK
+
+
+# codec ids stored in the header flags (shifted into FLAG_CODEC_MASK), never renumber
+CODECS = {"zlib": 1, "lzma": 2, "zstd": 3}
+CODEC_SHIFT = 1
+
+SAMPLE_SIZE = 2**17 # bytes sampled by the 'auto' mode
+MIN_SAVING = 0.1 # the 'auto' mode only compresses data that shrinks by at least this fraction
+MIN_SIZE = 512 # smaller inputs are never compressed, the codec overhead would outweigh the saving
+
+
+# function to list the codecs available here
+def available_codecs() -> list:
+    '''
+    Function to list the compression codecs usable in this environment, zstd depends on optional packages
+    '''
+    return [name for name in CODECS if name != "zstd" or _zstd is not None or _zstandard is not None]
+
+
+# function to check a codec name
+def check_codec(name: str) -> None:
+    '''
+    Function to reject unknown codecs and codecs whose package is not installed
+
+    :param name: codec name
+    '''
+    if name not in CODECS:
+        raise ValueError("Unknown compression codec: {0}".format(name))
+    if name not in available_codecs():
+        raise ValueError("{0} compression requires the zstandard package".format(name))
+
+
+# function to encode a codec into header flags
+def codec_flags(name: str) -> int:
+    '''
+    Function to build the header flags recording a codec
+
+    :param name: codec name, None for uncompressed payloads
+    '''
+    return 0 if name is None else CODECS[name] << CODEC_SHIFT
+
+
+# function to decode a codec from header flags
+def codec_from_flags(flags: int) -> str:
+    '''
+    Function to find the codec recorded in header flags
+
+    :param flags: header flags
+
+    Returns codec name or None for uncompressed payloads, raises ValueError for codecs not available here
+    '''
+    codec_id = (flags & FLAG_CODEC_MASK) >> CODEC_SHIFT
+    if codec_id == 0:
+        return None
+    for name, known_id in CODECS.items():
+        if known_id == codec_id:
+            check_codec(name)
+            return name
+    raise ValueError("Unsupported file header")
+
+
+# function to pick a codec for a sample of the data
+def choose_codec(sample: bytes, preferred: str = None) -> str:
+    '''
+    Function to decide whether data is worth compressing from a sample of its start,
+    already compressed data (images, archives, video) is left as is
+
+    :param sample: first bytes of the data, up to SAMPLE_SIZE
+    :param preferred: (optional) codec to use if the data compresses, defaults to zstd when available else zlib
+
+    Returns codec name or None
+    '''
+    if len(sample) < MIN_SIZE:
+        return None
+    if len(zlib.compress(sample, 1)) > (1 - MIN_SAVING) * len(sample): # fastest level, only a rough estimate
+        return None
+    if preferred is not None:
+        return preferred
+    return "zstd" if "zstd" in available_codecs() else "zlib"
+
+
+# function to create a streaming compressor
+def compressor(name: str):
+    '''
+    Function to create a streaming compressor
+
+    :param name: codec name
+
+    Returns object with compress(data) and flush() methods
+    '''
+    check_codec(name)
+    if name == "zlib":
+        return zlib.compressobj(6)
+    if name == "lzma":
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+    if _zstd is not None:
+        return _zstd.ZstdCompressor(level=3)
+    return _zstandard.ZstdCompressor(level=3).compressobj()
+
+
+# function to create a streaming decompressor
+def decompressor(name: str):
+    '''
+    Function to create a streaming decompressor
+
+    :param name: codec name
+
+    Returns object with a decompress(data) method and an eof attribute
+    '''
+    check_codec(name)
+    if name == "zlib":
+        return zlib.decompressobj()
+    if name == "lzma":
+        return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+    if _zstd is not None:
+        return _zstd.ZstdDecompressor()
+    return _zstandard.ZstdDecompressor().decompressobj()
+
+
+class PrefixedReader(RawIOBase):
+    '''
+    Class to read bytes already taken from a stream (e.g. a sample) followed by the rest of the stream
+    '''
+
+    def __init__(self, prefix: bytes, src) -> None:
+        super().__init__()
+        self._prefix = memoryview(prefix)
+        self._src = src
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        if self._prefix:
+            size = min(len(view), len(self._prefix))
+            view[:size] = self._prefix[:size]
+            self._prefix = self._prefix[size:]
+            return size
+        readinto = getattr(self._src, "readinto", None)
+        if readinto is not None:
+            return readinto(view)
+        data = self._src.read(len(view))
+        view[:len(data)] = data
+        return len(data)
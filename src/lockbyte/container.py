@@ -0,0 +1,341 @@
+# ====================================================================
+# This file is part of LockByte.
+# LockByte is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3 of the License.
+# LockByte is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with LockByte. If not, see <https://www.gnu.org/licenses/>.
+# ====================================================================
+
+from Crypto.Cipher import AES
+
+from struct import Struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+
+from lockbyte.scheduler import aes_workers
+
+
+# .lockbyte container layouts
+#   version 1: iv (16) | argon2 hash (118) | AES-CBC payload
+#   version 2: magic (8) | version (1) | scrypt log2(N), r, p (3) | argon2 hash (118) | file nonce (16) | iv (16) | AES-CBC payload
+#   version 3: magic (8) | version (1) | flags (1) | scrypt log2(N), r, p (3) | chunk size (4) | argon2 hash (118) | file nonce (16)
+#              followed by AES-GCM chunks, each holding chunk size bytes of ciphertext and a 16-byte tag.
+#              The last chunk is always shorter than chunk size (possibly empty) and is sealed with the final flag set,
+#              so truncation, reordering and header tampering (the header is authenticated with every chunk) are detected
+#   version 4: magic (8) | version (1) | flags (1) | key slots (1) | chunk size (4)
+#              followed by key slots, each scrypt log2(N), r, p (3) | argon2 hash (118) | slot nonce (16) | wrapped key (48).
+#              The payload is encrypted as in version 3 with a random file key, each slot wraps that key with AES-GCM
+#              under a key derived from one password. Only the fixed part of the header is authenticated with every
+#              chunk, so passwords are added, changed or removed by rewriting the slots without touching the payload.
+#              Unused slots are all zeros
+FORMAT_MAGIC = b"LOCKBYTE"
+HEADER_V2 = Struct(">8sBBBB118s16s16s")
+HEADER_V3 = Struct(">8sBBBBBI118s16s")
+HEADER_V4 = Struct(">8sBBBI")
+KEY_SLOT = Struct(">BBB118s16s48s")
+WRAPPED_KEY_SIZE = 48 # 256-bit file key and its tag
+MAX_KEY_SLOTS = 8
+CHUNK_NONCE = Struct(">QI") # chunk index, final flag
+TAG_SIZE = 16
+
+# version 3 header flags, unknown flags are rejected
+FLAG_ARCHIVE = 0x01 # the payload is a folder packed by lockbyte.archive
+FLAG_CODEC_MASK = 0x0E # id of the codec the payload was compressed with before encryption, see lockbyte.compress
+KNOWN_FLAGS = FLAG_ARCHIVE | FLAG_CODEC_MASK
+
+# chunk workers shared by every file of this process, so that parallel files never oversubscribe the cores
+_chunk_pool = None
+_chunk_pool_lock = Lock()
+
+
+class OperationCancelled(Exception):
+    '''
+    Extends standard exception class to signal that an operation was cancelled between two chunks
+    '''
+    pass
+
+
+# function to read an exact number of bytes
+def read_exact(src, size: int) -> bytes:
+    '''
+    Function to read up to size bytes, only returning less at the end of the stream (pipes may return short reads)
+
+    :param src: readable binary stream
+    :param size: number of bytes to read
+    '''
+    data = src.read(size)
+    if data is None:
+        data = b""
+    while 0 < len(data) < size:
+        more = src.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+# function to fill a buffer from a stream
+def readinto_exact(src, view: memoryview) -> int:
+    '''
+    Function to fill a writable buffer from a stream without allocating, only stopping short at the end of the stream
+
+    :param src: readable binary stream
+    :param view: writable memoryview to be filled
+
+    Returns number of bytes read
+    '''
+    readinto = getattr(src, "readinto", None)
+    if readinto is None: # plain read() streams still work, at the cost of a copy
+        data = read_exact(src, len(view))
+        view[:len(data)] = data
+        return len(data)
+    count = 0
+    while count < len(view):
+        size = readinto(view[count:])
+        if not size:
+            break
+        count += size
+    return count
+
+
+# function to run one end of a pipe on a thread
+def run_in_thread(target, *args) -> tuple:
+    '''
+    Function to run a stage of a pipeline on a daemon thread, e.g. the end of an os.pipe the caller does not read
+
+    :param target: function to run
+    :param args: arguments of target
+
+    Returns (thread, errors) pair, errors holds the exception raised by target once the thread is joined
+    '''
+    errors = []
+
+    def run():
+        try:
+            target(*args)
+        except BaseException as e: # reported by the caller once the thread is joined
+            errors.append(e)
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+    return thread, errors
+
+
+# function to pick the error of a pipeline
+def pipeline_error(errors: list, error: BaseException) -> BaseException:
+    '''
+    Function to pick the error to raise once both ends of a pipe stopped. The thread's error is the cause,
+    e.g. a tampered chunk truncating the stream, unless it only failed because the caller closed the pipe
+
+    :param errors: errors of the thread, see run_in_thread
+    :param error: exception raised by the caller, None if it succeeded
+
+    Returns exception to raise or None
+    '''
+    for thread_error in errors:
+        if error is None or not isinstance(thread_error, BrokenPipeError):
+            return thread_error
+    return error
+
+
+# function to allocate reusable chunk buffers
+def chunk_buffers(chunk_size: int, workers: int) -> list:
+    '''
+    Function to allocate one record buffer (chunk and tag) for every chunk that can be in flight at once
+
+    :param chunk_size: number of plaintext bytes per chunk
+    :param workers: number of chunks processed in parallel
+    '''
+    return [memoryview(bytearray(chunk_size + TAG_SIZE)) for _ in range(2 * workers + 1)]
+
+
+# function to create the cipher of a single chunk
+def chunk_cipher(key: bytes, header: bytes, index: int, final: bool):
+    '''
+    Function to create the AES-GCM cipher object sealing one chunk
+
+    :param key: 256-bit file key
+    :param header: raw file header, authenticated with every chunk
+    :param index: position of the chunk in the file
+    :param final: whether this is the last chunk of the file
+    '''
+    cipher = AES.new(key, AES.MODE_GCM, nonce=CHUNK_NONCE.pack(index, int(final)))
+    cipher.update(header)
+    return cipher
+
+
+# function to wrap a file key
+def seal_key(wrap_key: bytes, nonce: bytes, aad: bytes, key: bytes) -> bytes:
+    '''
+    Function to encrypt and authenticate a file key for a version 4 key slot
+
+    :param wrap_key: 256-bit key derived from a password
+    :param nonce: random slot nonce
+    :param aad: fixed header and slot fields authenticated along with the key
+
+    Returns wrapped key followed by its tag
+    '''
+    cipher = AES.new(wrap_key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(aad)
+    wrapped, tag = cipher.encrypt_and_digest(key)
+    return wrapped + tag
+
+
+# function to unwrap a file key
+def open_key(wrap_key: bytes, nonce: bytes, aad: bytes, wrapped: bytes) -> bytes:
+    '''
+    Function to authenticate and decrypt the file key of a version 4 key slot
+
+    :param wrap_key: 256-bit key derived from a password
+    :param nonce: slot nonce
+    :param aad: fixed header and slot fields authenticated along with the key
+    :param wrapped: wrapped key followed by its tag
+
+    Returns file key, raises ValueError if the slot does not authenticate
+    '''
+    cipher = AES.new(wrap_key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(aad)
+    return cipher.decrypt_and_verify(wrapped[:-TAG_SIZE], wrapped[-TAG_SIZE:])
+
+
+# function to get the shared chunk worker pool
+def chunk_pool() -> ThreadPoolExecutor:
+    '''
+    Function to get the thread pool sealing / opening chunks, created on first use with one thread per core.
+    pycryptodome releases the GIL inside AES-GCM, so chunks are processed on all cores in parallel
+    '''
+    global _chunk_pool
+    with _chunk_pool_lock:
+        if _chunk_pool is None:
+            _chunk_pool = ThreadPoolExecutor(max_workers=aes_workers(), thread_name_prefix="lockbyte-chunk")
+        return _chunk_pool
+
+
+# function to seal a single chunk
+def seal_chunk(key: bytes, header: bytes, index: int, final: bool, record: memoryview) -> memoryview:
+    '''
+    Function to encrypt and authenticate a single chunk in place
+
+    :param record: writable buffer holding the plaintext followed by TAG_SIZE spare bytes for the tag
+
+    Returns view of the record (ciphertext followed by tag)
+    '''
+    size = len(record) - TAG_SIZE
+    cipher = chunk_cipher(key, header, index, final)
+    cipher.encrypt(record[:size], output=record[:size])
+    record[size:] = cipher.digest()
+    return record
+
+
+# function to open a single chunk
+def open_chunk(key: bytes, header: bytes, index: int, final: bool, record: memoryview) -> memoryview:
+    '''
+    Function to authenticate and decrypt a single chunk record (ciphertext followed by tag) in place
+
+    :param record: writable buffer holding the ciphertext followed by the tag
+
+    Returns view of the plaintext, raises ValueError if the chunk does not authenticate
+    '''
+    size = len(record) - TAG_SIZE
+    cipher = chunk_cipher(key, header, index, final)
+    cipher.decrypt(record[:size], output=record[:size])
+    cipher.verify(record[size:])
+    return record[:size]
+
+
+# function to run chunk tasks in parallel while keeping their results in order
+def run_in_order(tasks, workers: int = 1):
+    '''
+    Generator running chunk tasks on the shared pool and yielding their results in submission order.
+    At most 2 * workers tasks are in flight, so memory use stays bounded to a few chunks
+
+    :param tasks: iterable of (function, args) tuples, consumed lazily
+    :param workers: number of tasks run in parallel, 1 runs every task on the calling thread
+    '''
+    pending = deque()
+    try:
+        for function, args in tasks:
+            if workers <= 1:
+                yield function(*args)
+                continue
+            pending.append(chunk_pool().submit(function, *args))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending: # stop work that is no longer needed after an error
+            future.cancel()
+
+
+# function to encrypt a stream into authenticated chunks
+def encrypt_chunks(key: bytes, header: bytes, src, dst, chunk_size: int, workers: int = 1, progress=None,
+                   cancel_event=None) -> None:
+    '''
+    Function to encrypt a stream into independently authenticated AES-GCM chunks
+
+    :param key: 256-bit file key
+    :param header: raw file header
+    :param src: readable binary stream holding the plaintext
+    :param dst: writable binary stream receiving the chunks
+    :param chunk_size: number of plaintext bytes per chunk
+    :param workers: number of chunks encrypted in parallel, chunks are always written in order
+    :param progress: (optional) callback(size) receiving the number of plaintext bytes of every chunk written
+    :param cancel_event: (optional) event checked before every chunk, OperationCancelled is raised once it is set
+    '''
+    buffers = chunk_buffers(chunk_size, workers)
+
+    def tasks():
+        index = 0
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise OperationCancelled()
+            record = buffers[index % len(buffers)]
+            size = readinto_exact(src, record[:chunk_size])
+            final = size < chunk_size
+            yield seal_chunk, (key, header, index, final, record[:size + TAG_SIZE])
+            if final:
+                return
+            index += 1
+
+    for record in run_in_order(tasks(), workers):
+        dst.write(record)
+        if progress is not None:
+            progress(len(record) - TAG_SIZE)
+
+
+# function to decrypt a stream of authenticated chunks
+def decrypt_chunks(key: bytes, header: bytes, src, dst, chunk_size: int, workers: int = 1, progress=None,
+                   cancel_event=None) -> None:
+    '''
+    Function to decrypt a stream of AES-GCM chunks, failing at the first chunk that does not authenticate
+
+    :param key: 256-bit file key
+    :param header: raw file header
+    :param src: readable binary stream positioned after the header
+    :param dst: writable binary stream receiving the plaintext
+    :param chunk_size: number of plaintext bytes per chunk
+    :param workers: number of chunks decrypted in parallel, chunks are always written in order
+    :param progress: (optional) callback(size) receiving the number of encrypted bytes of every chunk written
+    :param cancel_event: (optional) event checked before every chunk, OperationCancelled is raised once it is set
+    '''
+    buffers = chunk_buffers(chunk_size, workers)
+
+    def tasks():
+        index = 0
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise OperationCancelled()
+            record = buffers[index % len(buffers)]
+            size = readinto_exact(src, record)
+            final = size < chunk_size + TAG_SIZE
+            if size < TAG_SIZE:
+                raise ValueError("Encrypted file is truncated")
+            yield open_chunk, (key, header, index, final, record[:size])
+            if final:
+                return
+            index += 1
+
+    for plaintext in run_in_order(tasks(), workers):
+        dst.write(plaintext)
+        if progress is not None:
+            progress(len(plaintext) + TAG_SIZE)
@@ -0,0 +1,179 @@
+# ====================================================================
+# This file is part of LockByte.
+# LockByte is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3 of the License.
+# LockByte is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with LockByte. If not, see <https://www.gnu.org/licenses/>.
+# ====================================================================
+
+from os import environ, fsync, makedirs, stat, remove as osremove, path as ospath
+from hashlib import sha256
+from threading import Lock
+import json
+import sys
+
+
+# function to find the folder journals are kept in
+def state_dir() -> str:
+    '''
+    Function to find the per-user folder LockByte keeps its state in, LOCKBYTE_STATE_DIR overrides it
+    '''
+    if environ.get("LOCKBYTE_STATE_DIR"):
+        return environ["LOCKBYTE_STATE_DIR"]
+    if sys.platform == "win32":
+        return ospath.join(environ.get("LOCALAPPDATA") or ospath.expanduser("~"), "LockByte")
+    return ospath.join(environ.get("XDG_STATE_HOME") or ospath.expanduser("~/.local/state"), "lockbyte")
+
+
+# function to name the journal of a batch
+def journal_path(mode: str, paths: list) -> str:
+    '''
+    Function to build the journal path of a batch, the same mode and sources always map to the same journal
+    so that a rerun picks up where the interrupted batch stopped
+
+    :param mode: batch mode, e.g. 'encrypt'
+    :param paths: files and / or folders the batch was started on
+
+    Returns path to the journal file
+    '''
+    key = "\0".join([mode] + sorted(ospath.abspath(path) for path in paths))
+    return ospath.join(state_dir(), "journals", sha256(key.encode("utf-8", "surrogateescape")).hexdigest()[:32] + ".jsonl")
+
+
+# function to identify a version of a file
+def file_signature(file_path: str) -> list:
+    '''
+    Function to build a cheap signature of the contents of a file from its metadata
+
+    :param file_path: path to file
+
+    Returns [size, mtime in nanoseconds] or None if the file does not exist
+    '''
+    try:
+        info = stat(file_path)
+    except OSError:
+        return None
+    return [info.st_size, info.st_mtime_ns]
+
+
+class BatchJournal:
+    '''
+    Class to keep an append-only record of the files of a batch, one JSON object per line.
+    Files marked done (and not modified since, with their output still in place) are skipped by a rerun,
+    files started but never finished or failed are processed again
+    '''
+
+    def __init__(self, file_path: str) -> None:
+        '''
+        Constructor for BatchJournal class, replays an existing journal
+
+        :param file_path: path to the journal file, created along with its folder if needed
+        '''
+        self.file_path = file_path
+        self._lock = Lock()
+        self._done = {} # file path -> (signature of the source, output, size of the output) when it was done
+        self._started = set() # started but not finished
+        self.key = None # password hash of the batch that wrote the journal, see set_key
+        if ospath.isfile(file_path):
+            with open(file_path, "r", encoding="utf-8", errors="surrogateescape") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: # last line torn by a crash
+                        continue
+                    self._replay(entry)
+        self.resumed = bool(self._done or self._started)
+        makedirs(ospath.dirname(ospath.abspath(file_path)), exist_ok=True)
+        self._file = open(file_path, "a", encoding="utf-8", errors="surrogateescape")
+
+    def _replay(self, entry: dict) -> None:
+        file_path = entry.get("path")
+        event = entry.get("event")
+        if event == "key":
+            self.key = entry.get("key")
+        elif event == "start":
+            self._started.add(file_path)
+        elif event == "done":
+            self._started.discard(file_path)
+            self._done[file_path] = (entry.get("source"), entry.get("output"), entry.get("size"))
+        elif event == "failed":
+            self._started.discard(file_path)
+            self._done.pop(file_path, None)
+
+    def _append(self, entry: dict) -> None:
+        with self._lock:
+            self._replay(entry)
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush() # survives a crash of the process, sync() makes it survive a crash of the system
+
+    @property
+    def in_flight(self) -> set:
+        '''
+        Files started but neither finished nor failed, e.g. when the previous run was interrupted
+        '''
+        with self._lock:
+            return set(self._started)
+
+    def finished(self, file_path: str) -> bool:
+        '''
+        Function to check whether a file was processed by a previous run, has not changed since
+        and its output still exists with the size it was written with
+
+        :param file_path: path to file
+        '''
+        file_path = ospath.abspath(file_path)
+        with self._lock:
+            if file_path not in self._done:
+                return False
+            signature, output, size = self._done[file_path]
+        if signature != file_signature(file_path):
+            return False
+        if output is None:
+            return True
+        if size is None: # folder, e.g. an extracted archive
+            return ospath.isdir(output)
+        return ospath.isfile(output) and ospath.getsize(output) == size
+
+    def set_key(self, key: str) -> None:
+        '''
+        Function to record which password the batch runs with, a rerun with another password starts over
+
+        :param key: encoded argon2 hash of the batch password
+        '''
+        self._append({"event": "key", "key": key})
+
+    def start(self, file_path: str) -> None:
+        self._append({"event": "start", "path": ospath.abspath(file_path)})
+
+    def done(self, file_path: str, output: str = None) -> None:
+        if output is not None:
+            output = ospath.abspath(output)
+        self._append({"event": "done", "path": ospath.abspath(file_path), "output": output,
+                      "source": file_signature(file_path),
+                      "size": ospath.getsize(output) if output is not None and ospath.isfile(output) else None})
+
+    def failed(self, file_path: str) -> None:
+        self._append({"event": "failed", "path": ospath.abspath(file_path)})
+
+    def sync(self) -> None:
+        '''
+        Function to make the entries written so far durable
+        '''
+        with self._lock:
+            if not self._file.closed:
+                fsync(self._file.fileno())
+
+    def close(self, remove: bool = False) -> None:
+        '''
+        Function to close the journal
+
+        :param remove: delete the journal, e.g. once every file of the batch is done
+        '''
+        with self._lock:
+            if self._file.closed:
+                return
+            if not remove:
+                self._file.flush()
+                fsync(self._file.fileno())
+            self._file.close()
+        if remove and ospath.isfile(self.file_path):
+            osremove(self.file_path)
@@ -7,11 +7,235 @@
 
 from argon2 import PasswordHasher
 from argon2.low_level import Type
-from Crypto.Protocol.KDF import scrypt
+from Crypto.Protocol.KDF import scrypt, HKDF
+from Crypto.Hash import SHA256
 from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
+from Crypto.Util.Padding import unpad
+from argon2 import exceptions as argon2exceptions
 
-from os import urandom, path as ospath
+from os import urandom, pipe, fsync, makedirs, remove as osremove, path as ospath
+from threading import Lock
+from hashlib import sha256
+from collections import OrderedDict
+from math import log2
+
+from lockbyte.scheduler import kdf_scheduler, aes_workers
+from lockbyte.container import FORMAT_MAGIC, HEADER_V2, HEADER_V3, encrypt_chunks, decrypt_chunks, read_exact, readinto_exact
+from lockbyte.container import OperationCancelled, KNOWN_FLAGS, FLAG_CODEC_MASK, run_in_thread, pipeline_error
+from lockbyte.container import HEADER_V4, KEY_SLOT, WRAPPED_KEY_SIZE, MAX_KEY_SLOTS, seal_key, open_key
+from lockbyte.compress import PrefixedReader, SAMPLE_SIZE, check_codec, choose_codec, codec_flags, codec_from_flags
+from lockbyte.compress import compressor, decompressor
+from lockbyte.atomic import atomic_write
+from lockbyte.journal import state_dir
+
+
+# function to run scrypt within the memory budget
+def derive_key(password, salt, key_params: dict) -> bytes:
+    '''
+    Function to run scrypt once a derivation slot is free, see lockbyte.scheduler.KDFScheduler
+
+    :param password: user password
+    :param salt: salt extracted from the encoded argon2 hash
+    :param key_params: scrypt parameters
+    '''
+    with kdf_scheduler.slot(key_params):
+        return scrypt(password=password, salt=salt, **key_params)
+
+
+# function to derive a per-file key from a batch master key
+def derive_file_key(master_key: bytes, nonce: bytes) -> bytes:
+    '''
+    Function to derive an independent 256-bit file key from a scrypt master key using HKDF-SHA256
+
+    :param master_key: key produced by scrypt for the batch
+    :param nonce: random per-file nonce stored in the file header
+    '''
+    return HKDF(master_key, 32, nonce, SHA256, context=b"lockbyte file key")
+
+
+class KeySlotError(ValueError):
+    '''
+    Extends ValueError to report password changes that the key slots of a file do not allow
+    '''
+    pass
+
+
+# function to name the header backup of a file
+def header_backup_path(file_path: str) -> str:
+    '''
+    Function to build the path the header of a file is saved to while its key slots are rewritten,
+    kept in the per-user state folder until the new header is durable
+
+    :param file_path: path to the encrypted file
+
+    Returns path to the backup file
+    '''
+    key = ospath.abspath(file_path).encode("utf-8", "surrogateescape")
+    return ospath.join(state_dir(), "headers", sha256(key).hexdigest()[:32] + ".bin")
+
+
+class KeyCache:
+    '''
+    Class to implement a bounded LRU cache of derived keys which wipes key material on eviction
+    '''
+
+    def __init__(self, max_entries: int = 64) -> None:
+        '''
+        Constructor for KeyCache class
+
+        :param max_entries: maximum number of keys held at once
+        '''
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, cache_key) -> bytes:
+        '''
+        Function to look up a key, marking it as most recently used
+
+        :param cache_key: hashable lookup key
+
+        Returns a copy of the cached key or None
+        '''
+        with self._lock:
+            key = self._entries.get(cache_key)
+            if key is None:
+                return None
+            self._entries.move_to_end(cache_key)
+            return bytes(key)
+
+    def put(self, cache_key, key: bytes) -> None:
+        '''
+        Function to store a key, evicting the least recently used one when full
+
+        :param cache_key: hashable lookup key
+        :param key: key material to be cached
+        '''
+        with self._lock:
+            if cache_key in self._entries:
+                self._wipe(self._entries.pop(cache_key))
+            self._entries[cache_key] = bytearray(key)
+            while len(self._entries) > self.max_entries:
+                self._wipe(self._entries.popitem(last=False)[1])
+
+    def clear(self) -> None:
+        '''
+        Function to wipe and drop every cached key
+        '''
+        with self._lock:
+            while self._entries:
+                self._wipe(self._entries.popitem()[1])
+
+    @staticmethod
+    def _wipe(key: bytearray) -> None:
+        key[:] = bytes(len(key))
+
+
+class LockByteSession:
+    '''
+    Class to share a single argon2 hash and scrypt master key across a batch of files
+    '''
+
+    def __init__(self, passphrase: str, cache_size: int = 64) -> None:
+        '''
+        Constructor for LockByteSession class
+
+        :param passphrase: user password to be used for the whole batch
+        :param cache_size: maximum number of scrypt keys kept for decryption
+        '''
+        self._passphrase = passphrase
+        self.hashing_obj = PasswordHasher(**LockByteUser.hashing_params) # create hashing object
+        self.key_params = dict(LockByteUser.key_params)
+        self.pass_hash = None
+        self._master_key = None
+        self._lock = Lock()
+        self.key_cache = KeyCache(cache_size)
+        self._unlock_locks = {}
+        self._verified = set() # file hashes already matched against the session password
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def master_key(self) -> tuple:
+        '''
+        Function to derive the batch password hash and master key, the KDF only runs on first use
+
+        Returns tuple of (encoded argon2 hash, master key)
+        '''
+        with self._lock:
+            if self._master_key is None:
+                self.pass_hash = self.hashing_obj.hash(self._passphrase, salt=urandom(32))
+                self._master_key = bytearray(derive_key(self._passphrase,
+                                                        self.pass_hash.split('$')[-2], self.key_params))
+            return self.pass_hash, self._master_key
+
+    def load_master_key(self, pass_hash: str, master_key: bytes, key_params: dict) -> None:
+        '''
+        Function to adopt a master key derived by another session, e.g. by the parent of a worker process
+
+        :param pass_hash: encoded argon2 hash of the batch
+        :param master_key: scrypt key derived for that hash
+        :param key_params: scrypt parameters used for the derivation
+        '''
+        with self._lock:
+            self.pass_hash = pass_hash
+            self._master_key = bytearray(master_key)
+            self.key_params = dict(key_params)
+
+    def verify(self, extracted_hash: str) -> bool:
+        '''
+        Function to check the session password against a file hash without deriving any key,
+        each distinct hash is only checked once per session
+
+        :param extracted_hash: encoded argon2 hash read from the file header
+
+        Returns True, raises argon2 exceptions on mismatch
+        '''
+        if extracted_hash not in self._verified:
+            self.hashing_obj.verify(extracted_hash, self._passphrase) # raises on mismatch
+            with self._lock:
+                self._verified.add(extracted_hash)
+        return True
+
+    def unlock(self, extracted_hash: str, key_params: dict) -> bytes:
+        '''
+        Function to verify the session password against a file hash and derive its scrypt key,
+        files sharing a salt and KDF parameters are only verified and derived once
+
+        :param extracted_hash: encoded argon2 hash read from the file header
+        :param key_params: scrypt parameters the file was encrypted with
+
+        Returns scrypt key for the file
+        '''
+        cache_key = (extracted_hash, tuple(sorted(key_params.items())))
+        with self._lock:
+            unlock_lock = self._unlock_locks.setdefault(cache_key, Lock())
+        with unlock_lock: # concurrent misses on the same salt wait for a single derivation
+            key = self.key_cache.get(cache_key)
+            if key is None:
+                self.verify(extracted_hash)
+                key = derive_key(self._passphrase, extracted_hash.split('$')[-2], key_params)
+                self.key_cache.put(cache_key, key)
+            return key
+
+    def close(self) -> None:
+        '''
+        Function to wipe the master key and cached keys once the batch is over
+        '''
+        with self._lock:
+            if self._master_key is not None:
+                self._master_key[:] = bytes(len(self._master_key))
+            self._master_key = None
+            self.pass_hash = None
+            self._unlock_locks.clear()
+            self._verified.clear()
+        self.key_cache.clear()
 
 
 class LockByteUser:
@@ -29,28 +253,117 @@ class LockByteUser:
                   "r": 8,
                   "p": 1}
 
+    header_size = 134 # 16-byte IV followed by the 118-byte encoded argon2 hash (version 1)
+
+    buffer_size = 2**20 # default number of bytes read per chunk
+
+    format_version = 4 # container version written by encrypt, see lockbyte.container
+
+    chunk_size = 2**16 # plaintext bytes per authenticated chunk (version 3 and 4)
+
+    workers = None # chunks processed in parallel per file (version 3 and 4), defaults to one per core
+
+    key_slots = 4 # password slots reserved in version 4 headers
+
+    durable = True # fsync output files before renaming them into place
+
+    replace = None # path of an earlier .lockbyte file of the same source, replaced instead of picking a unique name
+
+    flags = 0 # version 3 header flags, see lockbyte.container
+
+    compression = None # codec compressing version 3 payloads before encryption, 'auto' samples the data first
+
+    names = None # lockbyte.atomic.NameAllocator picking output names, shared by the files of a batch
+
     def __init__(self, passphrase: str, **kwargs) -> None:
         '''
         Constructor for LockByte class
 
         :param passphrase: user password to be used for encryption
+        :param buffer_size: (optional) number of bytes read per chunk while encrypting / decrypting
+        :param session: (optional) LockByteSession whose master key is shared by a batch of files
+        :param format_version: (optional) container version to write, only version 1 is readable by earlier releases
+        :param chunk_size: (optional) plaintext bytes per authenticated chunk of version 3 and 4 files
+        :param workers: (optional) number of chunks of a version 3 and 4 file encrypted / decrypted in parallel
+        :param key_slots: (optional) number of passwords a version 4 file can hold, see add_password
+        :param progress: (optional) callback(size) receiving the number of input bytes processed, chunk by chunk
+        :param cancel_event: (optional) threading.Event checked between chunks, OperationCancelled is raised once set
+        :param syncer: (optional) lockbyte.atomic.DirectorySync grouping the folder syncs of a batch
+        :param durable: (optional) fsync output files before renaming them into place
+        :param replace: (optional) path of an earlier .lockbyte file of the same source, replaced when encrypting
+        :param flags: (optional) version 3 header flags describing the payload, e.g. container.FLAG_ARCHIVE
+        :param compression: (optional) 'zlib', 'lzma', 'zstd' (if installed) or 'auto' to compress only data
+                            that shrinks, recorded in the header and undone on decryption
+        :param names: (optional) lockbyte.atomic.NameAllocator shared by a batch, output names are then
+                      allocated without probing the file system and existing files are never replaced
         '''
-        self.salt = urandom(32) # create a random salt
-        self.hashing_obj = PasswordHasher(**self.hashing_params) # create hashing object
-        self.pass_hash = self.hashing_obj.hash(passphrase, salt=self.salt) # generate password hash
+        buffer_size = kwargs.get("buffer_size", self.buffer_size)
+        # keep chunks aligned to the AES block size so that only the final chunk is ever padded
+        self.buffer_size = max(AES.block_size, buffer_size - buffer_size % AES.block_size)
+        self.session = kwargs.get("session")
+        self.version = kwargs.get("format_version", self.format_version)
+        self.chunk_size = kwargs.get("chunk_size", self.chunk_size)
+        self.workers = max(1, kwargs.get("workers", self.workers) or aes_workers())
+        self.progress = kwargs.get("progress")
+        self.cancel_event = kwargs.get("cancel_event")
+        self.syncer = kwargs.get("syncer")
+        self.durable = kwargs.get("durable", self.durable)
+        self.replace = kwargs.get("replace", self.replace)
+        self.flags = kwargs.get("flags", self.flags)
+        self.compression = kwargs.get("compression", self.compression)
+        self.names = kwargs.get("names", self.names)
+        if self.compression == "none":
+            self.compression = None
+        if self.compression not in (None, "auto"):
+            check_codec(self.compression)
+        if self.compression is not None and self.version < 3:
+            raise ValueError("Compression requires format version 3")
+        self.codec = None if self.compression == "auto" else self.compression # decided on the data in auto mode
+        if self.version not in (1, 2, 3, 4):
+            raise ValueError("Unsupported format version: {0}".format(self.version))
+        self.key_slots = kwargs.get("key_slots", self.key_slots)
+        if not 0 < self.key_slots <= MAX_KEY_SLOTS:
+            raise ValueError("Number of key slots must be between 1 and {0}".format(MAX_KEY_SLOTS))
+        if self.version == 1 and self.session is not None:
+            raise ValueError("Version 1 files cannot share a session key")
+        if self.flags & ~KNOWN_FLAGS or (self.flags and self.version < 3):
+            raise ValueError("Unsupported header flags: {0:#x}".format(self.flags))
+        self.nonce = None
+        self.header = None
+        self.aad = None # part of the header authenticated with every chunk
+        self.slot = None # key slot unlocked by the user password (version 4)
+        if self.session is None:
+            self.salt = urandom(32) # create a random salt
+            self.hashing_obj = PasswordHasher(**self.hashing_params) # create hashing object
+            self.pass_hash = self.hashing_obj.hash(passphrase, salt=self.salt) # generate password hash
+        else: # hash and key are derived once per batch by the session
+            self.salt = None
+            self.hashing_obj = self.session.hashing_obj
+            self.pass_hash = None
         self._key = passphrase
         self.cipher = None
 
-    def validate_and_generate(self, mode: int, extracted_hash = None, iv:bytes = None) -> bool:
+    def validate_and_generate(self, mode: int, extracted_hash = None, iv:bytes = None, nonce:bytes = None, key_params:dict = None, version:int = None, slots:list = None) -> bool:
         '''
         Function to validate user password and generate cipher object
 
         :param mode: encryption/decryption
         :param extracted-hash: hash to be compared in case of decryption
         :param iv: initialization vector to be used 
+        :param nonce: per-file nonce of a version 2/3 file, the file key is then derived from the scrypt key
+        :param key_params: scrypt parameters recorded in a version 2/3 file header
+        :param version: container version of the file to be decrypted
+        :param slots: key slots of a version 4 file, the file key is then unwrapped from the slot of the password
         '''
         if mode == 0:  # mode = 0 (decryption), validate user password
-            if not self.hashing_obj.verify(extracted_hash, self._key):
+            self.version = version or 1
+            if slots is not None:
+                self._key = self._open_slots(slots)
+            elif self.session is not None: # reuse keys already derived during this batch
+                self.pass_hash = extracted_hash
+                self.salt = extracted_hash.split('$')[-2]
+                self._key = self.session.unlock(extracted_hash, key_params or self.key_params)
+            elif not self.hashing_obj.verify(extracted_hash, self._key):
                 return False
             else: # verification successful 
                 self.salt = extracted_hash.split('$')[-2]
@@ -59,20 +372,210 @@ class LockByteUser:
                         password=self._key, salt=self.salt)
                 else:
                     self.pass_hash = extracted_hash
+                self._key = derive_key(self._key, self.salt, key_params or self.key_params)
         else: # mode = 1 (encryption)
-            self.salt = self.pass_hash.split('$')[-2]
+            if self.session is not None: # derive per-file keys from the batch master key
+                self.pass_hash, master_key = self.session.master_key()
+                self.salt = self.pass_hash.split('$')[-2]
+                self._key = bytes(master_key)
+                self._key_params = self.session.key_params
+            else:
+                self.salt = self.pass_hash.split('$')[-2]
+                self._key = derive_key(self._key, self.salt, self.key_params)
+                self._key_params = self.key_params
+            if self.version >= 2:
+                nonce = urandom(16)
 
-        self._key = scrypt(password=self._key,
-                           salt=self.salt, **self.key_params)
-        if iv is not None: # set initialization vector if decryption
+        if nonce is not None:
+            self.nonce = nonce
+            self._key = derive_file_key(self._key, nonce)
+        if self.version >= 4 and mode == 1: # the password only wraps a random file key
+            self._wrap_key, self._key = self._key, urandom(32)
+        if self.version >= 3:
+            self.cipher = None # every chunk is sealed by its own AES-GCM cipher object
+        elif iv is not None: # set initialization vector if decryption
             self.cipher = AES.new(self._key, AES.MODE_CBC, iv=iv) # create cipher object
         else:
             self.cipher = AES.new(self._key, AES.MODE_CBC) # create cipher object
 
         return True
 
+    # function to unwrap the file key of a version 4 file
+    def _open_slots(self, slots: list) -> bytes:
+        '''
+        Function to find the key slot of the user password and unwrap the file key from it
+
+        :param slots: key slots read from the file header
+
+        Returns file key, raises argon2 exceptions if no slot matches the password
+        '''
+        mismatch = None
+        for index, key_params, extracted_hash, nonce, wrapped, aad in slots:
+            try:
+                if self.session is not None:
+                    key = self.session.unlock(extracted_hash, key_params)
+                else:
+                    self.hashing_obj.verify(extracted_hash, self._key)
+                    key = derive_key(self._key, extracted_hash.split('$')[-2], key_params)
+            except argon2exceptions.VerifyMismatchError as e: # belongs to another password
+                mismatch = e
+                continue
+            self.pass_hash, self.salt, self.slot = extracted_hash, extracted_hash.split('$')[-2], index
+            return open_key(derive_file_key(key, nonce), nonce, aad, wrapped)
+        raise mismatch
+
+    # function to build a version 4 key slot
+    def _seal_slot(self, wrap_key: bytes, key_params: dict, pass_hash: str, nonce: bytes) -> bytes:
+        '''
+        Function to wrap the file key into a key slot
+
+        :param wrap_key: key derived from the password and the slot nonce
+        :param key_params: scrypt parameters of the password
+        :param pass_hash: encoded argon2 hash of the password
+        :param nonce: random slot nonce
+
+        Returns raw key slot
+        '''
+        fields = KEY_SLOT.pack(int(log2(key_params["N"])), key_params["r"], key_params["p"],
+                               pass_hash.encode("ascii"), nonce, bytes(WRAPPED_KEY_SIZE))[:-WRAPPED_KEY_SIZE]
+        return fields + seal_key(wrap_key, nonce, self.aad + fields, self._key)
+
+    # function to wrap the file key for another password
+    def _new_slot(self, passphrase) -> bytes:
+        '''
+        Function to build the key slot of another password
+
+        :param passphrase: password, or a LockByteSession of it whose key is derived once for several files
+        '''
+        if isinstance(passphrase, LockByteSession):
+            pass_hash, master_key = passphrase.master_key()
+            key_params = passphrase.key_params
+        else:
+            pass_hash = self.hashing_obj.hash(passphrase, salt=urandom(32))
+            key_params = self.key_params
+            master_key = derive_key(passphrase, pass_hash.split('$')[-2], key_params)
+        nonce = urandom(16)
+        return self._seal_slot(derive_file_key(bytes(master_key), nonce), key_params, pass_hash, nonce)
+
+    # function to repair a header torn by an interrupted rewrite
+    @staticmethod
+    def _recover_header(file, backup: str) -> None:
+        '''
+        Function to check the header of a version 4 file against the backup of an earlier rewrite. Only a header
+        that is neither the old nor the new one was torn by the rewrite and gets the old one back, a stale
+        backup of a rewrite that completed (or never started) is deleted without being trusted
+
+        :param file: encrypted file opened for reading and writing, positioned at its start
+        :param backup: path to the backup, the old header followed by the new one
+        '''
+        with open(backup, "rb") as f:
+            saved = f.read()
+        size = len(saved) // 2
+        old, new = saved[:size], saved[size:]
+        live = read_exact(file, size)
+        file.seek(0)
+        if size and len(saved) == 2 * size and live not in (old, new):
+            file.write(old)
+            file.flush()
+            fsync(file.fileno())
+            file.seek(0)
+        osremove(backup)
+
+    # function to rewrite the key slots of a version 4 file
+    def _rewrite_slots(self, file_path: str, edit):
+        '''
+        Function to unlock a version 4 file with the user password and rewrite its key slots in place.
+        The old and new headers are saved to the state folder until the new one is durable, if the rewrite
+        is interrupted the next rewrite puts the old header back
+
+        :param file_path: path to the encrypted file
+        :param edit: callback(header, slots) changing the raw header (bytearray), its result is returned
+
+        Returns result of edit
+        '''
+        backup = header_backup_path(file_path)
+        with open(file_path, "r+b") as file:
+            if ospath.isfile(backup):
+                self._recover_header(file, backup)
+            fields = self._read_header(file)
+            if fields.get("version") != 4:
+                raise KeySlotError("passwords can only be changed in place in version 4 files, "
+                                   "decrypt and encrypt the file again instead")
+            self.validate_and_generate(0, **fields)
+            header = bytearray(self.header)
+            result = edit(header, fields["slots"])
+            makedirs(ospath.dirname(backup), exist_ok=True)
+            with atomic_write(backup) as f:
+                f.write(self.header + header)
+            file.seek(0)
+            file.write(header)
+            file.flush()
+            fsync(file.fileno())
+        osremove(backup)
+        self.header = bytes(header)
+        return result
+
+    # function to locate a key slot in a version 4 header
+    @staticmethod
+    def _slot_range(index: int) -> slice:
+        start = HEADER_V4.size + index * KEY_SLOT.size
+        return slice(start, start + KEY_SLOT.size)
+
+    # password change function
+    def change_password(self, file_path: str, new_passphrase: str) -> int:
+        '''
+        Function to replace the user password of a version 4 file, only the header is rewritten
+        whatever the size of the file
+
+        :param file_path: path to the encrypted file
+        :param new_passphrase: password replacing the user password, or a LockByteSession of it
+
+        Returns index of the key slot rewritten
+        '''
+        def edit(header, slots):
+            header[self._slot_range(self.slot)] = self._new_slot(new_passphrase)
+            return self.slot
+        return self._rewrite_slots(file_path, edit)
+
+    # password addition function
+    def add_password(self, file_path: str, new_passphrase: str) -> int:
+        '''
+        Function to let another password decrypt a version 4 file, the user password keeps working
+
+        :param file_path: path to the encrypted file
+        :param new_passphrase: password to be added, or a LockByteSession of it
+
+        Returns index of the new key slot, raises KeySlotError if every slot is in use
+        '''
+        def edit(header, slots):
+            used = {slot[0] for slot in slots}
+            free = [index for index in range((len(header) - HEADER_V4.size) // KEY_SLOT.size) if index not in used]
+            if not free:
+                raise KeySlotError("every key slot of the file is in use, remove a password first")
+            header[self._slot_range(free[0])] = self._new_slot(new_passphrase)
+            return free[0]
+        return self._rewrite_slots(file_path, edit)
+
+    # password removal function
+    def remove_password(self, file_path: str) -> int:
+        '''
+        Function to stop the user password from decrypting a version 4 file, other passwords keep working
+
+        :param file_path: path to the encrypted file
+
+        Returns index of the key slot cleared, raises KeySlotError for the only password of the file
+        '''
+        def edit(header, slots):
+            if len(slots) == 1:
+                raise KeySlotError("the only password of the file cannot be removed")
+            header[self._slot_range(self.slot)] = bytes(KEY_SLOT.size)
+            return self.slot
+        return self._rewrite_slots(file_path, edit)
+
     # fubction to generate unique file names
     def get_unique_name(self, f:str):
+        if self.names is not None: # reserved in memory, released if the output is never written
+            return self.names.claim(f)
         fnew = f
         root, ext = ospath.splitext(f)
         i = 0
@@ -81,48 +584,395 @@ class LockByteUser:
             fnew = '%s(%i)%s' % (root, i, ext)
         return fnew
 
+    # function to encrypt a stream chunk by chunk
+    def _encrypt_chunks(self, src, dst) -> None:
+        '''
+        Function to encrypt the contents of a stream chunk by chunk in the format of the file header
+
+        :param src: readable binary stream holding the plaintext
+        :param dst: writable binary stream receiving the ciphertext
+        '''
+        if self.version >= 3 and self.codec is not None:
+            self._encrypt_compressed(src, dst)
+        elif self.version >= 3:
+            encrypt_chunks(self._key, self.aad, src, dst, self.chunk_size, self.workers, self.progress,
+                           self.cancel_event)
+        else:
+            self._encrypt_cbc(src, dst)
+
+    # function to decrypt a stream chunk by chunk
+    def _decrypt_chunks(self, src, dst) -> None:
+        '''
+        Function to decrypt the contents of a stream chunk by chunk in the format of the file header
+
+        :param src: readable binary stream positioned at the start of the ciphertext
+        :param dst: writable binary stream receiving the plaintext
+        '''
+        if self.version >= 3 and self.codec is not None:
+            self._decrypt_compressed(src, dst)
+        elif self.version >= 3:
+            decrypt_chunks(self._key, self.aad, src, dst, self.chunk_size, self.workers, self.progress,
+                           self.cancel_event)
+        else:
+            self._decrypt_cbc(src, dst)
+
+    # function to compress a stream into a pipe
+    def _compress(self, src, write_fd: int) -> None:
+        '''
+        Function to compress a stream into the write end of a pipe, runs on its own thread
+        so that compression overlaps with encryption
+
+        :param src: readable binary stream holding the plaintext
+        :param write_fd: write end of the pipe, closed once done
+        '''
+        codec = compressor(self.codec)
+        view = memoryview(bytearray(self.chunk_size))
+        with open(write_fd, "wb") as dst:
+            while True:
+                size = readinto_exact(src, view)
+                if size:
+                    dst.write(codec.compress(view[:size]))
+                    if self.progress is not None:
+                        self.progress(size)
+                if size < len(view):
+                    break
+            dst.write(codec.flush())
+
+    # function to encrypt a compressed stream
+    def _encrypt_compressed(self, src, dst) -> None:
+        '''
+        Function to compress a stream on a separate thread and encrypt the compressed stream as it is produced
+
+        :param src: readable binary stream holding the plaintext
+        :param dst: writable binary stream receiving the ciphertext
+        '''
+        read_fd, write_fd = pipe()
+        with open(read_fd, "rb") as compressed:
+            thread, errors = run_in_thread(self._compress, src, write_fd)
+            try: # progress is reported by the compressor, in plaintext bytes
+                encrypt_chunks(self._key, self.aad, compressed, dst, self.chunk_size, self.workers, None,
+                               self.cancel_event)
+            finally:
+                compressed.close() # unblocks the compressor if encryption stopped early
+                thread.join()
+        if errors: # the compressed stream ended early
+            raise errors[0]
+
+    # function to decrypt into a pipe
+    def _decrypt_to_pipe(self, src, write_fd: int) -> None:
+        with open(write_fd, "wb") as dst:
+            decrypt_chunks(self._key, self.aad, src, dst, self.chunk_size, self.workers, self.progress,
+                           self.cancel_event)
+
+    # function to decrypt a compressed stream
+    def _decrypt_compressed(self, src, dst) -> None:
+        '''
+        Function to decrypt a stream on a separate thread and decompress the result as it is produced
+
+        :param src: readable binary stream positioned at the start of the ciphertext
+        :param dst: writable binary stream receiving the plaintext
+        '''
+        read_fd, write_fd = pipe()
+        with open(read_fd, "rb") as compressed:
+            thread, errors = run_in_thread(self._decrypt_to_pipe, src, write_fd)
+            try:
+                codec = decompressor(self.codec)
+                while True:
+                    data = compressed.read(self.chunk_size)
+                    if not data:
+                        break
+                    if getattr(codec, "eof", False):
+                        raise ValueError("Data after the end of the compressed stream")
+                    dst.write(codec.decompress(data))
+                if not getattr(codec, "eof", True) or getattr(codec, "unused_data", b""):
+                    raise ValueError("Compressed stream is truncated or corrupt")
+            except BaseException as e:
+                compressed.close() # unblocks the decryption thread
+                thread.join()
+                # e.g. a tampered chunk is more telling than the broken compressed stream it caused,
+                # but a failed write (e.g. a full disk) is the cause of the broken pipe the thread saw
+                raise pipeline_error(errors, e)
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    # function to stop between two chunks once cancelled
+    def _check_cancelled(self) -> None:
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise OperationCancelled()
+
+    # function to encrypt a CBC stream chunk by chunk
+    def _encrypt_cbc(self, src, dst) -> None:
+        '''
+        Function to encrypt the contents of a stream in fixed-size chunks, padding only the final chunk.
+        Chunks are read into and encrypted within one reusable buffer
+
+        :param src: readable binary stream holding the plaintext
+        :param dst: writable binary stream receiving the ciphertext
+        '''
+        view = memoryview(bytearray(self.buffer_size + AES.block_size)) # spare block for the padding
+        while True:
+            self._check_cancelled()
+            size = readinto_exact(src, view[:self.buffer_size])
+            if size < self.buffer_size: # end of stream
+                break
+            self.cipher.encrypt(view[:size], output=view[:size])
+            dst.write(view[:size])
+            if self.progress is not None:
+                self.progress(size)
+        padding = AES.block_size - size % AES.block_size # PKCS#7
+        view[size:size + padding] = bytes([padding]) * padding
+        self.cipher.encrypt(view[:size + padding], output=view[:size + padding])
+        dst.write(view[:size + padding])
+        if self.progress is not None:
+            self.progress(size)
+
+    # function to decrypt a CBC stream chunk by chunk
+    def _decrypt_cbc(self, src, dst) -> None:
+        '''
+        Function to decrypt the contents of a stream in fixed-size chunks, unpadding only the final block.
+        Chunks are read into and decrypted within one reusable buffer
+
+        :param src: readable binary stream positioned at the start of the ciphertext
+        :param dst: writable binary stream receiving the plaintext
+        '''
+        buffer_size = max(self.buffer_size, 2 * AES.block_size)
+        view = memoryview(bytearray(buffer_size))
+        carry = 0
+        while True:
+            self._check_cancelled()
+            size = carry + readinto_exact(src, view[carry:])
+            if size < buffer_size: # end of stream
+                break
+            # always hold back the last complete block, it carries the padding
+            end = size - AES.block_size
+            self.cipher.decrypt(view[:end], output=view[:end])
+            dst.write(view[:end])
+            if self.progress is not None:
+                self.progress(end)
+            view[:AES.block_size] = view[end:size]
+            carry = AES.block_size
+        if size == 0 or size % AES.block_size:
+            raise ValueError("Ciphertext length is not a multiple of the block size")
+        self.cipher.decrypt(view[:size], output=view[:size])
+        dst.write(view[:size - AES.block_size])
+        dst.write(unpad(view[size - AES.block_size:size].tobytes(), AES.block_size, 'pkcs7'))
+        if self.progress is not None:
+            self.progress(size)
+
+    # function to write the file header
+    def _write_header(self, dst) -> None:
+        '''
+        Function to write the header of an encrypted file in the configured format version
+
+        :param dst: writable binary stream receiving the header
+        '''
+        params = self._key_params
+        self.aad = None
+        if self.version == 1:
+            self.header = self.cipher.iv + self.pass_hash.encode("ascii")
+        elif self.version == 2:
+            self.header = HEADER_V2.pack(FORMAT_MAGIC, 2, int(log2(params["N"])), params["r"], params["p"],
+                                         self.pass_hash.encode("ascii"), self.nonce, self.cipher.iv)
+        elif self.version == 3:
+            flags = self.flags & ~FLAG_CODEC_MASK | codec_flags(self.codec)
+            self.header = HEADER_V3.pack(FORMAT_MAGIC, 3, flags, int(log2(params["N"])), params["r"], params["p"],
+                                         self.chunk_size, self.pass_hash.encode("ascii"), self.nonce)
+        else:
+            flags = self.flags & ~FLAG_CODEC_MASK | codec_flags(self.codec)
+            self.aad = HEADER_V4.pack(FORMAT_MAGIC, 4, flags, self.key_slots, self.chunk_size)
+            self.header = (self.aad + self._seal_slot(self._wrap_key, params, self.pass_hash, self.nonce)
+                           + bytes(KEY_SLOT.size * (self.key_slots - 1)))
+        self.aad = self.aad or self.header
+        dst.write(self.header)
+
+    # function to read the file header
+    def _read_header(self, src) -> dict:
+        '''
+        Function to read and parse the header of an encrypted file
+
+        :param src: readable binary stream positioned at the start of the file
+
+        Returns dict of header fields, keyword arguments to validate_and_generate
+        '''
+        header = read_exact(src, self.header_size)
+        if self.progress is not None:
+            self.progress(len(header))
+        self.flags, self.codec = 0, None
+        if header[:len(FORMAT_MAGIC)] != FORMAT_MAGIC: # version 1 files start with a random IV
+            self.header = self.aad = header
+            return {"extracted_hash": header[16:self.header_size].decode("ascii"), "iv": header[:16]}
+        version = header[len(FORMAT_MAGIC)]
+        if version == 4:
+            return self._read_slots(src, header)
+        layout = {2: HEADER_V2, 3: HEADER_V3}.get(version)
+        if layout is None:
+            raise ValueError("Unsupported file format version: {0}".format(version))
+        header += read_exact(src, layout.size - len(header))
+        if self.progress is not None:
+            self.progress(layout.size - self.header_size)
+        if len(header) != layout.size:
+            raise ValueError("Encrypted file is truncated")
+        self.header = self.aad = header
+        if version == 2:
+            _, _, log_n, r, p, extracted_hash, nonce, iv = HEADER_V2.unpack(header)
+        else:
+            _, _, self.flags, log_n, r, p, self.chunk_size, extracted_hash, nonce = HEADER_V3.unpack(header)
+            iv = None
+            if self.flags & ~KNOWN_FLAGS or self.chunk_size == 0:
+                raise ValueError("Unsupported file header")
+            self.codec = codec_from_flags(self.flags)
+        key_params = {"key_len": 32, "N": 2**log_n, "r": r, "p": p}
+        return {"extracted_hash": extracted_hash.decode("ascii"), "iv": iv, "nonce": nonce,
+                "key_params": key_params, "version": version}
+
+    # function to read the key slots of a version 4 header
+    def _read_slots(self, src, header: bytes) -> dict:
+        '''
+        Function to read the rest of a version 4 header and parse its key slots
+
+        :param src: readable binary stream positioned after the first header_size bytes
+        :param header: first header_size bytes of the file
+
+        Returns dict of header fields, keyword arguments to validate_and_generate
+        '''
+        _, _, self.flags, count, self.chunk_size = HEADER_V4.unpack(header[:HEADER_V4.size])
+        if self.flags & ~KNOWN_FLAGS or self.chunk_size == 0 or not 0 < count <= MAX_KEY_SLOTS:
+            raise ValueError("Unsupported file header")
+        size = HEADER_V4.size + count * KEY_SLOT.size
+        header += read_exact(src, size - len(header))
+        if self.progress is not None:
+            self.progress(size - self.header_size)
+        if len(header) != size:
+            raise ValueError("Encrypted file is truncated")
+        self.header, self.aad = header, header[:HEADER_V4.size]
+        self.codec = codec_from_flags(self.flags)
+        slots = []
+        for index in range(count):
+            raw = header[self._slot_range(index)]
+            log_n, r, p, extracted_hash, nonce, wrapped = KEY_SLOT.unpack(raw)
+            if log_n == 0: # unused, must stay blank
+                if any(raw):
+                    raise ValueError("Unsupported file header")
+                continue
+            key_params = {"key_len": 32, "N": 2**log_n, "r": r, "p": p}
+            slots.append((index, key_params, extracted_hash.decode("ascii"), nonce, wrapped,
+                          self.aad + raw[:-WRAPPED_KEY_SIZE]))
+        if not slots:
+            raise ValueError("Unsupported file header")
+        return {"slots": slots, "version": 4}
+
+    # header-only password check
+    def verify_password(self, file) -> bool:
+        '''
+        Function to check the user password against the header of an encrypted file.
+        Only the header is read and no key is derived, so a wrong password fails without touching the file contents
+
+        :param file: open file object of the encrypted file
+
+        Returns True, raises argon2 exceptions on mismatch
+        '''
+        fields = self._read_header(file)
+        if "slots" in fields: # any password of the file will do
+            hashes = [slot[2] for slot in fields["slots"]]
+        else:
+            hashes = [fields["extracted_hash"]]
+        mismatch = None
+        for extracted_hash in hashes:
+            try:
+                if self.session is not None:
+                    return self.session.verify(extracted_hash)
+                return self.hashing_obj.verify(extracted_hash, self._key)
+            except argon2exceptions.VerifyMismatchError as e:
+                mismatch = e
+        raise mismatch
+
+    # stream encryption function
+    def encrypt_stream(self, src, dst) -> None:
+        '''
+        Function to encrypt any readable binary stream into any writable binary stream, header included.
+        Neither stream needs to be seekable and memory use does not depend on the stream length,
+        validate_and_generate(1) has to be called first as for encrypt
+
+        :param src: readable binary stream holding the plaintext, e.g. sys.stdin.buffer
+        :param dst: writable binary stream receiving the encrypted contents, e.g. sys.stdout.buffer
+        '''
+        if self.compression == "auto": # decided before the header is written, the codec is recorded in it
+            sample = read_exact(src, SAMPLE_SIZE)
+            self.codec = choose_codec(sample)
+            src = PrefixedReader(sample, src)
+        self._write_header(dst)
+        self._encrypt_chunks(src, dst)
+
+    # stream decryption function
+    def decrypt_stream(self, src, dst) -> None:
+        '''
+        Function to decrypt any readable binary stream into any writable binary stream.
+        Neither stream needs to be seekable and memory use does not depend on the stream length
+
+        :param src: readable binary stream positioned at the start of the encrypted contents
+        :param dst: writable binary stream receiving the plaintext
+        '''
+        if self.validate_and_generate(0, **self._read_header(src)):
+            self._decrypt_chunks(src, dst)
+
     # encryption function
-    def encrypt(self, file, file_path: str) -> None:
+    def encrypt(self, file, file_path: str) -> str:
         '''
         Function to handle encryption process
 
         :param file: open file object of the file to be encrypted
         :param file_path: path to file to be encrypted
+
+        Returns encrypted file path
         '''
         try:
-            file_content = file.read()
-            en_file = self.cipher.encrypt(pad(file_content, AES.block_size, 'pkcs7'))
-            iv = self.cipher.iv
-            file_name_new = file_path + ".lockbyte"
-            file_name_new = self.get_unique_name(file_name_new)
-            with open(file_name_new, "wb") as ef:
-                ef.write(iv)
-                ef.write(self.pass_hash.encode("ascii"))
-                ef.write(en_file)
+            if self.replace is not None:
+                file_name_new = self.replace
+            else:
+                file_name_new = self.get_unique_name(file_path + ".lockbyte")
+            names = self.names if self.replace is None else None
+            # written to a temporary file renamed into place once complete, never a truncated .lockbyte file
+            writer = atomic_write(file_name_new, self.syncer, self.durable, names=names)
+            try:
+                with writer as ef:
+                    self.encrypt_stream(file, ef)
+            except BaseException:
+                if names is not None:
+                    names.release(writer.file_path)
+                raise
+            return writer.file_path
         except:
             raise
 
     # decryption function
-    def decrypt(self, file, file_path: str) -> str:
+    def decrypt(self, file, file_path: str, output = None) -> str:
         '''
         Function to handle decrytion process
 
         :param file: open file object of the file to be decrypted
         :param file_path: path to file to be decrypted
+        :param output: (optional) writable binary stream receiving the plaintext instead of a new file
 
-        Returns decrypted file path
+        Returns decrypted file path (None if written to output)
         '''
         try:
-            file_content = file.read()
-            iv = file_content[:16]
-            extracted_hash = file_content[16:134].decode("ascii")
-            if self.validate_and_generate(0, extracted_hash, iv):
-                de_file = unpad(self.cipher.decrypt(
-                    file_content[134:]), AES.block_size, 'pkcs7')
+            if output is not None:
+                self.decrypt_stream(file, output)
+                return None
+            if self.validate_and_generate(0, **self._read_header(file)):
                 file_name_new = file_path.split('.')[-3]+"_decrypted"+'.'+file_path.split('.')[-2].split('(')[0]
                 file_name_new = self.get_unique_name(file_name_new)
-                with open(file_name_new, "wb") as df:
-                    df.write(de_file)
+                # do not leave partially decrypted output behind
+                writer = atomic_write(file_name_new, self.syncer, self.durable, names=self.names)
+                try:
+                    with writer as df:
+                        self._decrypt_chunks(file, df)
+                except BaseException:
+                    if self.names is not None:
+                        self.names.release(writer.file_path)
+                    raise
+                file_name_new = writer.file_path
             return file_name_new
         except:
-            raise
\ No newline at end of file
+            raise
@@ -0,0 +1,186 @@
+# ====================================================================
+# This file is part of LockByte.
+# LockByte is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3 of the License.
+# LockByte is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with LockByte. If not, see <https://www.gnu.org/licenses/>.
+# ====================================================================
+
+from os import stat, makedirs, remove as osremove, path as ospath
+from hashlib import blake2b, sha256
+from threading import Lock
+import json
+
+from lockbyte.atomic import atomic_write
+from lockbyte.journal import state_dir, file_signature
+
+
+# function to name the manifest of a folder
+def manifest_path(folder: str) -> str:
+    '''
+    Function to build the manifest path of a folder, kept in the per-user state folder so that
+    file names and content hashes are never stored in plain text next to the encrypted files
+
+    :param folder: path to the folder encrypted incrementally
+
+    Returns path to the manifest file
+    '''
+    key = ospath.abspath(folder).encode("utf-8", "surrogateescape")
+    return ospath.join(state_dir(), "manifests", sha256(key).hexdigest()[:32] + ".json")
+
+
+# function to hash the contents of a file
+def file_digest(file_path: str, block_size: int = 2**20) -> str:
+    '''
+    Function to compute a fast 128-bit BLAKE2b hash of the contents of a file
+
+    :param file_path: path to file
+    :param block_size: number of bytes read at a time
+
+    Returns hex digest
+    '''
+    digest = blake2b(digest_size=16)
+    buffer = memoryview(bytearray(block_size))
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            digest.update(buffer[:size])
+    return digest.hexdigest()
+
+
+class Manifest:
+    '''
+    Class to remember the size, modification time and content hash of every source encrypted from a folder
+    along with its .lockbyte output and the password hash it was encrypted with, so that later runs only encrypt
+    new or changed files
+    '''
+
+    version = 1
+
+    def __init__(self, file_path: str) -> None:
+        '''
+        Constructor for Manifest class, loads an existing manifest
+
+        :param file_path: path to the manifest file
+        '''
+        self.file_path = file_path
+        self._lock = Lock()
+        self._entries = {} # source path -> entry
+        self._seen = set() # sources found by the current run
+        self._dirty = False
+        if ospath.isfile(file_path):
+            with open(file_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.version:
+                self._entries = data.get("files", {})
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def unchanged(self, file_path: str, key_check=None) -> bool:
+        '''
+        Function to check whether a source is unchanged since it was last encrypted and its output is intact.
+        Only the metadata is compared unless the modification time changed but the size did not,
+        the contents are hashed then, e.g. for files copied or touched without being modified
+
+        :param file_path: path to source file
+        :param key_check: (optional) callback(key) telling whether the password hash recorded for the source
+                          belongs to the current password, sources encrypted with another password are changed
+        '''
+        file_path = ospath.abspath(file_path)
+        with self._lock:
+            self._seen.add(file_path)
+            entry = self._entries.get(file_path)
+        if entry is None:
+            return False
+        if key_check is not None and not key_check(entry.get("key")):
+            return False
+        source = file_signature(file_path)
+        if source is None or source[0] != entry["size"]:
+            return False
+        if file_signature(entry["output"]) != entry["output_signature"]:
+            return False # output deleted or modified, encrypt again
+        if source[1] == entry["mtime"]:
+            return True
+        try:
+            if file_digest(file_path) != entry["hash"]:
+                return False
+        except OSError:
+            return False
+        with self._lock:
+            entry["mtime"] = source[1]
+            self._dirty = True
+        return True
+
+    def previous_output(self, file_path: str) -> str:
+        '''
+        Function to find the output an earlier run wrote for a source, only if it is still the file written then
+
+        :param file_path: path to source file
+
+        Returns path to the .lockbyte file or None, e.g. for new sources or outputs replaced by other files
+        '''
+        with self._lock:
+            entry = self._entries.get(ospath.abspath(file_path))
+        if entry is None or file_signature(entry["output"]) != entry["output_signature"]:
+            return None
+        return entry["output"]
+
+    def record(self, file_path: str, output: str, digest: str, key: str = None) -> None:
+        '''
+        Function to record an encrypted source
+
+        :param file_path: path to source file
+        :param output: path to its .lockbyte file
+        :param digest: file_digest of the source, taken before it was encrypted
+        :param key: encoded argon2 hash of the password the source was encrypted with
+        '''
+        try:
+            info = stat(file_path)
+        except OSError: # deleted meanwhile, nothing to compare with next time
+            return
+        entry = {"size": info.st_size, "mtime": info.st_mtime_ns, "hash": digest, "key": key,
+                 "output": ospath.abspath(output), "output_signature": file_signature(output)}
+        with self._lock:
+            self._entries[ospath.abspath(file_path)] = entry
+            self._seen.add(ospath.abspath(file_path))
+            self._dirty = True
+
+    def prune(self) -> list:
+        '''
+        Function to delete the outputs of sources that no longer exist, only call it once the whole folder
+        has been scanned. Outputs modified since they were written are kept
+
+        Returns list of deleted output paths
+        '''
+        removed = []
+        with self._lock:
+            stale = [file_path for file_path in self._entries if file_path not in self._seen]
+        for file_path in stale:
+            if ospath.lexists(file_path): # not part of this run, e.g. filtered out
+                continue
+            entry = self._entries[file_path]
+            if file_signature(entry["output"]) == entry["output_signature"]:
+                try:
+                    osremove(entry["output"])
+                    removed.append(entry["output"])
+                except OSError:
+                    continue
+            with self._lock:
+                del self._entries[file_path]
+                self._dirty = True
+        return removed
+
+    def save(self) -> None:
+        '''
+        Function to write the manifest atomically, if anything changed
+        '''
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({"version": self.version, "files": self._entries})
+            self._dirty = False
+        makedirs(ospath.dirname(ospath.abspath(self.file_path)), exist_ok=True)
+        with atomic_write(self.file_path) as f:
+            f.write(data.encode("utf-8"))
@@ -0,0 +1,158 @@
+# ====================================================================
+# This file is part of LockByte.
+# LockByte is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3 of the License.
+# LockByte is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with LockByte. If not, see <https://www.gnu.org/licenses/>.
+# ====================================================================
+
+from io import RawIOBase, SEEK_SET, SEEK_CUR, SEEK_END
+from os import fstat
+
+from lockbyte.lock_unlock import LockByteUser, LockByteSession
+from lockbyte.container import TAG_SIZE, readinto_exact, open_chunk
+
+
+class EncryptedReader(RawIOBase):
+    '''
+    Class to read byte ranges of a version 3 or 4 .lockbyte file, decrypting only the chunks covering the range
+    '''
+
+    def __init__(self, file, passphrase: str, session: LockByteSession = None) -> None:
+        '''
+        Constructor for EncryptedReader class
+
+        :param file: seekable binary file object of the encrypted file, closed along with the reader
+        :param passphrase: user password
+        :param session: (optional) LockByteSession shared by several readers
+        '''
+        super().__init__()
+        self._file = file
+        user = LockByteUser(passphrase, session=session, workers=1)
+        user.validate_and_generate(0, **user._read_header(file))
+        if user.version < 3:
+            raise ValueError("Random access requires format version 3, decrypt the whole file instead")
+        if user.codec is not None:
+            raise ValueError("Random access is not possible on compressed files, decrypt the whole file instead")
+        self._key = user._key
+        self._aad = user.aad
+        self._offset = len(user.header)
+        self.chunk_size = user.chunk_size
+        self.flags = user.flags
+
+        # the chunk layout is fixed, so the size of the file is the index:
+        # every chunk but the last holds chunk_size bytes, the last one is always shorter
+        record_size = self.chunk_size + TAG_SIZE
+        payload = fstat(file.fileno()).st_size - self._offset
+        full_chunks, last_record = divmod(payload, record_size)
+        if last_record < TAG_SIZE:
+            raise ValueError("Encrypted file is truncated")
+        self.chunks = full_chunks + 1
+        self.size = full_chunks * self.chunk_size + last_record - TAG_SIZE
+        self._position = 0
+        self._record = memoryview(bytearray(record_size)) # reused by every chunk read
+        self._cached_index = None
+        self._cached_chunk = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+        '''
+        Function to move the read position, no data is decrypted until the next read
+
+        :param offset: offset relative to whence
+        :param whence: SEEK_SET, SEEK_CUR or SEEK_END
+        '''
+        if whence == SEEK_SET:
+            position = offset
+        elif whence == SEEK_CUR:
+            position = self._position + offset
+        elif whence == SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence: {0}".format(whence))
+        if position < 0:
+            raise ValueError("Negative seek position {0}".format(position))
+        self._position = position
+        return position
+
+    # function to decrypt a single chunk
+    def _chunk(self, index: int) -> memoryview:
+        '''
+        Function to read, authenticate and decrypt a single chunk, the last chunk read is kept
+
+        :param index: position of the chunk in the file
+        '''
+        if index != self._cached_index:
+            record_size = self.chunk_size + TAG_SIZE
+            self._file.seek(self._offset + index * record_size)
+            size = readinto_exact(self._file, self._record)
+            self._cached_index = None # the buffer is overwritten below, even if the chunk fails to open
+            self._cached_chunk = open_chunk(self._key, self._aad, index, index == self.chunks - 1,
+                                            self._record[:size])
+            self._cached_index = index
+        return self._cached_chunk
+
+    def readinto(self, buffer) -> int:
+        '''
+        Function to read from the current position into a writable buffer
+
+        :param buffer: writable bytes-like object
+
+        Returns number of bytes read, 0 at the end of the file
+        '''
+        view = memoryview(buffer).cast("B")
+        count = 0
+        while count < len(view) and self._position < self.size:
+            index, start = divmod(self._position, self.chunk_size)
+            chunk = self._chunk(index)
+            length = min(len(chunk) - start, len(view) - count)
+            view[count:count + length] = chunk[start:start + length]
+            count += length
+            self._position += length
+        return count
+
+    # function to read a byte range
+    def read_at(self, offset: int, length: int) -> bytes:
+        '''
+        Function to read a byte range of the plaintext, time spent is proportional to the length of the range
+
+        :param offset: position of the first byte
+        :param length: number of bytes to read
+
+        Returns the bytes read, shorter than length at the end of the file
+        '''
+        self.seek(offset)
+        return self.read(length)
+
+    def close(self) -> None:
+        if not self.closed:
+            self._file.close()
+            self._key = None
+            self._cached_chunk = b""
+        super().close()
+
+
+# function to open an encrypted file for random access
+def open_encrypted(file_path: str, passphrase: str, session: LockByteSession = None) -> EncryptedReader:
+    '''
+    Function to open a .lockbyte file for reading byte ranges without decrypting the whole file
+
+    :param file_path: path to the encrypted file
+    :param passphrase: user password
+    :param session: (optional) LockByteSession shared by several readers
+
+    Returns seekable read-only file object of the plaintext
+    '''
+    file = open(file_path, "rb")
+    try:
+        return EncryptedReader(file, passphrase, session)
+    except:
+        file.close()
+        raise
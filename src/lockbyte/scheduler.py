@@ -0,0 +1,155 @@
+# ====================================================================
+# This file is part of LockByte.
+# LockByte is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3 of the License.
+# LockByte is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with LockByte. If not, see <https://www.gnu.org/licenses/>.
+# ====================================================================
+
+from threading import Condition
+from contextlib import contextmanager
+from platform import system
+import os
+
+
+# function to read the amount of memory available to this process
+def available_memory() -> int:
+    '''
+    Function to read the physical memory currently available, honouring cgroup (container) limits
+
+    Returns available memory in bytes or None if it cannot be determined
+    '''
+    available = None
+    try:
+        if system() == 'Windows':
+            import ctypes
+
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [("dwLength", ctypes.c_ulong),
+                            ("dwMemoryLoad", ctypes.c_ulong),
+                            ("ullTotalPhys", ctypes.c_ulonglong),
+                            ("ullAvailPhys", ctypes.c_ulonglong),
+                            ("ullTotalPageFile", ctypes.c_ulonglong),
+                            ("ullAvailPageFile", ctypes.c_ulonglong),
+                            ("ullTotalVirtual", ctypes.c_ulonglong),
+                            ("ullAvailVirtual", ctypes.c_ulonglong),
+                            ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                available = status.ullAvailPhys
+        elif os.path.isfile("/proc/meminfo"):
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        available = int(line.split()[1]) * 1024
+                        break
+        else:
+            available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    # containers may be capped well below the memory of the host
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        if limit != "max":
+            with open("/sys/fs/cgroup/memory.current") as f:
+                headroom = max(0, int(limit) - int(f.read().strip()))
+            available = headroom if available is None else min(available, headroom)
+    except (OSError, ValueError):
+        pass
+    return available
+
+
+# function to compute the memory needed by one scrypt derivation
+def scrypt_memory(key_params: dict) -> int:
+    '''
+    Function to compute the memory used by a single scrypt derivation (128 * r * (N + p) bytes)
+
+    :param key_params: scrypt parameters
+    '''
+    return 128 * key_params["r"] * (key_params["N"] + key_params["p"])
+
+
+# function to size the pool running AES work
+def aes_workers() -> int:
+    '''
+    Function to compute the number of workers used for AES work, one per available core
+    '''
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return max(1, os.cpu_count() or 1)
+
+
+class KDFScheduler:
+    '''
+    Class to limit concurrent scrypt derivations to what the available memory can hold
+    '''
+    fallback_slots = 2 # concurrency used when available memory cannot be determined
+
+    def __init__(self, max_slots: int = None, headroom: float = 1.25) -> None:
+        '''
+        Constructor for KDFScheduler class
+
+        :param max_slots: (optional) fixed upper bound on concurrent derivations
+        :param headroom: factor of extra memory required per derivation
+        '''
+        self.max_slots = max_slots
+        self.headroom = headroom
+        self._cond = Condition()
+        self._active = 0
+        self._capacity = 1
+        self._shared = None
+
+    def attach(self, semaphore) -> None:
+        '''
+        Function to hand slot accounting over to a semaphore shared with other processes
+
+        :param semaphore: multiprocessing semaphore sized by the parent process
+        '''
+        self._shared = semaphore
+
+    def capacity(self, key_params: dict) -> int:
+        '''
+        Function to compute how many derivations fit into the currently available memory
+
+        :param key_params: scrypt parameters of the derivation
+        '''
+        available = available_memory()
+        if available is None:
+            slots = self.fallback_slots
+        else:
+            slots = int(available // (scrypt_memory(key_params) * self.headroom))
+        slots = min(slots, aes_workers())
+        if self.max_slots is not None:
+            slots = min(slots, self.max_slots)
+        return max(1, slots)
+
+    @contextmanager
+    def slot(self, key_params: dict):
+        '''
+        Context manager to hold a derivation slot, blocking while memory is fully committed
+
+        :param key_params: scrypt parameters of the derivation
+        '''
+        if self._shared is not None:
+            with self._shared:
+                yield
+            return
+        with self._cond:
+            if self._active == 0: # measure while no derivation holds memory
+                self._capacity = self.capacity(key_params)
+            while self._active >= self._capacity:
+                self._cond.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify()
+
+
+kdf_scheduler = KDFScheduler()
@@ -0,0 +1,31 @@
+import pytest
+
+from lockbyte import lock_unlock
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path_factory, monkeypatch):
+    # batch journals are kept out of the home folder of whoever runs the tests
+    path = tmp_path_factory.mktemp("state")
+    monkeypatch.setenv("LOCKBYTE_STATE_DIR", str(path))
+    return path
+
+
+@pytest.fixture
+def fast_kdf(monkeypatch):
+    # scrypt with N=2**20 needs ~1 GiB per call, a cheaper cost keeps the suite fast
+    monkeypatch.setattr(lock_unlock.LockByteUser, "key_params",
+                        dict(lock_unlock.LockByteUser.key_params, N=2**14))
+
+
+@pytest.fixture
+def tree(tmp_path):
+    # small folder tree with files in nested sub folders
+    contents = {}
+    for i, rel_path in enumerate(["a.txt", "b.csv", "sub/c.txt", "sub/deeper/d.log", "sub/deeper/e.txt"]):
+        file_path = tmp_path / rel_path
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        content = ("line %d\n" % i).encode("ascii") * (i * 300)
+        file_path.write_bytes(content)
+        contents[str(file_path)] = content
+    return tmp_path, contents
@@ -0,0 +1,105 @@
+import gc
+import io
+import os
+import tarfile
+import warnings
+
+import argon2
+import pytest
+from lockbyte import archive, batch, container, lock_unlock, reader
+
+
+def read_tree(root):
+    found = {}
+    for path, folders, names in os.walk(root):
+        for name in folders:
+            found[os.path.relpath(os.path.join(path, name), root)] = None
+        for name in names:
+            with open(os.path.join(path, name), "rb") as f:
+                found[os.path.relpath(os.path.join(path, name), root)] = f.read()
+    return found
+
+
+@pytest.mark.parametrize("index, compression", [(True, None), (False, None), (True, "zlib")])
+def test_pack_list_unpack_round_trip(fast_kdf, tree, index, compression):
+    root, contents = tree
+    (root / "empty").mkdir()
+    archive_path = archive.pack(str(root), "abcdef", str(root / "sub" / "data.lockbyte"), index=index,
+                                compression=compression)
+    assert archive.is_archive(archive_path)
+
+    members = archive.list_archive(archive_path, "abcdef")
+    assert [member.name for member in members] == ["a.txt", "b.csv", "empty", "sub", "sub/c.txt", "sub/deeper",
+                                                   "sub/deeper/d.log", "sub/deeper/e.txt"]
+    assert {member.name: member.size for member in members if member.type == "file"} == \
+        {os.path.relpath(file_path, str(root)).replace(os.sep, "/"): len(content)
+         for file_path, content in contents.items()}
+
+    output = batch.decrypt_file(archive_path, "abcdef") # archives are extracted by a plain decrypt
+    assert output == str(root / "sub" / "data_decrypted")
+    extracted = read_tree(output)
+    os.remove(archive_path) # written inside the folder, but left out of the archive
+    assert extracted == {name: content for name, content in read_tree(str(root)).items()
+                         if not name.startswith(os.path.join("sub", "data_decrypted"))}
+
+
+def test_listing_decrypts_only_the_index(fast_kdf, tmp_path, monkeypatch):
+    folder = tmp_path / "data"
+    folder.mkdir()
+    for i in range(20):
+        (folder / "file{0:02d}".format(i)).write_bytes(os.urandom(10000))
+    archive_path = archive.pack(str(folder), "abcdef")
+    assert archive_path == str(folder) + ".lockbyte"
+    opened = []
+    real_open_chunk = reader.open_chunk
+    monkeypatch.setattr(reader, "open_chunk", lambda key, header, index, *args: opened.append(index) or
+                        real_open_chunk(key, header, index, *args))
+    assert len(archive.list_archive(archive_path, "abcdef")) == 20
+    assert 0 < len(opened) <= 2 # the last chunk or two, out of four
+
+
+def test_tampered_archive_leaves_nothing_behind(fast_kdf, tree, tmp_path_factory):
+    root, _ = tree
+    output_folder = tmp_path_factory.mktemp("archives")
+    archive_path = archive.pack(str(root), "abcdef", str(output_folder / "data.lockbyte"))
+    with open(archive_path, "r+b") as f:
+        f.seek(-100, io.SEEK_END)
+        byte = f.read(1)
+        f.seek(-1, io.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 1]))
+    with pytest.raises(ValueError):
+        archive.unpack(archive_path, "abcdef")
+    assert os.listdir(str(output_folder)) == ["data.lockbyte"]
+    with pytest.raises(ValueError): # regular files are not archives
+        archive.unpack(batch.encrypt_file(str(root / "a.txt"), "abcdef"), "abcdef")
+
+
+def test_listing_with_wrong_password_closes_the_archive(fast_kdf, tree, tmp_path_factory):
+    root, _ = tree
+    archive_path = archive.pack(str(root), "abcdef", str(tmp_path_factory.mktemp("archives") / "data.lockbyte"))
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        with pytest.raises(argon2.exceptions.VerifyMismatchError):
+            archive.list_archive(archive_path, "abcdeg")
+        gc.collect()
+    assert not [warning for warning in caught if issubclass(warning.category, ResourceWarning)]
+
+
+def test_members_outside_the_folder_are_rejected(fast_kdf, tmp_path):
+    payload = io.BytesIO()
+    with tarfile.open(fileobj=payload, mode="w") as tar:
+        tarinfo = tarfile.TarInfo("../evil.txt")
+        tarinfo.size = 4
+        tar.addfile(tarinfo, io.BytesIO(b"evil"))
+        tarinfo = tarfile.TarInfo("big.bin") # keeps the decryption thread writing when the member is rejected
+        tarinfo.size = 2**22
+        tar.addfile(tarinfo, io.BytesIO(os.urandom(2**22)))
+    payload.seek(0)
+    user = lock_unlock.LockByteUser("abcdef", flags=container.FLAG_ARCHIVE)
+    user.validate_and_generate(1)
+    archive_path = str(tmp_path / "evil.lockbyte")
+    with open(archive_path, "wb") as f:
+        user.encrypt_stream(payload, f)
+    with pytest.raises(ValueError):
+        archive.unpack(archive_path, "abcdef")
+    assert sorted(os.listdir(str(tmp_path))) == ["evil.lockbyte"]
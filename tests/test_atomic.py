@@ -0,0 +1,98 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from lockbyte import atomic, lock_unlock
+
+
+def test_atomic_write_replaces_only_complete_files(tmp_path):
+    file_path = str(tmp_path / "out.bin")
+    with pytest.raises(RuntimeError):
+        with atomic.atomic_write(file_path) as f:
+            f.write(b"partial")
+            raise RuntimeError("interrupted")
+    assert os.listdir(str(tmp_path)) == [] # neither the output nor the temporary file is left behind
+
+    with atomic.atomic_write(file_path) as f:
+        f.write(b"complete")
+    assert os.listdir(str(tmp_path)) == ["out.bin"]
+    with open(file_path, "rb") as f:
+        assert f.read() == b"complete"
+
+
+def test_sources_are_deleted_after_the_folder_sync(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(atomic, "fsync_dir", lambda folder: calls.append(("sync", folder)))
+    source = tmp_path / "source.txt"
+    source.write_bytes(b"x")
+    syncer = atomic.DirectorySync()
+    for name in ["a.bin", "b.bin"]:
+        with atomic.atomic_write(str(tmp_path / name), syncer) as f:
+            f.write(b"y")
+    syncer.remove_after_sync(str(source))
+    assert calls == [] and source.exists()
+    syncer.flush()
+    assert calls == [("sync", str(tmp_path))] # synced once for both files
+    assert not source.exists()
+
+
+def test_failed_encryption_leaves_no_output(fast_kdf, tmp_path, monkeypatch):
+    file_path = str(tmp_path / "data.bin")
+    with open(file_path, "wb") as f:
+        f.write(b"x" * 1000)
+    user = lock_unlock.LockByteUser(passphrase="abcdef")
+
+    def fail(*args):
+        raise OSError("disk full")
+    monkeypatch.setattr(user, "encrypt_stream", fail)
+    with open(file_path, "rb") as f:
+        assert user.validate_and_generate(1)
+        with pytest.raises(OSError):
+            user.encrypt(file=f, file_path=file_path)
+    assert os.listdir(str(tmp_path)) == ["data.bin"]
+
+
+def test_name_allocator_never_hands_out_a_name_twice(tmp_path):
+    (tmp_path / "a.txt.lockbyte").write_bytes(b"existing")
+    (tmp_path / "a.txt(1).lockbyte").write_bytes(b"")
+    names = atomic.NameAllocator()
+    preferred = str(tmp_path / "a.txt.lockbyte")
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        claimed = list(pool.map(lambda _: names.claim(preferred), range(20)))
+    assert len(set(claimed)) == 20 and preferred not in claimed
+    assert sorted(os.listdir(str(tmp_path))) == ["a.txt(1).lockbyte", "a.txt.lockbyte"] # nothing created
+    names.release(claimed[0])
+    assert names.claim(str(tmp_path / "b")) == str(tmp_path / "b")
+
+    # created by another process after the listing: refused, never replaced
+    (tmp_path / "a.txt(2).lockbyte").write_bytes(b"other process")
+    with pytest.raises(FileExistsError):
+        with atomic.atomic_write(str(tmp_path / "a.txt(2).lockbyte"), exclusive=True) as f:
+            f.write(b"output")
+    assert (tmp_path / "a.txt(2).lockbyte").read_bytes() == b"other process"
+    assert not any(atomic.is_temp_file(name) for name in os.listdir(str(tmp_path)))
+
+    # written with the allocator, the complete file takes the next free name instead
+    reserved = names.claim(str(tmp_path / "c.txt"))
+    (tmp_path / "c.txt").write_bytes(b"other process")
+    writer = atomic.atomic_write(reserved, names=names)
+    with writer as f:
+        f.write(b"output")
+    assert writer.file_path == str(tmp_path / "c(1).txt")
+    assert (tmp_path / "c.txt").read_bytes() == b"other process"
+    assert (tmp_path / "c(1).txt").read_bytes() == b"output"
+
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX permissions")
+def test_atomic_write_uses_default_permissions(tmp_path):
+    mask = os.umask(0o022)
+    os.umask(mask)
+    file_path = str(tmp_path / "out.bin")
+    with atomic.atomic_write(file_path) as f:
+        f.write(b"new")
+    assert os.stat(file_path).st_mode & 0o777 == 0o666 & ~mask # as if created by open()
+    os.chmod(file_path, 0o640)
+    with atomic.atomic_write(file_path) as f:
+        f.write(b"replaced")
+    assert os.stat(file_path).st_mode & 0o777 == 0o640 # a replaced file keeps its permissions
@@ -0,0 +1,328 @@
+import os
+import threading
+
+import pytest
+import argon2
+from lockbyte import batch
+from lockbyte.journal import BatchJournal
+
+
+def list_files(root, suffix=""):
+    return sorted(os.path.join(path, name) for path, _, names in os.walk(root)
+                  for name in names if name.endswith(suffix))
+
+
+@pytest.mark.parametrize("backend", ["thread", "process"])
+def test_folder_round_trip(fast_kdf, tree, backend):
+    root, contents = tree
+    events = []
+    runner = batch.BatchRunner("encrypt", "abcdef", backend=backend, jobs=2, keep_files=False,
+                               on_event=lambda kind, file_path, value: events.append((kind, file_path)))
+    results = runner.run(list(contents))
+    assert sorted(file_path for file_path, _, error in results if error is None) == sorted(contents)
+    assert sorted(file_path for kind, file_path in events if kind == "done") == sorted(contents)
+    assert list_files(root) == list_files(root, ".lockbyte") # sources removed
+
+    runner = batch.BatchRunner("decrypt", "abcdef", backend=backend, jobs=2)
+    results = runner.run(list_files(root, ".lockbyte"))
+    assert all(error is None for _, _, error in results)
+    for file_path, content in contents.items():
+        root_name, ext = os.path.splitext(file_path)
+        with open(root_name + "_decrypted" + ext, "rb") as f:
+            assert f.read() == content
+
+
+def test_wrong_password_is_reported_per_file(fast_kdf, tree):
+    _, contents = tree
+    batch.BatchRunner("encrypt", "abcdef", keep_files=False).run(list(contents))
+    encrypted_file_paths = [file_path + ".lockbyte" for file_path in contents]
+    results = batch.BatchRunner("decrypt", "abcdeg", jobs=2).run(encrypted_file_paths)
+    assert len(results) == len(encrypted_file_paths)
+    assert all(isinstance(error, argon2.exceptions.VerifyMismatchError) for _, _, error in results)
+
+
+def test_cancelled_batch_processes_nothing(fast_kdf, tree):
+    root, contents = tree
+    runner = batch.BatchRunner("encrypt", "abcdef")
+    runner.cancel_event.set()
+    assert runner.run(list(contents)) == []
+    assert list_files(root, ".lockbyte") == []
+
+
+def test_walk_files_filters_and_orders(tree):
+    root, contents = tree
+    assert list(batch.walk_files(str(root))) == sorted(contents)
+    assert list(batch.walk_files(str(root), include="*.txt")) == sorted(p for p in contents if p.endswith(".txt"))
+    assert list(batch.walk_files(str(root), exclude="*.txt")) == sorted(p for p in contents if not p.endswith(".txt"))
+    assert list(batch.walk_files(str(root / "missing"))) == []
+
+
+def test_files_are_processed_while_the_scan_goes_on(fast_kdf, tree):
+    _, contents = tree
+    file_paths = sorted(contents)
+    first_done = threading.Event()
+
+    def scan():
+        yield file_paths[0]
+        # the rest of the tree is only listed once the first file has been encrypted
+        assert first_done.wait(timeout=30)
+        yield from file_paths[1:]
+
+    def on_event(kind, file_path, value):
+        if kind == "done" and file_path == file_paths[0]:
+            first_done.set()
+
+    results = batch.BatchRunner("encrypt", "abcdef", jobs=2, on_event=on_event).run(scan())
+    assert sorted(file_path for file_path, _, error in results if error is None) == file_paths
+
+
+def test_large_files_first_and_small_files_packed(tmp_path):
+    sizes = {"small%d" % i: 10 for i in range(40)}
+    sizes.update({"large": 100000, "medium": 50000})
+    for name, size in sizes.items():
+        (tmp_path / name).write_bytes(b"x" * size)
+    runner = batch.BatchRunner("encrypt", "abcdef", jobs=2)
+    runner.pack_size = 1000
+    tasks = runner._pack([str(tmp_path / name) for name in sizes], chunksize=64)
+    assert tasks[:2] == [[str(tmp_path / "large")], [str(tmp_path / "medium")]]
+    assert [len(task) for task in tasks[2:]] == [40] # small files share one task up to pack_size
+    assert len(runner._pack([str(tmp_path / name) for name in sizes], chunksize=16)) == 5
+
+
+def test_progress_reports_bytes_and_files(fast_kdf, tree):
+    _, contents = tree
+    snapshots = []
+    runner = batch.BatchRunner("encrypt", "abcdef", jobs=2,
+                               on_event=lambda kind, file_path, value: kind == "progress" and snapshots.append(value))
+    runner.run(sorted(contents))
+    total = sum(len(content) for content in contents.values())
+    final = snapshots[-1]
+    assert (final.files_done, final.files_total) == (len(contents), len(contents))
+    assert final.bytes_done == final.bytes_total == total
+    assert final.fraction == 1.0 and not final.scanning
+    assert all(a.bytes_done <= b.bytes_done for a, b in zip(snapshots, snapshots[1:]))
+
+
+def test_chunk_loop_reports_every_byte(fast_kdf, tmp_path):
+    file_path = tmp_path / "data.bin"
+    file_path.write_bytes(b"x" * 1000)
+    sizes = []
+    encrypted_file_path = batch.encrypt_file(str(file_path), "abcdef", progress=sizes.append)
+    assert sum(sizes) == 1000
+    sizes = []
+    batch.verify_file(encrypted_file_path, "abcdef", progress=sizes.append)
+    assert sum(sizes) == os.path.getsize(encrypted_file_path)
+
+
+def test_counters_without_results(fast_kdf, tree):
+    _, contents = tree
+    file_paths = sorted(contents) + [file_path + ".missing" for file_path in sorted(contents)[:2]]
+    runner = batch.BatchRunner("encrypt", "abcdef", jobs=2, keep_results=False)
+    assert runner.run(file_paths) == []
+    progress = runner.progress()
+    assert (progress.files_done, progress.files_failed, progress.files_total) == (len(file_paths), 2, len(file_paths))
+
+
+@pytest.mark.parametrize("action", [batch.encrypt_file, batch.decrypt_file])
+@pytest.mark.parametrize("version", [1, 3])
+def test_cancelling_mid_file_removes_partial_output(fast_kdf, tmp_path, monkeypatch, action, version):
+    monkeypatch.setattr(batch.LockByteUser, "format_version", version)
+    monkeypatch.setattr(batch.LockByteUser, "buffer_size", 2**12)
+    monkeypatch.setattr(batch.LockByteUser, "chunk_size", 2**12)
+    file_path = tmp_path / "data.bin"
+    file_path.write_bytes(b"x" * 2**16)
+    if action is batch.decrypt_file:
+        file_path = tmp_path / batch.encrypt_file(str(file_path), "abcdef", keep_files=False)
+    cancel_event = threading.Event()
+    seen = []
+
+    def progress(size):
+        seen.append(size)
+        if len(seen) == 3: # cancel while the file is half done
+            cancel_event.set()
+
+    assert action(str(file_path), "abcdef", cancel_event=cancel_event, progress=progress) is None
+    assert sum(seen) < 2**16
+    assert os.listdir(tmp_path) == [file_path.name] # partial output rolled back, source kept
+
+
+def test_rerun_skips_files_finished_by_an_interrupted_batch(fast_kdf, tree, monkeypatch, state_dir):
+    root, contents = tree
+    journal = str(state_dir / "batch.jsonl")
+    failing = sorted(contents)[1]
+    encrypt_file = batch.ACTIONS["encrypt"]
+
+    def interrupted(file_path, *args, **kwargs):
+        if file_path == failing:
+            raise OSError("interrupted")
+        return encrypt_file(file_path, *args, **kwargs)
+    monkeypatch.setitem(batch.ACTIONS, "encrypt", interrupted)
+    runner = batch.BatchRunner("encrypt", "abcdef", keep_results=False, journal=journal)
+    runner.run(batch.walk_files(str(root)))
+    assert runner.progress().files_failed == 1
+    assert os.path.isfile(journal) # kept for the rerun
+
+    monkeypatch.setitem(batch.ACTIONS, "encrypt", encrypt_file)
+    runner = batch.BatchRunner("encrypt", "abcdef", journal=journal)
+    results = runner.run(batch.walk_files(str(root), exclude="*.lockbyte"))
+    assert [(file_path, error) for file_path, _, error in results] == [(failing, None)]
+    assert runner.progress().files_skipped == len(contents) - 1
+    assert list_files(root, ")") == [] # no duplicate outputs
+    assert not os.path.isfile(journal) # every file is done
+
+
+def test_journal_replays_entries(tmp_path):
+    file_path = tmp_path / "a.txt"
+    file_path.write_bytes(b"x")
+    (tmp_path / ".a.txt.lockbyte.1234.lockbyte-part").write_bytes(b"partial")
+    (tmp_path / "a.txt.lockbyte").write_bytes(b"output")
+    journal = BatchJournal(str(tmp_path / "journal.jsonl"))
+    journal.start(str(file_path))
+    journal.done(str(file_path), str(file_path) + ".lockbyte")
+    journal.start(str(tmp_path / "b.txt"))
+    journal.close()
+    with open(str(tmp_path / "journal.jsonl"), "a") as f:
+        f.write('{"event": "done", "pa') # torn by a crash
+
+    journal = BatchJournal(str(tmp_path / "journal.jsonl"))
+    assert journal.resumed and journal.finished(str(file_path))
+    assert journal.in_flight == {str(tmp_path / "b.txt")}
+    assert list(batch.walk_files(str(tmp_path))) == [str(file_path), str(tmp_path / "a.txt.lockbyte"),
+                                                      str(tmp_path / "journal.jsonl")]
+    (tmp_path / "a.txt.lockbyte").write_bytes(b"out") # output truncated since, processed again
+    assert not journal.finished(str(file_path))
+    (tmp_path / "a.txt.lockbyte").write_bytes(b"output")
+    assert journal.finished(str(file_path))
+    os.utime(str(file_path), ns=(0, 0)) # modified since, processed again
+    assert not journal.finished(str(file_path))
+    journal.close(remove=True)
+    assert not os.path.exists(str(tmp_path / "journal.jsonl"))
+
+
+def test_rerun_starts_over_when_outputs_or_password_changed(fast_kdf, tree, monkeypatch, state_dir):
+    root, contents = tree
+    journal = str(state_dir / "batch.jsonl")
+    failing = sorted(contents)[1]
+    encrypt_file = batch.ACTIONS["encrypt"]
+
+    def interrupted(file_path, *args, **kwargs):
+        if file_path == failing:
+            raise OSError("interrupted")
+        return encrypt_file(file_path, *args, **kwargs)
+    monkeypatch.setitem(batch.ACTIONS, "encrypt", interrupted)
+    runner = batch.BatchRunner("encrypt", "abcdef", journal=journal)
+    outputs = {file_path: output for file_path, output, error in runner.run(batch.walk_files(str(root)))
+               if error is None}
+    monkeypatch.setitem(batch.ACTIONS, "encrypt", encrypt_file)
+    deleted = sorted(outputs)[0]
+    os.remove(outputs[deleted])
+
+    runner = batch.BatchRunner("encrypt", "abcdef", journal=journal)
+    results = runner.run(batch.walk_files(str(root), exclude="*.lockbyte"))
+    assert sorted(file_path for file_path, _, error in results) == sorted([failing, deleted])
+    assert all(error is None for _, _, error in results)
+
+    monkeypatch.setitem(batch.ACTIONS, "encrypt", interrupted)
+    batch.BatchRunner("encrypt", "abcdef", journal=journal).run([deleted, failing])
+    monkeypatch.setitem(batch.ACTIONS, "encrypt", encrypt_file)
+    resumed = BatchJournal(journal)
+    assert resumed.finished(deleted)
+    resumed.close()
+    runner = batch.BatchRunner("encrypt", "ghijkl", journal=journal) # other password, nothing is skipped
+    results = runner.run([deleted, failing])
+    assert sorted(file_path for file_path, _, error in results if error is None) == sorted([deleted, failing])
+    assert runner.progress().files_skipped == 0
+
+
+def test_incremental_runs_encrypt_only_changed_files(fast_kdf, tree, state_dir):
+    root, contents = tree
+    manifest = str(state_dir / "manifest.json")
+    a, b, c = sorted(contents)[1:4] # all non-empty
+
+    def run(prune=False):
+        events = []
+        runner = batch.BatchRunner("encrypt", "abcdef", manifest=manifest, prune=prune,
+                                   on_event=lambda kind, file_path, value: events.append((kind, file_path)))
+        runner.run(batch.walk_files(str(root), exclude="*.lockbyte"))
+        return sorted(file_path for kind, file_path in events if kind in ("done", "pruned")), runner.progress()
+
+    assert run()[0] == sorted(contents)
+    done, progress = run()
+    assert done == [] and progress.files_skipped == len(contents)
+
+    with open(a, "r+b") as f: # same size, new contents
+        f.write(b"X")
+    os.utime(b, ns=(0, 0)) # touched only, the hash still matches
+    os.remove(c)
+    done, progress = run(prune=True)
+    assert done == [a, c + ".lockbyte"]
+    assert list_files(root, ")") == [] # the previous output was replaced
+    assert not os.path.exists(c + ".lockbyte")
+    batch.decrypt_file(a + ".lockbyte", "abcdef")
+    root_name, ext = os.path.splitext(a)
+    with open(root_name + "_decrypted" + ext, "rb") as f:
+        assert f.read() == b"X" + contents[a][1:]
+    with pytest.raises(ValueError):
+        batch.BatchRunner("decrypt", "abcdef", manifest=manifest)
+
+
+def test_compressed_batch_round_trip(fast_kdf, tree):
+    root, contents = tree
+    batch.BatchRunner("encrypt", "abcdef", compression="auto", keep_files=False).run(list(contents))
+    results = batch.BatchRunner("decrypt", "abcdef").run(list_files(root, ".lockbyte"))
+    assert all(error is None for _, _, error in results)
+    for file_path, content in contents.items():
+        root_name, ext = os.path.splitext(file_path)
+        with open(root_name + "_decrypted" + ext, "rb") as f:
+            assert f.read() == content
+    with pytest.raises(ValueError):
+        batch.BatchRunner("decrypt", "abcdef", compression="zlib")
+
+
+def test_worker_processes_split_the_chunk_threads(monkeypatch):
+    pools = []
+
+    class Pool:
+        def __init__(self, **kwargs):
+            pools.append(kwargs)
+    monkeypatch.setattr(batch, "ProcessPoolExecutor", Pool)
+    monkeypatch.setattr(batch, "aes_workers", lambda: 8)
+    runner = batch.BatchRunner("decrypt", "abcdef", backend="process", jobs=4)
+    runner._create_pool(batch.LockByteSession("abcdef"))
+    assert pools[0]["initargs"][-1] == 2 # 4 processes with 2 chunk threads each, not 8 each
+
+
+@pytest.mark.parametrize("backend", ["thread", "process"])
+def test_parallel_outputs_in_one_folder_get_unique_names(fast_kdf, tree, backend):
+    root, contents = tree
+    file_path = next(iter(contents))
+    results = batch.BatchRunner("encrypt", "abcdef", backend=backend, jobs=4, chunksize=1).run([file_path] * 6)
+    outputs = [file_path_new for _, file_path_new, error in results if error is None]
+    assert len(set(outputs)) == 6
+    results = batch.BatchRunner("decrypt", "abcdef", backend=backend, jobs=4, chunksize=1).run(outputs)
+    decrypted = [file_path_new for _, file_path_new, error in results if error is None]
+    assert len(set(decrypted)) == 6
+    for decrypted_path in decrypted:
+        with open(decrypted_path, "rb") as f:
+            assert f.read() == contents[file_path]
+
+
+def test_incremental_runs_keep_unrelated_outputs_and_follow_the_password(fast_kdf, tree, state_dir):
+    root, contents = tree
+    manifest = str(state_dir / "manifest.json")
+    a = sorted(contents)[1]
+    with open(a + ".lockbyte", "wb") as f:
+        f.write(b"unrelated")
+    results = batch.BatchRunner("encrypt", "abcdef", manifest=manifest).run(
+        batch.walk_files(str(root), exclude="*.lockbyte"))
+    outputs = {file_path: file_path_new for file_path, file_path_new, _ in results}
+    with open(a + ".lockbyte", "rb") as f:
+        assert f.read() == b"unrelated" # not recorded by an earlier run, never replaced
+    assert outputs[a] == a + "(1).lockbyte"
+
+    # another password encrypts every file again, replacing the outputs written by the first run
+    results = batch.BatchRunner("encrypt", "ghijkl", manifest=manifest).run(
+        batch.walk_files(str(root), exclude="*.lockbyte"))
+    assert {file_path: file_path_new for file_path, file_path_new, _ in results} == outputs
+    results = batch.BatchRunner("check", "ghijkl").run(list(outputs.values()))
+    assert all(error is None for _, _, error in results)
@@ -0,0 +1,138 @@
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+from lockbyte import cli, lock_unlock
+
+
+def test_cli_does_not_import_gui_stack():
+    code = "import sys, lockbyte.cli; print(any(m in sys.modules for m in ('customtkinter', 'PIL', 'darkdetect')))"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                            env=dict(os.environ, PYTHONPATH="src"), check=True).stdout
+    assert output.strip() == "False"
+
+
+def test_encrypt_verify_decrypt_folder(fast_kdf, tree, monkeypatch, capsys):
+    root, contents = tree
+    monkeypatch.setenv("LOCKBYTE_PASSWORD", "abcdef")
+    assert cli.main(["encrypt", "-r", "-j", "2", "--delete", "--password-env", "LOCKBYTE_PASSWORD", str(root)]) == 0
+    assert all(not os.path.exists(file_path) for file_path in contents)
+    # existing .lockbyte files are not encrypted a second time
+    with pytest.raises(SystemExit):
+        cli.main(["encrypt", "-r", "--password-env", "LOCKBYTE_PASSWORD", str(root)])
+    assert cli.main(["verify", "-r", "--password-env", "LOCKBYTE_PASSWORD", str(root)]) == 0
+    assert cli.main(["decrypt", "-r", "--password-env", "LOCKBYTE_PASSWORD", str(root)]) == 0
+    for file_path, content in contents.items():
+        root_name, ext = os.path.splitext(file_path)
+        with open(root_name + "_decrypted" + ext, "rb") as f:
+            assert f.read() == content
+
+
+def password_fd(password):
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, password.encode() + b"\n")
+    os.close(write_fd)
+    return str(read_fd)
+
+
+def test_wrong_password_fails_verification(fast_kdf, tree, capsys):
+    root, contents = tree
+    file_path = next(iter(contents))
+    assert cli.main(["encrypt", "--password-fd", password_fd("abcdef"), file_path]) == 0
+    assert cli.main(["verify", "--password-fd", password_fd("abcdeg"), file_path + ".lockbyte"]) == 1
+    assert "password is incorrect" in capsys.readouterr().err
+
+
+def test_verify_reads_headers_only_unless_full(fast_kdf, tree, monkeypatch, capsys):
+    root, contents = tree
+    monkeypatch.setenv("LOCKBYTE_PASSWORD", "abcdef")
+    file_path = list(contents)[-1]
+    assert cli.main(["encrypt", "--password-env", "LOCKBYTE_PASSWORD", file_path]) == 0
+    with open(file_path + ".lockbyte", "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)[0]
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last ^ 1])) # corrupt the last tag, the header stays intact
+    monkeypatch.setattr(lock_unlock, "scrypt", None) # no key is derived for a header check
+    assert cli.main(["verify", "--password-env", "LOCKBYTE_PASSWORD", file_path + ".lockbyte"]) == 0
+    monkeypatch.undo()
+    monkeypatch.setenv("LOCKBYTE_PASSWORD", "abcdef")
+    assert cli.main(["verify", "--full", "--password-env", "LOCKBYTE_PASSWORD", file_path + ".lockbyte"]) == 1
+    assert "file is corrupt" in capsys.readouterr().err
+
+
+def test_folder_requires_recursive_flag(tree):
+    root, _ = tree
+    with pytest.raises(SystemExit) as e:
+        cli.main(["encrypt", "--password-env", "UNUSED", str(root)])
+    assert e.value.code == 2
+
+
+class Pipe(io.BytesIO):
+    # stands in for a non-seekable pipe
+    def seekable(self):
+        return False
+
+    def seek(self, *args):
+        raise io.UnsupportedOperation("seek")
+
+
+def test_pipe_round_trip_through_standard_streams(fast_kdf, monkeypatch):
+    content = b"COPY data FROM stdin;\n" * 5000
+    monkeypatch.setenv("LOCKBYTE_PASSWORD", "abcdef")
+    stdout = io.TextIOWrapper(Pipe())
+    monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(Pipe(content)))
+    monkeypatch.setattr(sys, "stdout", stdout)
+    assert cli.main(["encrypt", "--password-env", "LOCKBYTE_PASSWORD", "-"]) == 0
+    encrypted = stdout.buffer.getvalue()
+    assert content not in encrypted
+
+    stdout = io.TextIOWrapper(Pipe())
+    monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(Pipe(encrypted)))
+    monkeypatch.setattr(sys, "stdout", stdout)
+    assert cli.main(["decrypt", "--password-env", "LOCKBYTE_PASSWORD", "-"]) == 0
+    assert stdout.buffer.getvalue() == content
+
+
+def test_decrypt_to_explicit_output_file(fast_kdf, tree, monkeypatch):
+    root, contents = tree
+    file_path, content = list(contents.items())[-1]
+    monkeypatch.setenv("LOCKBYTE_PASSWORD", "abcdef")
+    assert cli.main(["encrypt", "--password-env", "LOCKBYTE_PASSWORD", "-o", str(root / "out.bin"), file_path]) == 0
+    assert cli.main(["decrypt", "--password-env", "LOCKBYTE_PASSWORD", "-o", str(root / "plain"), str(root / "out.bin")]) == 0
+    assert (root / "plain").read_bytes() == content
+
+
+def test_pack_list_unpack(fast_kdf, tree, monkeypatch, capsys, tmp_path_factory):
+    root, contents = tree
+    output_folder = tmp_path_factory.mktemp("archives")
+    monkeypatch.setenv("LOCKBYTE_PASSWORD", "abcdef")
+    options = ["--password-env", "LOCKBYTE_PASSWORD"]
+    assert cli.main(["pack", *options, "-o", str(output_folder / "data.lockbyte"), str(root)]) == 0
+    capsys.readouterr()
+    assert cli.main(["list", *options, str(output_folder / "data.lockbyte")]) == 0
+    assert capsys.readouterr().out.splitlines() == ["a.txt", "b.csv", "sub/", "sub/c.txt", "sub/deeper/",
+                                                    "sub/deeper/d.log", "sub/deeper/e.txt"]
+    assert cli.main(["unpack", *options, "-o", str(output_folder / "data"), str(output_folder / "data.lockbyte")]) == 0
+    for file_path, content in contents.items():
+        with open(os.path.join(str(output_folder / "data"), os.path.relpath(file_path, str(root))), "rb") as f:
+            assert f.read() == content
+    assert cli.main(["unpack", *options, "-o", str(output_folder / "data"), str(output_folder / "data.lockbyte")]) == 1
+
+
+def test_rekey_changes_password_of_files(fast_kdf, tree, monkeypatch, capsys):
+    root, contents = tree
+    monkeypatch.setenv("LOCKBYTE_PASSWORD", "abcdef")
+    monkeypatch.setenv("LOCKBYTE_NEW_PASSWORD", "ghijkl")
+    file_paths = list(contents)[:2]
+    assert cli.main(["encrypt", "--password-env", "LOCKBYTE_PASSWORD", *file_paths]) == 0
+    encrypted = [file_path + ".lockbyte" for file_path in file_paths]
+    assert cli.main(["rekey", "--password-env", "LOCKBYTE_PASSWORD", "--new-password-env", "LOCKBYTE_NEW_PASSWORD",
+                     *encrypted]) == 0
+    assert cli.main(["verify", "--password-env", "LOCKBYTE_PASSWORD", *encrypted]) == 1
+    assert cli.main(["verify", "--password-env", "LOCKBYTE_NEW_PASSWORD", *encrypted]) == 0
+    capsys.readouterr()
+    assert cli.main(["rekey", "--remove", "--password-env", "LOCKBYTE_NEW_PASSWORD", encrypted[0]]) == 1
+    assert "only password" in capsys.readouterr().err
@@ -1,9 +1,11 @@
+import io
+import errno
 import os
 from difflib import unified_diff
 
 import pytest
 import argon2
-from lockbyte import lock_unlock
+from lockbyte import lock_unlock, container, compress
 
 
 @pytest.fixture
@@ -33,7 +35,7 @@ def fixed_user():
         os.remove(file_path)  # remove file if previously generated
     with open(file_path, "w") as f:
         f.write('')
-    user = lock_unlock.LockByteUser(passphrase=user_password)
+    user = lock_unlock.LockByteUser(passphrase=user_password, format_version=1)
     return (user, file_path)
 
 
@@ -88,3 +90,375 @@ def test_decrypted_file_matches_original_file(fixed_user):
     diff = list(unified_diff(expected_lines, actual_lines))
     assert diff == [], "Unexpected file contents:\n" + "".join(diff)
 
+
+
+@pytest.mark.parametrize("size", [0, 15, 16, 17, 48, 96, 1000, 4096])
+def test_chunked_round_trip_with_small_buffer(fast_kdf, fixed_user, size):
+    _, file_path = fixed_user
+    content = "".join(str(i%10) for i in range(size)).encode("ascii")
+    with open(file_path, "wb") as f:
+        f.write(content)
+    user = lock_unlock.LockByteUser(passphrase="abcdef", buffer_size=48, format_version=1)
+    with open(file_path, "rb") as f:
+        if user.validate_and_generate(1):
+            user.encrypt(file=f, file_path=file_path)
+    assert os.path.getsize(file_path + ".lockbyte") == 134 + (size // 16 + 1) * 16
+    user = lock_unlock.LockByteUser(passphrase="abcdef", buffer_size=48)
+    with open(file_path + ".lockbyte", "rb") as f:
+        decrypted_file_path = user.decrypt(file=f, file_path=file_path + ".lockbyte")
+    with open(decrypted_file_path, "rb") as f:
+        assert f.read() == content
+
+
+@pytest.mark.parametrize("size", [0, 1, 63, 64, 65, 1000])
+def test_authenticated_chunks_round_trip(fast_kdf, fixed_user, size):
+    _, file_path = fixed_user
+    content = "".join(str(i%10) for i in range(size)).encode("ascii")
+    with open(file_path, "wb") as f:
+        f.write(content)
+    user = lock_unlock.LockByteUser(passphrase="abcdef", chunk_size=64)
+    with open(file_path, "rb") as f:
+        if user.validate_and_generate(1):
+            encrypted_file_path = user.encrypt(file=f, file_path=file_path)
+    # every chunk carries a 16-byte tag, the last chunk is always shorter than chunk size
+    header_size = container.HEADER_V4.size + lock_unlock.LockByteUser.key_slots * container.KEY_SLOT.size
+    assert os.path.getsize(encrypted_file_path) == header_size + size + (size // 64 + 1) * 16
+    user = lock_unlock.LockByteUser(passphrase="abcdef")
+    with open(encrypted_file_path, "rb") as f:
+        decrypted_file_path = user.decrypt(file=f, file_path=encrypted_file_path)
+    with open(decrypted_file_path, "rb") as f:
+        assert f.read() == content
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_parallel_chunks_are_written_in_order(fast_kdf, fixed_user, workers):
+    _, file_path = fixed_user
+    content = "".join(str(i%7) for i in range(5000)).encode("ascii")
+    with open(file_path, "wb") as f:
+        f.write(content)
+    user = lock_unlock.LockByteUser(passphrase="abcdef", chunk_size=64, workers=workers)
+    with open(file_path, "rb") as f:
+        if user.validate_and_generate(1):
+            encrypted_file_path = user.encrypt(file=f, file_path=file_path)
+    for decrypt_workers in (1, 3):
+        output = io.BytesIO()
+        with open(encrypted_file_path, "rb") as f:
+            lock_unlock.LockByteUser(passphrase="abcdef", workers=decrypt_workers).decrypt_stream(f, output)
+        assert output.getvalue() == content
+
+
+class ReadOnlyStream:
+    # stream without readinto, e.g. a custom file-like wrapper
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._data.read(size)
+
+
+@pytest.mark.parametrize("version", [1, 3])
+def test_streams_without_readinto(fast_kdf, version):
+    content = b"0123456789" * 50
+    user = lock_unlock.LockByteUser(passphrase="abcdef", format_version=version, buffer_size=64, chunk_size=64)
+    encrypted = io.BytesIO()
+    if user.validate_and_generate(1):
+        user.encrypt_stream(ReadOnlyStream(content), encrypted)
+    output = io.BytesIO()
+    lock_unlock.LockByteUser(passphrase="abcdef", buffer_size=64).decrypt_stream(ReadOnlyStream(encrypted.getvalue()), output)
+    assert output.getvalue() == content
+
+
+@pytest.mark.parametrize("offset", [10, 160, 400, -1])
+def test_authenticated_chunks_detect_tampering(fast_kdf, fixed_user, offset):
+    _, file_path = fixed_user
+    with open(file_path, "w") as f:
+        f.write("This is a test." * 20)
+    user = lock_unlock.LockByteUser(passphrase="abcdef", chunk_size=64)
+    with open(file_path, "rb") as f:
+        if user.validate_and_generate(1):
+            encrypted_file_path = user.encrypt(file=f, file_path=file_path)
+    with open(encrypted_file_path, "rb") as f:
+        data = bytearray(f.read())
+    data[offset] ^= 1 # flip one bit of the header, a chunk or the final tag
+    output = io.BytesIO()
+    with pytest.raises(ValueError):
+        lock_unlock.LockByteUser(passphrase="abcdef", workers=4).decrypt_stream(io.BytesIO(bytes(data)), output)
+
+
+def test_authenticated_chunks_detect_truncation(fast_kdf, fixed_user):
+    _, file_path = fixed_user
+    with open(file_path, "w") as f:
+        f.write("This is a test." * 20)
+    user = lock_unlock.LockByteUser(passphrase="abcdef", chunk_size=64)
+    with open(file_path, "rb") as f:
+        if user.validate_and_generate(1):
+            encrypted_file_path = user.encrypt(file=f, file_path=file_path)
+    with open(encrypted_file_path, "rb") as f:
+        data = f.read()
+    # cutting the file at a chunk boundary must not pass for a shorter file
+    header_size = container.HEADER_V4.size + lock_unlock.LockByteUser.key_slots * container.KEY_SLOT.size
+    truncated = data[:header_size + 2 * (64 + 16)]
+    with pytest.raises(ValueError):
+        lock_unlock.LockByteUser(passphrase="abcdef").decrypt_stream(io.BytesIO(truncated), io.BytesIO())
+
+
+@pytest.mark.parametrize("version", [1, 2])
+def test_older_format_versions_remain_readable(fast_kdf, fixed_user, version):
+    _, file_path = fixed_user
+    with open(file_path, "w") as f:
+        f.write("This is a test.")
+    user = lock_unlock.LockByteUser(passphrase="abcdef", format_version=version)
+    with open(file_path, "rb") as f:
+        if user.validate_and_generate(1):
+            encrypted_file_path = user.encrypt(file=f, file_path=file_path)
+    output = io.BytesIO()
+    with open(encrypted_file_path, "rb") as f:
+        lock_unlock.LockByteUser(passphrase="abcdef").decrypt_stream(f, output)
+    assert output.getvalue() == b"This is a test."
+
+
+def test_session_derives_kdf_once_with_per_file_keys(fast_kdf, fixed_user, monkeypatch):
+    _, file_path = fixed_user
+    calls = []
+    real_scrypt = lock_unlock.scrypt
+    monkeypatch.setattr(lock_unlock, "scrypt", lambda **kw: calls.append(1) or real_scrypt(**kw))
+    with open(file_path, "w") as f:
+        f.write("This is a test.")
+    keys, outputs = [], []
+    with lock_unlock.LockByteSession("abcdef") as session:
+        for _ in range(3):
+            user = lock_unlock.LockByteUser(passphrase="abcdef", session=session)
+            with open(file_path, "rb") as f:
+                if user.validate_and_generate(1):
+                    user.encrypt(file=f, file_path=file_path)
+            keys.append(user._key)
+        assert len(calls) == 1 # one scrypt run for the whole batch
+    assert len(set(keys)) == 3 # every file still gets its own key
+    for encrypted_file_path in [file_path + ".lockbyte", "tests/temp/test.txt(1).lockbyte", "tests/temp/test.txt(2).lockbyte"]:
+        with open(encrypted_file_path, "rb") as f:
+            assert f.read(8) == lock_unlock.FORMAT_MAGIC
+        user = lock_unlock.LockByteUser(passphrase="abcdef")
+        with open(encrypted_file_path, "rb") as f:
+            decrypted_file_path = user.decrypt(file=f, file_path=encrypted_file_path)
+        with open(decrypted_file_path, "r") as f:
+            assert f.read() == "This is a test."
+        os.remove(encrypted_file_path)
+        os.remove(decrypted_file_path)
+
+
+def test_session_caches_keys_for_batch_decryption(fast_kdf, fixed_user, monkeypatch):
+    _, file_path = fixed_user
+    with open(file_path, "w") as f:
+        f.write("This is a test.")
+    encrypted_file_paths = [file_path + ".lockbyte", "tests/temp/test.txt(1).lockbyte"]
+    with lock_unlock.LockByteSession("abcdef") as session:
+        for _ in encrypted_file_paths:
+            user = lock_unlock.LockByteUser(passphrase="abcdef", session=session)
+            with open(file_path, "rb") as f:
+                if user.validate_and_generate(1):
+                    user.encrypt(file=f, file_path=file_path)
+    calls = []
+    real_scrypt = lock_unlock.scrypt
+    monkeypatch.setattr(lock_unlock, "scrypt", lambda **kw: calls.append(1) or real_scrypt(**kw))
+    session = lock_unlock.LockByteSession("abcdef")
+    for encrypted_file_path in encrypted_file_paths:
+        user = lock_unlock.LockByteUser(passphrase="abcdef", session=session)
+        with open(encrypted_file_path, "rb") as f:
+            decrypted_file_path = user.decrypt(file=f, file_path=encrypted_file_path)
+        with open(decrypted_file_path, "r") as f:
+            assert f.read() == "This is a test."
+        os.remove(encrypted_file_path)
+        os.remove(decrypted_file_path)
+    assert len(calls) == 1 # files sharing a salt cost a single KDF run
+    assert len(session.key_cache) == 1
+    session.close()
+    assert len(session.key_cache) == 0
+
+
+def test_key_cache_evicts_least_recently_used():
+    cache = lock_unlock.KeyCache(max_entries=2)
+    cache.put("a", b"\x01" * 32)
+    cache.put("b", b"\x02" * 32)
+    evicted = cache._entries["b"]
+    assert cache.get("a") == b"\x01" * 32 # "a" becomes most recently used
+    cache.put("c", b"\x03" * 32)
+    assert cache.get("b") is None
+    assert cache.get("a") == b"\x01" * 32
+    assert evicted == bytearray(32) # key material is wiped on eviction
+
+
+@pytest.mark.parametrize("version", [1, 3])
+def test_progress_counts_every_input_byte(fast_kdf, version):
+    content = b"0123456789" * 50
+    sizes = []
+    user = lock_unlock.LockByteUser(passphrase="abcdef", format_version=version, buffer_size=64, chunk_size=64,
+                                    progress=sizes.append)
+    encrypted = io.BytesIO()
+    if user.validate_and_generate(1):
+        user.encrypt_stream(io.BytesIO(content), encrypted)
+    assert sum(sizes) == len(content)
+    sizes = []
+    user = lock_unlock.LockByteUser(passphrase="abcdef", buffer_size=64, progress=sizes.append)
+    user.decrypt_stream(io.BytesIO(encrypted.getvalue()), io.BytesIO())
+    assert sum(sizes) == len(encrypted.getvalue())
+
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma", "zstd"])
+def test_compressed_round_trip(fast_kdf, codec):
+    if codec not in compress.available_codecs():
+        pytest.skip("zstd is not installed")
+    content = b"timestamp,level,message\n" + b"2024-01-01T00:00:00,INFO,request served\n" * 5000
+    sizes = []
+    user = lock_unlock.LockByteUser(passphrase="abcdef", chunk_size=1024, compression=codec, progress=sizes.append)
+    encrypted = io.BytesIO()
+    if user.validate_and_generate(1):
+        user.encrypt_stream(io.BytesIO(content), encrypted)
+    assert sum(sizes) == len(content) # progress counts plaintext bytes
+    assert len(encrypted.getvalue()) < len(content) // 10
+    decrypted = io.BytesIO()
+    lock_unlock.LockByteUser(passphrase="abcdef").decrypt_stream(io.BytesIO(encrypted.getvalue()), decrypted)
+    assert decrypted.getvalue() == content
+
+
+def test_auto_compression_skips_incompressible_data(fast_kdf):
+    for content, codec in [(os.urandom(200000), None), (b"abc" * 100000, "zlib"), (b"abc", None)]:
+        user = lock_unlock.LockByteUser(passphrase="abcdef", compression="auto")
+        encrypted = io.BytesIO()
+        if user.validate_and_generate(1):
+            user.encrypt_stream(io.BytesIO(content), encrypted)
+        if codec == "zlib" and "zstd" in compress.available_codecs():
+            codec = "zstd"
+        assert user.codec == codec
+        reader = lock_unlock.LockByteUser(passphrase="abcdef")
+        decrypted = io.BytesIO()
+        reader.decrypt_stream(io.BytesIO(encrypted.getvalue()), decrypted)
+        assert reader.codec == codec # detected from the header
+        assert decrypted.getvalue() == content
+
+
+def test_tampered_compressed_file_is_rejected(fast_kdf):
+    user = lock_unlock.LockByteUser(passphrase="abcdef", chunk_size=64, compression="zlib")
+    encrypted = io.BytesIO()
+    if user.validate_and_generate(1):
+        user.encrypt_stream(io.BytesIO(os.urandom(1000)), encrypted)
+    data = bytearray(encrypted.getvalue())
+    data[-40] ^= 1
+    with pytest.raises(ValueError):
+        lock_unlock.LockByteUser(passphrase="abcdef").decrypt_stream(io.BytesIO(bytes(data)), io.BytesIO())
+    with pytest.raises(ValueError):
+        lock_unlock.LockByteUser(passphrase="abcdef", format_version=2, compression="zlib")
+
+
+def encrypt_file(tmp_path, content, **kwargs):
+    file_path = str(tmp_path / "data.bin")
+    with open(file_path, "wb") as f:
+        f.write(content)
+    user = lock_unlock.LockByteUser(passphrase="abcdef", chunk_size=64, **kwargs)
+    with open(file_path, "rb") as f:
+        if user.validate_and_generate(1):
+            return user.encrypt(file=f, file_path=file_path)
+
+
+def decrypt_bytes(file_path, passphrase):
+    output = io.BytesIO()
+    with open(file_path, "rb") as f:
+        lock_unlock.LockByteUser(passphrase=passphrase).decrypt_stream(f, output)
+    return output.getvalue()
+
+
+def test_change_password_rewrites_header_only(fast_kdf, tmp_path):
+    content = os.urandom(1000)
+    encrypted_file_path = encrypt_file(tmp_path, content)
+    with open(encrypted_file_path, "rb") as f:
+        before = f.read()
+    lock_unlock.LockByteUser(passphrase="abcdef").change_password(encrypted_file_path, "ghijkl")
+    with open(encrypted_file_path, "rb") as f:
+        after = f.read()
+    header_size = container.HEADER_V4.size + lock_unlock.LockByteUser.key_slots * container.KEY_SLOT.size
+    assert len(after) == len(before) and after[header_size:] == before[header_size:]
+    assert decrypt_bytes(encrypted_file_path, "ghijkl") == content
+    with pytest.raises(argon2.exceptions.VerifyMismatchError):
+        decrypt_bytes(encrypted_file_path, "abcdef")
+
+
+def test_add_and_remove_passwords(fast_kdf, tmp_path):
+    content = b"slots" * 100
+    encrypted_file_path = encrypt_file(tmp_path, content, key_slots=2)
+    with lock_unlock.LockByteSession("ghijkl") as session:
+        assert lock_unlock.LockByteUser(passphrase="abcdef").add_password(encrypted_file_path, session) == 1
+    with pytest.raises(ValueError): # both slots in use
+        lock_unlock.LockByteUser(passphrase="abcdef").add_password(encrypted_file_path, "mnopqr")
+    for passphrase in ("abcdef", "ghijkl"):
+        assert decrypt_bytes(encrypted_file_path, passphrase) == content
+        with open(encrypted_file_path, "rb") as f:
+            assert lock_unlock.LockByteUser(passphrase=passphrase).verify_password(f)
+    assert lock_unlock.LockByteUser(passphrase="abcdef").remove_password(encrypted_file_path) == 0
+    with pytest.raises(argon2.exceptions.VerifyMismatchError):
+        decrypt_bytes(encrypted_file_path, "abcdef")
+    with pytest.raises(ValueError): # the last password cannot be removed
+        lock_unlock.LockByteUser(passphrase="ghijkl").remove_password(encrypted_file_path)
+    assert decrypt_bytes(encrypted_file_path, "ghijkl") == content
+
+
+def test_interrupted_rekey_is_repaired(fast_kdf, tmp_path):
+    content = b"torn" * 100
+    encrypted_file_path = encrypt_file(tmp_path, content)
+    backup = lock_unlock.header_backup_path(encrypted_file_path)
+    size = container.HEADER_V4.size + lock_unlock.LockByteUser.key_slots * container.KEY_SLOT.size
+    with open(encrypted_file_path, "r+b") as f:
+        header = f.read(size)
+        os.makedirs(os.path.dirname(backup), exist_ok=True)
+        with open(backup, "wb") as b: # old header, then the new one
+            b.write(header + header[:container.HEADER_V4.size] + os.urandom(size - container.HEADER_V4.size))
+        f.seek(container.HEADER_V4.size + 10)
+        f.write(bytes(20)) # crash while the first slot was being rewritten
+    lock_unlock.LockByteUser(passphrase="abcdef").change_password(encrypted_file_path, "ghijkl")
+    assert not os.path.exists(backup)
+    assert decrypt_bytes(encrypted_file_path, "ghijkl") == content
+
+
+def test_stale_rekey_backup_never_brings_back_an_old_password(fast_kdf, tmp_path, monkeypatch):
+    content = b"stale" * 100
+    encrypted_file_path = encrypt_file(tmp_path, content)
+    backup = lock_unlock.header_backup_path(encrypted_file_path)
+    remove = os.remove
+    monkeypatch.setattr(lock_unlock, "osremove", lambda path: None) # crash once the new header is durable
+    lock_unlock.LockByteUser(passphrase="abcdef").change_password(encrypted_file_path, "ghijkl")
+    monkeypatch.setattr(lock_unlock, "osremove", remove)
+    assert os.path.isfile(backup)
+    with pytest.raises(argon2.exceptions.VerifyMismatchError):
+        lock_unlock.LockByteUser(passphrase="abcdef").change_password(encrypted_file_path, "mnopqr")
+    assert not os.path.exists(backup)
+    assert decrypt_bytes(encrypted_file_path, "ghijkl") == content
+
+
+def test_rekey_requires_format_version_4(fast_kdf, tmp_path):
+    encrypted_file_path = encrypt_file(tmp_path, b"old", format_version=3)
+    with pytest.raises(ValueError):
+        lock_unlock.LockByteUser(passphrase="abcdef").change_password(encrypted_file_path, "ghijkl")
+    assert decrypt_bytes(encrypted_file_path, "abcdef") == b"old"
+
+
+class FullDisk(io.RawIOBase):
+    # output failing once a few chunks were written
+    def __init__(self):
+        self.written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.written += len(data)
+        if self.written > 2**18:
+            raise OSError(errno.ENOSPC, "No space left on device")
+        return len(data)
+
+
+def test_failed_write_of_compressed_file_is_reported(fast_kdf):
+    user = lock_unlock.LockByteUser(passphrase="abcdef", compression="zlib")
+    encrypted = io.BytesIO()
+    if user.validate_and_generate(1):
+        user.encrypt_stream(io.BytesIO(os.urandom(2**22)), encrypted)
+    with pytest.raises(OSError) as error:
+        lock_unlock.LockByteUser(passphrase="abcdef").decrypt_stream(io.BytesIO(encrypted.getvalue()), FullDisk())
+    assert error.value.errno == errno.ENOSPC # not the broken pipe it caused on the decryption thread
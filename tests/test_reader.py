@@ -0,0 +1,54 @@
+import io
+
+import pytest
+from lockbyte import lock_unlock, reader
+
+
+def encrypt(tmp_path, content, **kwargs):
+    file_path = str(tmp_path / "data.bin")
+    with open(file_path, "wb") as f:
+        f.write(content)
+    user = lock_unlock.LockByteUser(passphrase="abcdef", **kwargs)
+    with open(file_path, "rb") as f:
+        if user.validate_and_generate(1):
+            return user.encrypt(file=f, file_path=file_path)
+
+
+@pytest.mark.parametrize("size", [0, 63, 64, 1000])
+def test_reads_byte_ranges(fast_kdf, tmp_path, size):
+    content = bytes(i % 251 for i in range(size))
+    encrypted_file_path = encrypt(tmp_path, content, chunk_size=64)
+    with reader.open_encrypted(encrypted_file_path, "abcdef") as f:
+        assert f.size == size
+        assert f.read() == content
+        for offset, length in [(0, 10), (60, 10), (64, 64), (500, 300), (size - 5, 100), (size + 10, 5)]:
+            offset = max(0, offset)
+            assert f.read_at(offset, length) == content[offset:offset + length]
+        f.seek(-min(3, size), io.SEEK_END)
+        assert f.tell() == max(0, size - 3)
+        assert f.read() == content[size - min(3, size):]
+
+
+def test_decrypts_only_the_chunks_covering_the_range(fast_kdf, tmp_path, monkeypatch):
+    content = bytes(i % 251 for i in range(64 * 100))
+    encrypted_file_path = encrypt(tmp_path, content, chunk_size=64)
+    opened = []
+    real_open_chunk = reader.open_chunk
+    monkeypatch.setattr(reader, "open_chunk", lambda key, header, index, *args: opened.append(index) or
+                        real_open_chunk(key, header, index, *args))
+    with reader.open_encrypted(encrypted_file_path, "abcdef") as f:
+        assert f.read_at(64 * 50 + 60, 8) == content[64 * 50 + 60:64 * 50 + 68]
+    assert opened == [50, 51]
+
+
+def test_rejects_tampered_chunk_and_older_formats(fast_kdf, tmp_path):
+    encrypted_file_path = encrypt(tmp_path, b"x" * 1000, chunk_size=64)
+    with open(encrypted_file_path, "r+b") as f:
+        f.seek(-20, io.SEEK_END)
+        f.write(b"y")
+    with reader.open_encrypted(encrypted_file_path, "abcdef") as f:
+        assert f.read_at(0, 10) == b"x" * 10
+        with pytest.raises(ValueError):
+            f.read_at(990, 10)
+    with pytest.raises(ValueError):
+        reader.open_encrypted(encrypt(tmp_path, b"x" * 10, format_version=1), "abcdef")
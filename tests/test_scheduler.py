@@ -0,0 +1,47 @@
+import threading
+import time
+
+from lockbyte import scheduler
+
+
+def test_scrypt_memory_matches_default_parameters():
+    assert scheduler.scrypt_memory({"key_len": 32, "N": 2**20, "r": 8, "p": 1}) == 128 * 8 * (2**20 + 1)
+
+
+def test_available_memory_is_positive_when_known():
+    available = scheduler.available_memory()
+    assert available is None or available > 0
+
+
+def test_capacity_is_sized_from_available_memory(monkeypatch):
+    key_params = {"key_len": 32, "N": 2**20, "r": 8, "p": 1}
+    monkeypatch.setattr(scheduler, "aes_workers", lambda: 16)
+    monkeypatch.setattr(scheduler, "available_memory", lambda: 4 * scheduler.scrypt_memory(key_params))
+    assert scheduler.KDFScheduler(headroom=1).capacity(key_params) == 4
+    assert scheduler.KDFScheduler(max_slots=2, headroom=1).capacity(key_params) == 2
+    monkeypatch.setattr(scheduler, "available_memory", lambda: 1024)
+    assert scheduler.KDFScheduler().capacity(key_params) == 1 # one derivation is always allowed
+
+
+def test_slot_limits_concurrent_derivations(monkeypatch):
+    monkeypatch.setattr(scheduler, "aes_workers", lambda: 16)
+    monkeypatch.setattr(scheduler, "available_memory", lambda: None)
+    kdf_scheduler = scheduler.KDFScheduler(max_slots=2)
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def derive():
+        with kdf_scheduler.slot({"key_len": 32, "N": 2**14, "r": 8, "p": 1}):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+
+    threads = [threading.Thread(target=derive) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 2